@@ -0,0 +1,439 @@
+"""
+Headless HTTP API (JSON) для скриптов и внешних инструментов: расширение
+идей (обычное, пакетное, потоковое) и операции с библиотекой промптов.
+Тела запросов разбираются и ответы сериализуются orjson.
+
+Подключается к серверу интерфейса (app.create_server, префикс /api/v1)
+или запускается отдельно, без Gradio:
+
+    python api.py --port 8000
+"""
+
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional
+
+import orjson
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+
+import jobs
+import llm_adapter
+import metrics
+import storage
+import tracing
+from settings import get_settings
+
+PREFIX = "/api/v1"
+
+# Максимум элементов в одном пакетном запросе
+MAX_BATCH = 100
+
+# Максимальный размер страницы списков
+MAX_PAGE = 500
+
+# Максимум профилируемых вызовов на один запрос /debug/profile
+MAX_PROFILE_COUNT = 100
+
+
+class _TracedRoute(APIRoute):
+    """
+    Маршрут API — корневой спан трассы api.<имя> (при TRACE_ENABLED);
+    тело потокового ответа — дочерний спан api.stream_body. Вызов можно
+    профилировать через POST /debug/profile.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        name = "api." + self.name
+
+        async def traced_handler(request: Request):
+            with tracing.profiled(name) as profile, tracing.span(
+                name, root=True, method=request.method
+            ) as span:
+                profile.resume()
+                try:
+                    response = await handler(request)
+                finally:
+                    profile.pause()
+                span.set(status=response.status_code)
+                if isinstance(response, StreamingResponse) and (
+                    tracing.current() is not None
+                ):
+                    response.body_iterator = _traced_body(
+                        response.body_iterator, span
+                    )
+            return response
+
+        return traced_handler
+
+
+async def _traced_body(body, parent: tracing.Span):
+    with tracing.span("api.stream_body", parent=parent):
+        async for chunk in body:
+            yield chunk
+
+
+router = APIRouter(
+    default_response_class=ORJSONResponse, route_class=_TracedRoute
+)
+
+
+async def _body(request: Request) -> Any:
+    try:
+        return orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(400, f"Invalid JSON: {e}") from None
+
+
+def _object(value: Any, what: str = "request body") -> Dict:
+    if not isinstance(value, dict):
+        raise HTTPException(422, f"{what} must be a JSON object")
+    return value
+
+
+def _items(body: Any, key: str = "items") -> List:
+    items = _object(body).get(key)
+    if not isinstance(items, list):
+        raise HTTPException(422, f"'{key}' must be a list")
+    if len(items) > MAX_BATCH:
+        raise HTTPException(
+            413, f"Too many items: {len(items)} > {MAX_BATCH}"
+        )
+    return items
+
+
+def _expand_args(item: Any) -> Dict:
+    """
+    Проверить параметры expand: idea, slider, use_cache, force_fresh и
+    user (чей дневной бюджет токенов расходуется).
+    """
+    item = _object(item, "expand request")
+    idea = item.get("idea")
+    if not isinstance(idea, str) or not idea.strip():
+        raise HTTPException(422, "'idea' must be a non-empty string")
+    slider = item.get("slider", 5)
+    if isinstance(slider, bool) or not isinstance(slider, int):
+        raise HTTPException(422, "'slider' must be an integer 0..10")
+    if not 0 <= slider <= 10:
+        raise HTTPException(422, "'slider' must be an integer 0..10")
+    use_cache = item.get("use_cache")
+    if use_cache is not None and not isinstance(use_cache, bool):
+        raise HTTPException(422, "'use_cache' must be true, false or null")
+    user = item.get("user")
+    if user is not None and not isinstance(user, str):
+        raise HTTPException(422, "'user' must be a string")
+    return {
+        "idea": idea,
+        "slider": slider,
+        "use_cache": use_cache,
+        "force_fresh": bool(item.get("force_fresh", False)),
+        "user": user,
+    }
+
+
+def _variants(variants: List[Dict], raw: bool) -> List[Dict]:
+    # Исходный ответ LLM большой и обычно не нужен клиенту
+    if raw:
+        return variants
+    return [
+        {k: v for k, v in variant.items() if k != "llm_raw_response"}
+        for variant in variants
+    ]
+
+
+def _record(body: Any) -> Dict:
+    record = _object(body, "prompt record")
+    prompt = record.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise HTTPException(422, "'prompt' must be a non-empty string")
+    return record
+
+
+# --- Генерация ---
+
+
+@router.post("/expand")
+async def expand(request: Request, raw: bool = False):
+    """Варианты промпта для одной идеи."""
+    args = _expand_args(await _body(request))
+    try:
+        variants = await llm_adapter.expand_prompt_async(**args)
+    except llm_adapter.TokenBudgetExceeded as e:
+        raise HTTPException(429, str(e)) from None
+    if not variants:
+        raise HTTPException(502, "Empty LLM response")
+    return {"variants": _variants(variants, raw)}
+
+
+@router.post("/expand/batch")
+async def expand_batch(request: Request, raw: bool = False):
+    """
+    Несколько идей за один запрос ({"items": [...]}); запросы к LLM идут
+    параллельно через общий лимитер адаптера. Результаты — в порядке
+    items, ошибка одного элемента не прерывает остальные.
+    """
+    items = _items(await _body(request))
+    results: List[Optional[Dict]] = [None] * len(items)
+    calls = []
+    for i, item in enumerate(items):
+        try:
+            calls.append((i, _expand_args(item)))
+        except HTTPException as e:
+            results[i] = {"error": e.detail}
+    outcomes = await asyncio.gather(
+        *(llm_adapter.expand_prompt_async(**args) for _, args in calls),
+        return_exceptions=True,
+    )
+    for (i, _), outcome in zip(calls, outcomes):
+        if isinstance(outcome, BaseException):
+            results[i] = {"error": str(outcome)}
+        elif not outcome:
+            results[i] = {"error": "Empty LLM response"}
+        else:
+            results[i] = {"variants": _variants(outcome, raw)}
+    return {"results": results}
+
+
+@router.post("/expand/stream")
+async def expand_stream(request: Request):
+    """
+    Потоковое расширение идеи: NDJSON, по строке {"text": ...} на каждый
+    накопленный фрагмент, последней — {"done": true, "text": ...} или
+    {"error": ...}.
+    """
+    args = _expand_args(await _body(request))
+
+    async def lines():
+        text = ""
+        try:
+            async for text in llm_adapter.expand_prompt_stream_async(
+                **args
+            ):
+                yield orjson.dumps({"text": text}) + b"\n"
+        except Exception as e:
+            yield orjson.dumps({"error": str(e)}) + b"\n"
+            return
+        if not text.strip():
+            yield orjson.dumps({"error": "Empty LLM response"}) + b"\n"
+            return
+        yield orjson.dumps({"done": True, "text": text.strip()}) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# --- Фоновые задания ---
+
+
+@router.post("/jobs", status_code=202)
+async def create_job(request: Request):
+    """
+    Поставить расширение идеи в очередь заданий (jobs.py); возвращает
+    id задания. Необязательные поля: priority (по умолчанию пакетный),
+    session — задания одной сессии чередуются с чужими.
+    """
+    body = _object(await _body(request))
+    args = _expand_args(body)
+    priority = body.get("priority", jobs.PRIORITY_BATCH)
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise HTTPException(422, "'priority' must be an integer")
+    session = body.get("session", "")
+    if not isinstance(session, str):
+        raise HTTPException(422, "'session' must be a string")
+    params = {k: args[k] for k in ("idea", "slider", "use_cache")}
+    # Бюджет токенов — пользователя, а если он не указан — сессии
+    params["user"] = args["user"] or session or None
+    queue = await asyncio.to_thread(jobs.get_queue)
+    try:
+        job_id = await asyncio.to_thread(
+            queue.submit, "expand", params, session, priority
+        )
+    except jobs.JobQueueFull as e:
+        raise HTTPException(429, str(e)) from None
+    return {"id": job_id}
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Состояние задания: status, position, partial, result, error."""
+    queue = await asyncio.to_thread(jobs.get_queue)
+    job = await asyncio.to_thread(queue.get, job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return job
+
+
+@router.get("/jobs/{job_id}/stream")
+async def watch_job(job_id: str):
+    """Состояния задания по мере изменения (NDJSON), до завершения."""
+    queue = await asyncio.to_thread(jobs.get_queue)
+    if await asyncio.to_thread(queue.get, job_id) is None:
+        raise HTTPException(404, "Job not found")
+
+    async def lines():
+        async for job in queue.watch(job_id):
+            yield orjson.dumps(job) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Отменить задание в очереди или выполняющееся."""
+    queue = await asyncio.to_thread(jobs.get_queue)
+    if not await asyncio.to_thread(queue.cancel, job_id):
+        raise HTTPException(409, "Job not found or already finished")
+    return {"cancelled": job_id}
+
+
+# --- Библиотека промптов ---
+
+
+@router.get("/prompts")
+async def list_prompts(
+    limit: int = Query(50, ge=1, le=MAX_PAGE),
+    cursor: Optional[str] = None,
+    tags: Optional[List[str]] = Query(None),
+    match: str = Query("any", pattern="^(any|all)$"),
+):
+    """Страница списка (id, name, created_at), новые сверху."""
+    try:
+        rows, next_cursor = await asyncio.to_thread(
+            storage.list_prompt_summaries, limit, cursor, tags, match
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e)) from None
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+@router.get("/prompts/{record_id}")
+async def get_prompt(record_id: str):
+    record = await asyncio.to_thread(storage.get_prompt, record_id)
+    if record is None:
+        raise HTTPException(404, "Prompt not found")
+    return record
+
+
+@router.post("/prompts", status_code=201)
+async def create_prompt(request: Request):
+    """Сохранить запись; возвращает её id."""
+    record = _record(await _body(request))
+    record_id = await asyncio.to_thread(storage.save_prompt, record)
+    return {"id": record_id}
+
+
+@router.put("/prompts/{record_id}")
+async def replace_prompt(record_id: str, request: Request):
+    """Создать или заменить запись с заданным id."""
+    record = dict(_record(await _body(request)), id=record_id)
+    await asyncio.to_thread(storage.save_prompt, record)
+    return {"id": record_id}
+
+
+@router.post("/prompts/batch", status_code=201)
+async def create_prompts(request: Request):
+    """Сохранить записи ({"items": [...]}) одной транзакцией."""
+    records = [_record(item) for item in _items(await _body(request))]
+    ids = await asyncio.to_thread(storage.save_prompts, records)
+    return {"ids": ids}
+
+
+@router.delete("/prompts/{record_id}")
+async def delete_prompt(record_id: str):
+    if not await asyncio.to_thread(storage.delete_prompt, record_id):
+        raise HTTPException(404, "Prompt not found")
+    return {"deleted": record_id}
+
+
+@router.post("/prompts/delete")
+async def delete_prompts(request: Request):
+    """Удалить записи ({"ids": [...]}); возвращает удалённые id."""
+    ids = _items(await _body(request), key="ids")
+    if not all(isinstance(i, str) for i in ids):
+        raise HTTPException(422, "'ids' must be a list of strings")
+    deleted = await asyncio.to_thread(storage.delete_prompts, ids)
+    return {"deleted": deleted}
+
+
+@router.get("/search")
+async def search(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=MAX_PAGE),
+    cursor: Optional[str] = None,
+):
+    """Полнотекстовый поиск (FTS5, BM25)."""
+    try:
+        rows, next_cursor = await asyncio.to_thread(
+            storage.search_prompts, q, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e)) from None
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+@router.get("/tags")
+async def tags(limit: int = Query(100, ge=1, le=MAX_PAGE)):
+    """Самые частые теги: [[tag, count], ...]."""
+    return {"items": await asyncio.to_thread(storage.tag_counts, limit)}
+
+
+# --- Отладка ---
+
+
+@router.post("/debug/profile")
+async def arm_profile(request: Request):
+    """
+    Профилировать следующие вызовы обработчиков ({"pattern": "ui.*",
+    "count": 1, "mode": "cprofile" | "sample"}); результат пишется в
+    PROFILE_DIR.
+    """
+    body = _object(await _body(request))
+    pattern = body.get("pattern", "*")
+    count = body.get("count", 1)
+    mode = body.get("mode", "cprofile")
+    if not isinstance(pattern, str):
+        raise HTTPException(422, "'pattern' must be a string")
+    if isinstance(count, bool) or not isinstance(count, int):
+        raise HTTPException(422, "'count' must be an integer")
+    if not 1 <= count <= MAX_PROFILE_COUNT:
+        raise HTTPException(422, f"'count' must be 1..{MAX_PROFILE_COUNT}")
+    try:
+        armed = tracing.arm_profile(pattern, count, mode)
+    except ValueError as e:
+        raise HTTPException(422, str(e)) from None
+    return {"armed": armed}
+
+
+@router.get("/debug/profile")
+async def armed_profiles():
+    """Ещё не сработавшие запросы профилирования."""
+    return {"items": tracing.armed_profiles()}
+
+
+def mount(app: FastAPI, prefix: str = PREFIX) -> None:
+    """Подключить API к существующему FastAPI-приложению."""
+    app.include_router(router, prefix=prefix)
+
+
+def create_api() -> FastAPI:
+    """Отдельное приложение: API и метрики, без интерфейса."""
+    app = FastAPI(
+        title="Flux Prompt Lab API", default_response_class=ORJSONResponse
+    )
+    mount(app)
+    metrics.mount(app)
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    settings = get_settings()
+    parser = argparse.ArgumentParser(prog="api.py")
+    parser.add_argument("--host", default=settings.server_name)
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    # Задания, прерванные прошлым запуском, продолжаются сразу
+    jobs.get_queue()
+    uvicorn.run(create_api(), host=args.host, port=args.port)
@@ -1,107 +1,370 @@
+import time
+import asyncio
 import gradio as gr
-from typing import Dict, Tuple, List
-import llm_adapter
+from typing import Dict, Tuple, List, Optional
+import jobs
+import landscape_pool
+import metrics
 import storage
+import tracing
 
+from saved_index import SavedIndex, display_name
+from settings import get_settings
 from utils import TEXTS
 
 
-def _build_saved_choices() -> Tuple[List[str], Dict[str, str]]:
+# Размер страницы списка сохранённых записей
+SAVED_PAGE_SIZE = 200
+
+# Сколько самых частых тегов показывать в фильтре
+TAG_FILTER_SIZE = 200
+
+# Сколько похожих записей показывать по кнопке «Похожие»
+SIMILAR_COUNT = 20
+
+# Общий для всех сессий индекс последних записей; save_prompt и
+# delete_prompt обновляют его через write-through хук
+saved_index = SavedIndex(page_size=SAVED_PAGE_SIZE)
+storage.add_write_hook(saved_index.on_write)
+
+
+def _next_page(
+    query: str, cursor: Optional[str], tags: Optional[List[str]], match: str
+) -> Optional[Dict]:
+    if not cursor:
+        return None
+    return {
+        "query": query,
+        "cursor": cursor,
+        "tags": tags or [],
+        "match": match,
+    }
+
+
+def _build_saved_choices(
+    query: str = "",
+    cursor: Optional[str] = None,
+    tags: Optional[List[str]] = None,
+    match: str = "any",
+) -> Tuple[List[str], Dict[str, str], Optional[Dict]]:
     """
     Возвращает:
       - список display-строк для Dropdown (["Name (id1234)", ...])
       - map display -> id
+      - состояние следующей страницы {"query", "cursor", "tags", "match"}
+        (None, если записей больше нет)
+    Непустой query — результаты полнотекстового поиска, иначе последние
+    сохранённые записи, отфильтрованные по тегам tags (match="any" —
+    любой из тегов, "all" — все). Первая страница без фильтров берётся
+    из saved_index, без запроса к БД.
     """
     try:
-        rows = storage.list_prompts(limit=200)
+        query = (query or "").strip()
+        if not query and not cursor and not tags:
+            choices, mapping, next_cursor, _ = saved_index.page()
+            return choices, mapping, _next_page("", next_cursor, [], "any")
+        if query:
+            rows, next_cursor = storage.search_prompts(
+                query, limit=SAVED_PAGE_SIZE, cursor=cursor
+            )
+        else:
+            rows, next_cursor = storage.list_prompt_summaries(
+                limit=SAVED_PAGE_SIZE, cursor=cursor, tags=tags, match=match
+            )
         choices = []
         mapping = {}
         for r in rows:
-            record_id = r.get("id")
-            if not record_id:
+            if not r.get("id"):
                 continue
-            display = f"{r.get('name') or 'untitled'} ({record_id[:8]})"
+            display = display_name(r)
             choices.append(display)
-            mapping[display] = record_id
-        return choices, mapping
+            mapping[display] = r["id"]
+        return choices, mapping, _next_page(query, next_cursor, tags, match)
     except Exception as e:
         print(f"Error in _build_saved_choices: {e}")
-        return [], {}
+        return [], {}, None
 
 
-def generate_handler(idea: str, slider: int):
-    """Обработчик нажатия кнопки «Сгенерировать»."""
-    try:
-        variants = llm_adapter.expand_prompt(idea or "", slider) or []
-        if not variants:
-            return (
-                "",
-                "Empty LLM response",
-                gr.update(interactive=True),  # generate_btn
-                gr.update(interactive=True),  # creative_btn
-                gr.update(interactive=True),  # idea_input
-                gr.update(interactive=True),  # slider
-            )
-        first = variants[0]
-        prompt_text = (
-            first.get("prompt") if isinstance(first, dict) else str(first)
-        )
-        prompt_text = (prompt_text or "").strip()
-        return (
-            prompt_text,
-            "Done",
-            gr.update(interactive=True),  # generate_btn
-            gr.update(interactive=True),  # creative_btn
-            gr.update(interactive=True),  # idea_input
-            gr.update(interactive=True),  # slider
+def _tag_filter_choices() -> List[Tuple[str, str]]:
+    """Варианты фильтра по тегам: ("tag (count)", tag), частые сверху."""
+    return [
+        (f"{tag} ({count})", tag)
+        for tag, count in saved_index.tag_counts(limit=TAG_FILTER_SIZE)
+    ]
+
+
+def _saved_updates(
+    filter_tags: Optional[List[str]] = None,
+    match_all: bool = False,
+    seen_version: Optional[int] = None,
+    **dropdown,
+):
+    """
+    Обновления (dropdown, mapping, next_page, version, tag_filter) для
+    первой страницы списка с учётом фильтра по тегам. version — версия
+    saved_index, которую показывает сессия (None — отфильтрованный или
+    найденный список). Если версия не изменилась, компоненты не
+    обновляются (gr.skip()).
+    """
+    if filter_tags:
+        choices, mapping, next_page = _build_saved_choices(
+            tags=filter_tags, match="all" if match_all else "any"
         )
-    except Exception as e:
         return (
-            "",
-            f"Error: {e}",
-            gr.update(interactive=True),  # generate_btn
-            gr.update(interactive=True),  # creative_btn
-            gr.update(interactive=True),  # idea_input
-            gr.update(interactive=True),  # slider
+            gr.update(choices=choices, **dropdown),
+            mapping,
+            next_page,
+            None,
+            gr.update(choices=_tag_filter_choices()),
         )
+    choices, mapping, cursor, version = saved_index.page()
+    if version == seen_version:
+        return gr.skip(), gr.skip(), gr.skip(), version, gr.skip()
+    return (
+        gr.update(choices=choices, **dropdown),
+        mapping,
+        _next_page("", cursor, [], "any"),
+        version,
+        gr.update(choices=_tag_filter_choices()),
+    )
 
 
-def generate_random_handler(slider: int):
-    """Вызов expand_prompt для получения случайного пейзажа."""
-    idea = "A detailed and imaginative landscape of your choice."
-    return generate_handler(idea, slider)
+# Минимальный интервал между обновлениями редактора при стриминге (сек.)
+STREAM_UPDATE_INTERVAL = 0.05
 
 
+def _controls(interactive: bool) -> Tuple:
+    """Обновления generate_btn, creative_btn, idea_input и slider."""
+    return tuple(gr.update(interactive=interactive) for _ in range(4))
+
+
+@tracing.traced("ui.generate_job", root=True)
+async def generate_job_handler(
+    idea: str,
+    slider: int,
+    session: str = "",
+    priority: int = jobs.PRIORITY_INTERACTIVE,
+):
+    """
+    Генерация через очередь заданий (jobs.py): ставит задание и отдаёт
+    его состояние — позицию в очереди, промежуточный текст, результат.
+    Пока задание ждёт очереди или ответа LLM, воркер Gradio свободен.
+    Если клиент ушёл до завершения, задание отменяется.
+    """
+    if not idea or not idea.strip():
+        yield ("", "Empty LLM response", *_controls(True))
+        return
+    queue = await asyncio.to_thread(jobs.get_queue)
+    try:
+        job_id = await asyncio.to_thread(
+            queue.submit,
+            "expand",
+            {"idea": idea, "slider": slider, "user": session},
+            session,
+            priority,
+        )
+    except jobs.JobQueueFull as e:
+        yield ("", f"Error: {e}", *_controls(True))
+        return
+    finished = False
+    try:
+        last_update = 0.0
+        async for job in queue.watch(job_id):
+            status = job["status"]
+            if status == "queued":
+                yield (
+                    "",
+                    f"Queued ({job['position'] + 1})",
+                    *_controls(False),
+                )
+            elif status == "running":
+                now = time.monotonic()
+                if now - last_update >= STREAM_UPDATE_INTERVAL:
+                    last_update = now
+                    yield (job["partial"], "Generating", *_controls(False))
+            else:
+                finished = True
+                if status == "done":
+                    text, message = job["result"]["prompt"], "Done"
+                elif status == "cancelled":
+                    text, message = job["partial"], "Cancelled"
+                else:
+                    text, message = job["partial"], f"Error: {job['error']}"
+                yield (text, message, *_controls(True))
+    finally:
+        if not finished:
+            queue.cancel(job_id)
+
+
+@tracing.traced("ui.cancel_jobs", root=True)
+def cancel_jobs_handler(request: gr.Request):
+    """Отменить задания генерации текущей сессии (кнопка «Отменить»)."""
+    session = getattr(request, "session_hash", None)
+    if session:
+        jobs.get_queue().cancel_session(session)
+
+
+def _pop_landscape(slider: int) -> Optional[str]:
+    """Готовый случайный пейзаж из пула (None — пул пуст или выключен)."""
+    if not landscape_pool.enabled():
+        return None
+    try:
+        item = landscape_pool.get_pool().pop(slider)
+    except Exception as e:
+        print(f"Warning: landscape pool unavailable: {e}")
+        return None
+    return (item or {}).get("prompt") or None
+
+
+@tracing.traced("ui.save_prompt", root=True)
 def save_prompt_handler(
-    prompt_text: str, name: str
-) -> Tuple[str, gr.update, Dict[str, str]]:
-    """Сохраняет промпт через storage.save_prompt."""
+    prompt_text: str,
+    name: str,
+    tags: str = "",
+    filter_tags: Optional[List[str]] = None,
+    match_all: bool = False,
+    seen_version: Optional[int] = None,
+):
+    """
+    Сохраняет промпт через storage.save_prompt (tags — через запятую).
+    Возвращает (status, dropdown, mapping, next_page, version,
+    tag_filter); список берётся из saved_index с учётом фильтра.
+    """
     if not prompt_text or not prompt_text.strip():
-        choices, mapping = _build_saved_choices()
-        return "Нечего сохранять", gr.update(choices=choices), mapping
-    record = {
-        "name": name or "untitled",
-        "prompt": prompt_text,
-    }
+        status = "Нечего сохранять"
+    else:
+        record = {
+            "name": name or "untitled",
+            "prompt": prompt_text,
+            "tags": tags or "",
+        }
+        try:
+            import similarity  # numpy — при первом сохранении
+
+            duplicate = similarity.get_index().find_duplicate(prompt_text)
+        except Exception as e:
+            print(f"Warning: duplicate check failed: {e}")
+            duplicate = None
+        try:
+            rid = storage.save_prompt(record)
+            status = f"Сохранено: {rid}"
+            if duplicate:
+                status += (
+                    f" (похоже на «{duplicate['name']}», "
+                    f"{duplicate['similarity']:.0%})"
+                )
+        except Exception as e:
+            status = f"Ошибка сохранения: {e}"
+    return (status,) + _saved_updates(filter_tags, match_all, seen_version)
+
+
+@tracing.traced("ui.refresh_saved", root=True)
+def refresh_saved_handler(
+    filter_tags: Optional[List[str]] = None,
+    match_all: bool = False,
+    seen_version: Optional[int] = None,
+):
+    """
+    Обновить список сохранённых записей: индекс перечитывается из БД
+    (изменения других процессов), Dropdown — только если список
+    изменился. Возвращает (dropdown, mapping, next_page, version,
+    tag_filter).
+    """
     try:
-        rid = storage.save_prompt(record)
+        saved_index.reload()
+        return _saved_updates(filter_tags, match_all, seen_version)
     except Exception as e:
-        choices, mapping = _build_saved_choices()
-        return f"Ошибка сохранения: {e}", gr.update(choices=choices), mapping
-    choices, mapping = _build_saved_choices()
-    return f"Сохранено: {rid}", gr.update(choices=choices), mapping
+        print(f"Error in refresh_saved_handler: {e}")
+        return gr.update(choices=[]), {}, None, None, gr.update()
+
+
+@tracing.traced("ui.initial_saved", root=True)
+def initial_saved_handler():
+    """Первая страница списка при открытии страницы (из saved_index)."""
+    return _saved_updates()
+
+
+@tracing.traced("ui.filter_saved", root=True)
+def filter_saved_handler(
+    filter_tags: Optional[List[str]], match_all: bool
+):
+    """Отфильтровать список сохранённых записей по тегам."""
+    updates = _saved_updates(filter_tags, match_all)
+    choices = updates[0].get("choices") or []
+    value = choices[0] if choices else None
+    return (gr.update(choices=choices, value=value),) + updates[1:4]
+
+
+@tracing.traced("ui.load_more_saved", root=True)
+def load_more_saved_handler(
+    mapping: Dict[str, str], next_page: Optional[Dict]
+) -> Tuple[gr.update, Dict[str, str], Optional[Dict]]:
+    """Догрузить следующую страницу сохранённых записей в список."""
+    if not next_page:
+        return gr.update(), mapping, None
+    choices, more, next_page = _build_saved_choices(
+        next_page.get("query", ""),
+        next_page.get("cursor"),
+        next_page.get("tags"),
+        next_page.get("match", "any"),
+    )
+    mapping = {**(mapping or {}), **more}
+    return gr.update(choices=list(mapping)), mapping, next_page
+
+
+@tracing.traced("ui.search_saved", root=True)
+def search_saved_handler(
+    query: str,
+) -> Tuple[gr.update, Dict[str, str], Optional[Dict], Optional[int], str]:
+    """Полнотекстовый поиск по сохранённым записям (пустой — весь список)."""
+    choices, mapping, next_page = _build_saved_choices(query)
+    status = f"Найдено: {len(choices)}{'+' if next_page else ''}"
+    version = None
+    if not (query or "").strip():
+        status = ""
+        version = saved_index.version
+    value = choices[0] if choices else None
+    return (
+        gr.update(choices=choices, value=value),
+        mapping,
+        next_page,
+        version,
+        status,
+    )
 
 
-def refresh_saved_handler() -> Tuple[gr.update, Dict[str, str]]:
-    """Обновить список сохранённых записей."""
+@tracing.traced("ui.similar_saved", root=True)
+def similar_saved_handler(
+    selected_display: str, mapping: Dict[str, str]
+) -> Tuple[gr.update, Dict[str, str], Optional[Dict], Optional[int], str]:
+    """Показать в списке записи, похожие на выбранную (MinHash)."""
+    rid = (mapping or {}).get(selected_display or "")
+    if not rid:
+        return gr.skip(), gr.skip(), gr.skip(), gr.skip(), "Ничего не выбрано"
     try:
-        choices, mapping = _build_saved_choices()
-        return gr.update(choices=choices), mapping
+        import similarity
+
+        found = similarity.get_index().similar_to(rid, k=SIMILAR_COUNT)
     except Exception as e:
-        print(f"Error in refresh_saved_handler: {e}")
-        return gr.update(choices=[]), {}
+        print(f"Error in similar_saved_handler: {e}")
+        found = []
+    choices = []
+    mapping = {}
+    for r in found:
+        display = f"{display_name(r)} — {r['similarity']:.0%}"
+        choices.append(display)
+        mapping[display] = r["id"]
+    value = choices[0] if choices else None
+    return (
+        gr.update(choices=choices, value=value),
+        mapping,
+        None,
+        None,
+        f"Похожих: {len(choices)}",
+    )
 
 
+@tracing.traced("ui.load_saved", root=True)
 def load_saved_handler(
     selected_display: str, mapping: Dict[str, str]
 ) -> Tuple[str, str]:
@@ -111,42 +374,36 @@ def load_saved_handler(
     rid = mapping.get(selected_display)
     if not rid:
         return "", "Выбранный элемент не найден"
-    rec = storage.get_prompt(rid)
+    rec = storage.get_prompt(rid, include_raw=False)
     if not rec:
         return "", "Запись не найдена"
     return rec.get("prompt", ""), f"Загружено: {rec.get('name')}"
 
 
+@tracing.traced("ui.delete_saved", root=True)
 def delete_saved_handler(
-    selected_display: str, mapping: Dict[str, str]
-) -> Tuple[str, gr.update, Dict[str, str], str]:
+    selected_display: str,
+    mapping: Dict[str, str],
+    filter_tags: Optional[List[str]] = None,
+    match_all: bool = False,
+    seen_version: Optional[int] = None,
+):
     """
-    Удалить выбранную запись. Возвращаем (status, new_choices, new_mapping,
-    cleared_editor). cleared_editor — пустая строка, чтобы очистить редактор,
-    если нужно.
+    Удалить выбранную запись. Возвращаем (status, cleared_editor,
+    new_choices, new_mapping, next_page, version, tag_filter).
+    cleared_editor — пустая строка, чтобы очистить редактор, если нужно.
     """
     if not selected_display:
-        choices, mapping = _build_saved_choices()
-        return "Ничего не выбрано", gr.update(choices=choices), mapping, ""
-    rid = mapping.get(selected_display)
-    if not rid:
-        choices, mapping = _build_saved_choices()
-        return "Не удалось найти id", gr.update(choices=choices), mapping, ""
-    try:
-        ok = storage.delete_prompt(rid)
-        if not ok:
-            choices, mapping = _build_saved_choices()
-            return (
-                "Удаление не удалось",
-                gr.update(choices=choices),
-                mapping,
-                "",
-            )
-        choices, mapping = _build_saved_choices()
-        return "Удалено", gr.update(choices=choices), mapping, ""
-    except Exception as e:
-        choices, mapping = _build_saved_choices()
-        return f"Ошибка удаления: {e}", gr.update(choices=choices), mapping, ""
+        status = "Ничего не выбрано"
+    elif not (mapping or {}).get(selected_display):
+        status = "Не удалось найти id"
+    else:
+        try:
+            ok = storage.delete_prompt(mapping[selected_display])
+            status = "Удалено" if ok else "Удаление не удалось"
+        except Exception as e:
+            status = f"Ошибка удаления: {e}"
+    return (status, "") + _saved_updates(filter_tags, match_all, seen_version)
 
 
 def switch_language_handler(current_lang: str):
@@ -160,13 +417,23 @@ def switch_language_handler(current_lang: str):
         gr.update(label=t["slider_label"]),
         gr.update(value=t["generate"]),
         gr.update(value=t["creative"]),
+        gr.update(value=t["cancel"]),
         gr.update(label=t["save_name"], placeholder=""),
+        gr.update(label=t["save_tags"], placeholder=t["save_tags_hint"]),
         gr.update(value=t["save_btn"]),
         gr.update(value="### " + t["saved_prompts_title"]),
         gr.update(label=t["saved_prompts"]),
         gr.update(value=t["load_btn"]),
         gr.update(value=t["refresh_btn"]),
         gr.update(value=t["delete_btn"]),
+        gr.update(value=t["more_btn"]),
+        gr.update(value=t["similar_btn"]),
+        gr.update(
+            label=t["search_label"], placeholder=t["search_placeholder"]
+        ),
+        gr.update(value=t["search_btn"]),
+        gr.update(label=t["tag_filter_label"]),
+        gr.update(label=t["tag_match_all"]),
         gr.update(value="### " + t["extended_prompt"]),
         gr.update(label=t["prompt_editor"]),
         gr.update(label=t["status"]),
@@ -176,175 +443,380 @@ def switch_language_handler(current_lang: str):
 
 
 # --- Gradio UI ---
-with gr.Blocks() as demo:
-    lang_state = gr.State("ru")
-    # Initialize saved_map_state with initial mapping
-    initial_choices, initial_mapping = _build_saved_choices()
-    saved_map_state = gr.State(initial_mapping)
-
-    txt = TEXTS["ru"]
-
-    heading_md = gr.Markdown(txt["title"])
-
-    with gr.Row():
-        with gr.Column(scale=2):
-            idea_input = gr.Textbox(
-                label=txt["idea_label"],
-                placeholder=txt["idea_placeholder"],
-                lines=2,
-            )
-            slider = gr.Slider(
-                minimum=0,
-                maximum=10,
-                step=1,
-                label=txt["slider_label"],
-                value=5,
-            )
-            with gr.Row():
-                generate_btn = gr.Button(txt["generate"])
-                creative_btn = gr.Button(txt["creative"])
-            save_name = gr.Textbox(
-                label=txt["save_name"], placeholder="", lines=1
-            )
-            save_btn = gr.Button(txt["save_btn"])
+def build_demo() -> gr.Blocks:
+    """
+    Собрать интерфейс. Вызывается при запуске сервера, а не при импорте
+    app: обработчики можно импортировать без построения Blocks.
+    """
+    with gr.Blocks() as demo:
+        lang_state = gr.State("ru")
+        # Список сохранённых записей заполняется при открытии страницы
+        # (demo.load) из общего saved_index
+        saved_map_state = gr.State({})
+        saved_page_state = gr.State(None)
+        # Версия saved_index, которую показывает Dropdown этой сессии
+        saved_version_state = gr.State(None)
+
+        txt = TEXTS["ru"]
+
+        heading_md = gr.Markdown(txt["title"])
+
+        with gr.Row():
+            with gr.Column(scale=2):
+                idea_input = gr.Textbox(
+                    label=txt["idea_label"],
+                    placeholder=txt["idea_placeholder"],
+                    lines=2,
+                )
+                slider = gr.Slider(
+                    minimum=0,
+                    maximum=10,
+                    step=1,
+                    label=txt["slider_label"],
+                    value=5,
+                )
+                with gr.Row():
+                    generate_btn = gr.Button(txt["generate"])
+                    creative_btn = gr.Button(txt["creative"])
+                    cancel_btn = gr.Button(txt["cancel"])
+                save_name = gr.Textbox(
+                    label=txt["save_name"], placeholder="", lines=1
+                )
+                save_tags = gr.Textbox(
+                    label=txt["save_tags"],
+                    placeholder=txt["save_tags_hint"],
+                    lines=1,
+                )
+                save_btn = gr.Button(txt["save_btn"])
+
+                # блок сохранённых записей
+                saved_prompts_title_md = gr.Markdown(
+                    "### " + txt["saved_prompts_title"]
+                )
+                saved_dropdown = gr.Dropdown(
+                    label=txt["saved_prompts"],
+                    choices=[],
+                    interactive=True,
+                )
+                with gr.Row():
+                    load_btn = gr.Button(txt["load_btn"])
+                    refresh_btn = gr.Button(txt["refresh_btn"])
+                    delete_btn = gr.Button(txt["delete_btn"])
+                    more_btn = gr.Button(txt["more_btn"])
+                    similar_btn = gr.Button(txt["similar_btn"])
+                with gr.Row():
+                    search_input = gr.Textbox(
+                        label=txt["search_label"],
+                        placeholder=txt["search_placeholder"],
+                        lines=1,
+                        scale=3,
+                    )
+                    search_btn = gr.Button(txt["search_btn"], scale=1)
+                with gr.Row():
+                    tag_filter = gr.Dropdown(
+                        label=txt["tag_filter_label"],
+                        choices=[],
+                        multiselect=True,
+                        interactive=True,
+                        scale=3,
+                    )
+                    tag_match_all = gr.Checkbox(
+                        label=txt["tag_match_all"], value=False, scale=1
+                    )
+
+                # кнопка переключения языка
+                lang_btn = gr.Button(txt["switch_lang"])
+
+            with gr.Column(scale=3):
+                extended_prompt_md = gr.Markdown(
+                    "### " + txt["extended_prompt"]
+                )
+                prompt_editor = gr.Textbox(
+                    label=txt["prompt_editor"],
+                    lines=8,
+                    elem_id="prompt_editor",
+                )
+                copy_html = gr.HTML(txt["copy_button_html"])
+                status = gr.Textbox(label=txt["status"], interactive=False)
+
+        # --- Привязки ---
+        # Генерировать (основная кнопка). Генерация идёт фоновым заданием:
+        # обработчик только ждёт его, поэтому не ограничен
+        # concurrency_limit (число запросов к LLM ограничивают JOBS_*)
+        @tracing.traced("ui.generate_button", root=True)
+        async def generate_with_loading(
+            idea: str, slider: int, request: gr.Request
+        ):
+            """Обертка для генерации (с отключением элементов управления)."""
+            yield ("", "Generating", *_controls(False))
+            session = getattr(request, "session_hash", None) or ""
+            async for update in generate_job_handler(idea, slider, session):
+                yield update
+
+        generate_btn.click(
+            fn=generate_with_loading,
+            inputs=[idea_input, slider],
+            outputs=[
+                prompt_editor,
+                status,
+                generate_btn,
+                creative_btn,
+                idea_input,
+                slider,
+            ],
+            concurrency_limit=None,
+        )
 
-            # блок сохранённых записей
-            saved_prompts_title_md = gr.Markdown(
-                "### " + txt["saved_prompts_title"]
-            )
-            saved_dropdown = gr.Dropdown(
-                label=txt["saved_prompts"],
-                choices=initial_choices,
-                interactive=True,
+        # Кнопка "Креатив"
+        @tracing.traced("ui.creative_button", root=True)
+        async def generate_random_with_loading(
+            slider: int, request: gr.Request
+        ):
+            """
+            Обертка для случайной генерации (с отключением элементов
+            управления).
+            """
+            # Готовый пейзаж из пула отдаём сразу, без запроса к LLM
+            prompt_text = await asyncio.to_thread(_pop_landscape, slider)
+            if prompt_text:
+                yield (prompt_text, "Done", *_controls(True))
+                return
+            idea = landscape_pool.LANDSCAPE_IDEA
+            yield ("", "Generating", *_controls(False))
+            # Выполняем генерацию
+            session = getattr(request, "session_hash", None) or ""
+            async for update in generate_job_handler(idea, slider, session):
+                yield update
+
+        creative_btn.click(
+            fn=generate_random_with_loading,
+            inputs=[slider],
+            outputs=[
+                prompt_editor,
+                status,
+                generate_btn,
+                creative_btn,
+                idea_input,
+                slider,
+            ],
+            concurrency_limit=None,
+        )
+
+        # Отменить генерацию (задание в очереди или выполняющееся)
+        cancel_btn.click(
+            fn=cancel_jobs_handler, inputs=[], outputs=[], queue=False
+        )
+
+        # Сохранение — возвращает статус и обновляет список сохранённых
+        save_btn.click(
+            fn=save_prompt_handler,
+            inputs=[
+                prompt_editor,
+                save_name,
+                save_tags,
+                tag_filter,
+                tag_match_all,
+                saved_version_state,
+            ],
+            outputs=[
+                status,
+                saved_dropdown,
+                saved_map_state,
+                saved_page_state,
+                saved_version_state,
+                tag_filter,
+            ],
+        )
+
+        # Обновить список
+        refresh_btn.click(
+            fn=refresh_saved_handler,
+            inputs=[tag_filter, tag_match_all, saved_version_state],
+            outputs=[
+                saved_dropdown,
+                saved_map_state,
+                saved_page_state,
+                saved_version_state,
+                tag_filter,
+            ],
+        )
+
+        # Фильтр по тегам (любой из выбранных или все сразу)
+        for filter_event in (tag_filter.input, tag_match_all.input):
+            filter_event(
+                fn=filter_saved_handler,
+                inputs=[tag_filter, tag_match_all],
+                outputs=[
+                    saved_dropdown,
+                    saved_map_state,
+                    saved_page_state,
+                    saved_version_state,
+                ],
             )
-            with gr.Row():
-                load_btn = gr.Button(txt["load_btn"])
-                refresh_btn = gr.Button(txt["refresh_btn"])
-                delete_btn = gr.Button(txt["delete_btn"])
-
-            # кнопка переключения языка
-            lang_btn = gr.Button(txt["switch_lang"])
-
-        with gr.Column(scale=3):
-            extended_prompt_md = gr.Markdown("### " + txt["extended_prompt"])
-            prompt_editor = gr.Textbox(
-                label=txt["prompt_editor"], lines=8, elem_id="prompt_editor"
+
+        # Следующая страница списка
+        more_btn.click(
+            fn=load_more_saved_handler,
+            inputs=[saved_map_state, saved_page_state],
+            outputs=[saved_dropdown, saved_map_state, saved_page_state],
+        )
+
+        # Полнотекстовый поиск (кнопка или Enter в поле поиска)
+        for search_event in (search_btn.click, search_input.submit):
+            search_event(
+                fn=search_saved_handler,
+                inputs=[search_input],
+                outputs=[
+                    saved_dropdown,
+                    saved_map_state,
+                    saved_page_state,
+                    saved_version_state,
+                    status,
+                ],
             )
-            copy_html = gr.HTML(txt["copy_button_html"])
-            status = gr.Textbox(label=txt["status"], interactive=False)
-
-    # --- Привязки ---
-    # Генерировать (основная кнопка)
-    def generate_with_loading(idea: str, slider: int):
-        """Обертка для генерации (с отключением элементов управления)."""
-        yield (
-            "",
-            "Generating",
-            gr.update(interactive=False),  # generate_btn
-            gr.update(interactive=False),  # creative_btn
-            gr.update(interactive=False),  # idea_input
-            gr.update(interactive=False),  # slider
+
+        # Похожие на выбранную запись
+        similar_btn.click(
+            fn=similar_saved_handler,
+            inputs=[saved_dropdown, saved_map_state],
+            outputs=[
+                saved_dropdown,
+                saved_map_state,
+                saved_page_state,
+                saved_version_state,
+                status,
+            ],
         )
-        result = generate_handler(idea, slider)
-        yield result
-
-    generate_btn.click(
-        fn=generate_with_loading,
-        inputs=[idea_input, slider],
-        outputs=[
-            prompt_editor,
-            status,
-            generate_btn,
-            creative_btn,
-            idea_input,
-            slider,
-        ],
-    )
 
-    # Кнопка "Креатив"
-    def generate_random_with_loading(slider: int):
-        """
-        Обертка для случайной генерации (с отключением элементов управления).
-        """
-        idea = "A detailed and imaginative landscape of your choice."
-        yield (
-            "",
-            "Generating",
-            gr.update(interactive=False),  # generate_btn
-            gr.update(interactive=False),  # creative_btn
-            gr.update(interactive=False),  # idea_input
-            gr.update(interactive=False),  # slider
+        # Загрузить выбранную запись
+        load_btn.click(
+            fn=load_saved_handler,
+            inputs=[saved_dropdown, saved_map_state],
+            outputs=[prompt_editor, status],
         )
-        # Выполняем генерацию
-        result = generate_handler(idea, slider)
-        yield result
-
-    creative_btn.click(
-        fn=generate_random_with_loading,
-        inputs=[slider],
-        outputs=[
-            prompt_editor,
-            status,
-            generate_btn,
-            creative_btn,
-            idea_input,
-            slider,
-        ],
-    )
 
-    # Сохранение — возвращает статус и обновляет список сохранённых
-    save_btn.click(
-        fn=save_prompt_handler,
-        inputs=[prompt_editor, save_name],
-        outputs=[status, saved_dropdown, saved_map_state],
-    )
+        # Удалить выбранную запись
+        delete_btn.click(
+            fn=delete_saved_handler,
+            inputs=[
+                saved_dropdown,
+                saved_map_state,
+                tag_filter,
+                tag_match_all,
+                saved_version_state,
+            ],
+            outputs=[
+                status,
+                prompt_editor,
+                saved_dropdown,
+                saved_map_state,
+                saved_page_state,
+                saved_version_state,
+                tag_filter,
+            ],
+        )
 
-    # Обновить список
-    refresh_btn.click(
-        fn=refresh_saved_handler,
-        inputs=[],
-        outputs=[saved_dropdown, saved_map_state],
-    )
+        # Первая страница списка при открытии страницы
+        demo.load(
+            fn=initial_saved_handler,
+            inputs=[],
+            outputs=[
+                saved_dropdown,
+                saved_map_state,
+                saved_page_state,
+                saved_version_state,
+                tag_filter,
+            ],
+        )
 
-    # Загрузить выбранную запись
-    load_btn.click(
-        fn=load_saved_handler,
-        inputs=[saved_dropdown, saved_map_state],
-        outputs=[prompt_editor, status],
-    )
+        # Переключение языка (возвращаем обновления)
+        lang_btn.click(
+            fn=switch_language_handler,
+            inputs=[lang_state],
+            outputs=[
+                lang_state,
+                heading_md,
+                idea_input,
+                slider,
+                generate_btn,
+                creative_btn,
+                cancel_btn,
+                save_name,
+                save_tags,
+                save_btn,
+                saved_prompts_title_md,
+                saved_dropdown,
+                load_btn,
+                refresh_btn,
+                delete_btn,
+                more_btn,
+                similar_btn,
+                search_input,
+                search_btn,
+                tag_filter,
+                tag_match_all,
+                extended_prompt_md,
+                prompt_editor,
+                status,
+                copy_html,
+                lang_btn,
+            ],
+        )
 
-    # Удалить выбранную запись
-    delete_btn.click(
-        fn=delete_saved_handler,
-        inputs=[saved_dropdown, saved_map_state],
-        outputs=[status, saved_dropdown, saved_map_state, prompt_editor],
+    # Очередь событий: явные лимиты вместо значений Gradio по умолчанию
+    settings = get_settings()
+    demo.queue(
+        default_concurrency_limit=settings.gradio_concurrency_limit,
+        max_size=settings.gradio_max_queue,
     )
+    return demo
+
+
+_demo: Optional[gr.Blocks] = None
+
+
+def get_demo() -> gr.Blocks:
+    """Интерфейс приложения (собирается при первом обращении)."""
+    global _demo
+    if _demo is None:
+        _demo = build_demo()
+    return _demo
+
+
+def __getattr__(name):
+    # app.demo — для `gradio app.py` и кода, ожидающего переменную demo
+    if name == "demo":
+        return get_demo()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def create_server():
+    """
+    FastAPI-приложение: Gradio UI на /, рядом с ним JSON API (/api/v1,
+    см. api.py) и метрики — /metrics (Prometheus) и /api/metrics
+    (JSON-снимок).
+    """
+    from fastapi import FastAPI
+
+    import api
+
+    server = FastAPI()
+    api.mount(server)
+    metrics.mount(server)
+    return gr.mount_gradio_app(server, get_demo(), path="/")
 
-    # Переключение языка (возвращаем обновления)
-    lang_btn.click(
-        fn=switch_language_handler,
-        inputs=[lang_state],
-        outputs=[
-            lang_state,
-            heading_md,
-            idea_input,
-            slider,
-            generate_btn,
-            creative_btn,
-            save_name,
-            save_btn,
-            saved_prompts_title_md,
-            saved_dropdown,
-            load_btn,
-            refresh_btn,
-            delete_btn,
-            extended_prompt_md,
-            prompt_editor,
-            status,
-            copy_html,
-            lang_btn,
-        ],
-    )
 
 if __name__ == "__main__":
-    demo.launch()
+    import uvicorn
+
+    # Пул «Случайного пейзажа» начинает пополняться сразу при запуске
+    if landscape_pool.enabled():
+        landscape_pool.get_pool().ensure_refill()
+    # Задания, прерванные прошлым запуском, продолжаются сразу
+    jobs.get_queue()
+    settings = get_settings()
+    uvicorn.run(
+        create_server(),
+        host=settings.server_name,
+        port=settings.server_port,
+    )
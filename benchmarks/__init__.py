@@ -0,0 +1,5 @@
+"""
+Воспроизводимые бенчмарки без обращения к платному API: локальный
+OpenAI-совместимый сервер-заглушка, нагрузочные прогоны адаптера и
+обработчиков, микробенчмарки storage. Запуск: python -m benchmarks.
+"""
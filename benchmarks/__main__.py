@@ -0,0 +1,207 @@
+"""
+Запуск бенчмарков (из корня репозитория):
+
+    python -m benchmarks fake-server --port 8900 --latency 0.3
+    python -m benchmarks load --users 1,8,32 --modes expand,stream
+    python -m benchmarks storage --sizes 10000,100000,1000000
+    python -m benchmarks startup
+    python -m benchmarks all
+
+Результаты пишутся в benchmarks/results/<имя>-<время>.json (или в файл
+из --output) вместе с окружением и параметрами прогона.
+"""
+
+import sys
+import json
+import argparse
+from dataclasses import asdict
+from typing import List
+
+from benchmarks import fake_llm, results
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def _fake_config(args) -> fake_llm.FakeLLMConfig:
+    return fake_llm.FakeLLMConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens=args.tokens,
+        token_rate=args.token_rate,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+
+
+def _report(name: str, params, data, output: str) -> None:
+    path = results.write(name, params, data, output)
+    print(json.dumps(data, ensure_ascii=False, indent=2))
+    print(f"Results written to {path}")
+
+
+def cmd_fake_server(args) -> int:
+    fake_llm.serve(_fake_config(args), host=args.host, port=args.port)
+    return 0
+
+
+def _run_load(args, url: str):
+    from benchmarks import load
+
+    data = {}
+    for mode in args.modes.split(","):
+        for users in _ints(args.users):
+            load.configure_adapter(
+                url, max_in_flight=args.max_in_flight or users
+            )
+            print(f"load: {mode}, {users} users...")
+            data[f"{mode}/{users}"] = load.run(
+                mode,
+                users=users,
+                requests_per_user=args.requests,
+                warmup=args.warmup,
+            )
+    return data
+
+
+def _load_params(args):
+    return {
+        "modes": args.modes,
+        "users": _ints(args.users),
+        "requests_per_user": args.requests,
+        "max_in_flight": args.max_in_flight,
+        "url": args.url or None,
+        "fake": None if args.url else asdict(_fake_config(args)),
+    }
+
+
+def cmd_load(args) -> int:
+    if args.url:
+        data = _run_load(args, args.url)
+    else:
+        with fake_llm.running(_fake_config(args)) as fake:
+            data = _run_load(args, fake.url)
+    _report("load", _load_params(args), data, args.output)
+    return 0
+
+
+def cmd_storage(args) -> int:
+    from benchmarks import storage_bench
+
+    sizes = _ints(args.sizes)
+    data = storage_bench.run(sizes, args.iterations, args.seed)
+    params = {"sizes": sizes, "iterations": args.iterations}
+    _report("storage", params, data, args.output)
+    return 0
+
+
+def cmd_startup(args) -> int:
+    from benchmarks import startup
+
+    data = startup.check(repeat=args.repeat, scale=args.budget_scale)
+    params = {"repeat": args.repeat, "budget_scale": args.budget_scale}
+    _report("startup", params, data, args.output)
+    for module, item in data["modules"].items():
+        for problem in item["problems"]:
+            print(f"FAIL {module}: {problem}", file=sys.stderr)
+    return 0 if data["ok"] else 1
+
+
+def cmd_all(args) -> int:
+    cmd_load(args)
+    args.output = ""
+    cmd_storage(args)
+    return cmd_startup(args)
+
+
+def _add_fake_args(p) -> None:
+    p.add_argument("--latency", type=float, default=0.2, help="seconds")
+    p.add_argument("--jitter", type=float, default=0.05, help="seconds")
+    p.add_argument("--tokens", type=int, default=120)
+    p.add_argument(
+        "--token-rate", type=float, default=0.0, help="tokens/s, 0 = instant"
+    )
+    p.add_argument("--error-rate", type=float, default=0.0, help="0..1")
+    p.add_argument("--rate-limit-rate", type=float, default=0.0, help="0..1")
+    p.add_argument("--seed", type=int, default=0)
+
+
+def _add_load_args(p) -> None:
+    _add_fake_args(p)
+    p.add_argument(
+        "--url", default="", help="use this server instead of the fake one"
+    )
+    p.add_argument("--modes", default="expand,stream,job_handler")
+    p.add_argument(
+        "--users", default="1,8,32", help="comma-separated user counts"
+    )
+    p.add_argument("--requests", type=int, default=20, help="per user")
+    p.add_argument("--warmup", type=int, default=2)
+    p.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=0,
+        help="limiter slots (default: number of users)",
+    )
+
+
+def _add_storage_args(p) -> None:
+    p.add_argument("--sizes", default="10000,100000", help="row counts")
+    p.add_argument("--iterations", type=int, default=200)
+
+
+def _add_startup_args(p) -> None:
+    p.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    p.add_argument(
+        "--budget-scale",
+        type=float,
+        default=1.0,
+        help="multiply import-time budgets (slow machines)",
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("fake-server", help="run the fake LLM server")
+    _add_fake_args(p)
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8900)
+    p.set_defaults(func=cmd_fake_server)
+
+    p = sub.add_parser("load", help="concurrent users against the adapter")
+    _add_load_args(p)
+    p.add_argument("-o", "--output", default="", help="result JSON path")
+    p.set_defaults(func=cmd_load)
+
+    p = sub.add_parser("storage", help="storage micro-benchmarks")
+    _add_storage_args(p)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("-o", "--output", default="", help="result JSON path")
+    p.set_defaults(func=cmd_storage)
+
+    p = sub.add_parser(
+        "startup", help="import-time budgets (exit code 1 if exceeded)"
+    )
+    _add_startup_args(p)
+    p.add_argument("-o", "--output", default="", help="result JSON path")
+    p.set_defaults(func=cmd_startup)
+
+    p = sub.add_parser("all", help="load, storage and startup")
+    _add_load_args(p)
+    _add_storage_args(p)
+    _add_startup_args(p)
+    p.set_defaults(func=cmd_all, output="")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
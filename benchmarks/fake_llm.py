@@ -0,0 +1,216 @@
+"""
+Локальный OpenAI-совместимый сервер-заглушка для бенчмарков:
+POST /v1/chat/completions с настраиваемой задержкой, скоростью выдачи
+токенов, долей ошибок и 429, обычным и потоковым (SSE) ответом.
+
+    python -m benchmarks fake-server --port 8900 --latency 0.3
+"""
+
+import json
+import time
+import random
+import socket
+import asyncio
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Iterator, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+_WORDS = (
+    "misty mountain valley river dawn golden light pine forest reflection "
+    "dramatic clouds cinematic wide angle ultra detailed soft haze rocky "
+    "shore glacier aurora meadow wildflowers volumetric rays moody dusk"
+).split()
+
+
+@dataclass
+class FakeLLMConfig:
+    """Поведение сервера-заглушки."""
+
+    # Задержка до первого байта ответа (сек.) и её разброс (+-)
+    latency: float = 0.2
+    jitter: float = 0.05
+    # Токенов в ответе (не больше max_tokens запроса) и скорость выдачи
+    # (токенов/сек.; 0 — мгновенно)
+    tokens: int = 120
+    token_rate: float = 0.0
+    # Доля ответов 5xx (error_status) и 429 (с Retry-After)
+    error_rate: float = 0.0
+    error_status: int = 503
+    rate_limit_rate: float = 0.0
+    retry_after: float = 0.1
+    seed: int = 0
+
+
+class FakeLLM:
+    """Состояние сервера: конфигурация, ГСЧ и счётчики запросов."""
+
+    def __init__(self, config: Optional[FakeLLMConfig] = None):
+        self.config = config or FakeLLMConfig()
+        self.rng = random.Random(self.config.seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def _delay(self) -> float:
+        cfg = self.config
+        jitter = self.rng.uniform(-cfg.jitter, cfg.jitter)
+        return max(0.0, cfg.latency + jitter)
+
+    def _text(self, n: int):
+        return [self.rng.choice(_WORDS) for _ in range(n)]
+
+    async def chat(self, request: Request):
+        cfg = self.config
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(self._delay())
+        roll = self.rng.random()
+        if roll < cfg.rate_limit_rate:
+            self.rate_limited += 1
+            return JSONResponse(
+                {"error": {"message": "rate limited"}},
+                status_code=429,
+                headers={"Retry-After": str(cfg.retry_after)},
+            )
+        if roll < cfg.rate_limit_rate + cfg.error_rate:
+            self.errors += 1
+            return JSONResponse(
+                {"error": {"message": "fake upstream error"}},
+                status_code=cfg.error_status,
+            )
+        n = min(cfg.tokens, int(body.get("max_tokens") or cfg.tokens))
+        words = self._text(n)
+        finish = "length" if n < cfg.tokens else "stop"
+        usage = {
+            "prompt_tokens": sum(
+                len(str(m.get("content", "")).split())
+                for m in body.get("messages") or []
+            ),
+            "completion_tokens": n,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + n
+        if body.get("stream"):
+            return StreamingResponse(
+                self._stream(words, finish, usage),
+                media_type="text/event-stream",
+            )
+        if cfg.token_rate > 0:
+            await asyncio.sleep(n / cfg.token_rate)
+        return JSONResponse(
+            {
+                "id": f"fake-{self.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": " ".join(words),
+                        },
+                        "finish_reason": finish,
+                    }
+                ],
+                "usage": usage,
+            }
+        )
+
+    async def _stream(self, words, finish, usage):
+        delay = 1.0 / self.config.token_rate if self.config.token_rate else 0
+        for i, word in enumerate(words):
+            if delay:
+                await asyncio.sleep(delay)
+            chunk = {
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if i == 0 else " " + word},
+                        "finish_reason": None,
+                    }
+                ]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        last = {
+            "choices": [{"index": 0, "delta": {}, "finish_reason": finish}],
+            "usage": usage,
+        }
+        yield f"data: {json.dumps(last)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    async def stats(self, request: Request):
+        return JSONResponse(
+            {
+                "requests": self.requests,
+                "errors": self.errors,
+                "rate_limited": self.rate_limited,
+                "config": asdict(self.config),
+            }
+        )
+
+    def app(self) -> Starlette:
+        return Starlette(
+            routes=[
+                Route("/v1/chat/completions", self.chat, methods=["POST"]),
+                Route("/stats", self.stats, methods=["GET"]),
+            ]
+        )
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def running(
+    config: Optional[FakeLLMConfig] = None,
+    host: str = "127.0.0.1",
+    port: int = 0,
+) -> Iterator[FakeLLM]:
+    """
+    Запустить сервер в фоновом потоке на время блока. fake.url — адрес
+    chat/completions.
+    """
+    import uvicorn
+
+    fake = FakeLLM(config)
+    port = port or free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(
+            fake.app(), host=host, port=port, log_level="warning"
+        )
+    )
+    thread = threading.Thread(
+        target=server.run, name="fake-llm", daemon=True
+    )
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError("Fake LLM server failed to start")
+        time.sleep(0.01)
+    fake.url = f"http://{host}:{port}/v1/chat/completions"
+    try:
+        yield fake
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+
+def serve(
+    config: Optional[FakeLLMConfig] = None,
+    host: str = "127.0.0.1",
+    port: int = 8900,
+) -> None:
+    """Запустить сервер в текущем потоке (до Ctrl+C)."""
+    import uvicorn
+
+    uvicorn.run(FakeLLM(config).app(), host=host, port=port)
@@ -0,0 +1,149 @@
+"""
+Нагрузочные прогоны адаптера и обработчиков Gradio против локального
+сервера-заглушки: N одновременных пользователей, у каждого — серия
+запросов с разными идеями (кэш выключен, single-flight не склеивает).
+
+Режимы:
+  expand       — llm_adapter.expand_prompt
+  stream       — llm_adapter.expand_prompt_stream (до конца потока)
+  job_handler  — app.generate_job_handler, путь кнопки «Сгенерировать»:
+                 задание через JobQueue.submit, ожидание результата через
+                 watch (одновременно выполняется не больше JOBS_WORKERS)
+"""
+
+import os
+import time
+import asyncio
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import llm_adapter
+import settings
+from router import Endpoint
+
+from benchmarks.results import summarize
+
+MODES = ("expand", "stream", "job_handler")
+
+
+def configure_adapter(
+    url: str,
+    max_in_flight: int,
+    rate: float = 0.0,
+    max_queue: Optional[int] = None,
+) -> None:
+    """
+    Направить адаптер на сервер-заглушку: один endpoint, лимитер без
+    ограничения частоты (rate=0) и пул соединений под max_in_flight.
+    """
+    llm_adapter.configure_router(
+        [Endpoint(url=url, model="fake", key="fake")]
+    )
+    llm_adapter.configure_limiter(
+        rate=rate,
+        burst=max(1, max_in_flight),
+        max_in_flight=max_in_flight,
+        max_queue=max_queue if max_queue is not None else 10_000,
+    )
+    llm_adapter.configure_client(
+        max_connections=max_in_flight,
+        max_keepalive=max_in_flight,
+        http2=False,
+    )
+
+
+def _use_temp_storage() -> str:
+    """
+    Обработчики app и очередь заданий пишут в storage — при прогоне БД
+    пользователя не трогаем.
+    """
+    fd, path = tempfile.mkstemp(prefix="bench-", suffix=".db")
+    os.close(fd)
+    settings.configure(storage_db=path)
+    return path
+
+
+def _call(mode: str) -> Callable[[str, str], bool]:
+    """
+    Функция одного запроса: (idea, session) -> успех (непустой
+    результат). session — пользователь прогона, как сессия вкладки.
+    """
+    if mode == "expand":
+        return lambda idea, session: bool(
+            llm_adapter.expand_prompt(idea, 5, use_cache=False, user=session)
+        )
+    if mode == "stream":
+
+        def stream(idea, session):
+            text = ""
+            for text in llm_adapter.expand_prompt_stream(
+                idea, 5, use_cache=False, user=session
+            ):
+                pass
+            return bool(text)
+
+        return stream
+
+    # Обработчики используют кэш по умолчанию: температура слайдера 5
+    # выше CACHE_MAX_TEMPERATURE, идеи уникальны — в кэш не попадают
+    import app
+
+    if mode == "job_handler":
+
+        async def job_handler(idea, session):
+            status = ""
+            async for update in app.generate_job_handler(idea, 5, session):
+                status = update[1]
+            return status == "Done"
+
+        return lambda idea, session: asyncio.run(job_handler(idea, session))
+    raise ValueError(f"Unknown mode: {mode} (expected one of {MODES})")
+
+
+def run(
+    mode: str = "expand",
+    users: int = 8,
+    requests_per_user: int = 10,
+    warmup: int = 2,
+) -> Dict:
+    """
+    Прогон: users потоков по requests_per_user запросов. Адаптер должен
+    быть уже настроен (configure_adapter). Возвращает сводку задержек
+    (p50/p95/p99), пропускную способность и число ошибок.
+    """
+    if mode == "job_handler":
+        _use_temp_storage()
+    call = _call(mode)
+    for i in range(warmup):
+        call(f"warmup idea {i} {time.monotonic_ns()}", "warmup")
+
+    latencies: List[float] = []
+    failures = [0]
+    lock = threading.Lock()
+    run_id = time.monotonic_ns()
+
+    def user(uid: int) -> None:
+        for i in range(requests_per_user):
+            idea = f"benchmark idea {run_id} user {uid} request {i}"
+            started = time.perf_counter()
+            try:
+                ok = call(idea, f"bench-{uid}")
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    failures[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(user, range(users)))
+    elapsed = time.perf_counter() - started
+
+    summary = summarize(latencies, elapsed)
+    summary["failures"] = failures[0]
+    return summary
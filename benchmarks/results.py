@@ -0,0 +1,85 @@
+"""Статистика замеров и запись результатов бенчмарков в JSON."""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import platform
+import subprocess
+from typing import Dict, List, Optional
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(ordered: List[float], q: float) -> Optional[float]:
+    """Квантиль по отсортированному списку (nearest rank)."""
+    if not ordered:
+        return None
+    idx = min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))
+    return ordered[idx]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    """Сводка замеров: число, пропускная способность, p50/p95/p99."""
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        "count": count,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_per_s": round(count / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(ordered) / count * 1000, 3) if count else None,
+        "p50_ms": _ms(percentile(ordered, 0.50)),
+        "p95_ms": _ms(percentile(ordered, 0.95)),
+        "p99_ms": _ms(percentile(ordered, 0.99)),
+        "max_ms": _ms(ordered[-1] if ordered else None),
+    }
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value * 1000, 3)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment() -> Dict:
+    """Окружение запуска — для сравнения результатов между прогонами."""
+    return {
+        "git_commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write(name: str, params: Dict, results: Dict, path: str = "") -> str:
+    """
+    Записать результат в JSON (по умолчанию
+    benchmarks/results/<name>-<время>.json) и вернуть путь к файлу.
+    """
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"{name}-{stamp}.json")
+    document = {
+        "benchmark": name,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "params": params,
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    return path
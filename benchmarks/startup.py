@@ -0,0 +1,95 @@
+"""
+Бюджет холодного старта: `python -X importtime -c "import <модуль>"` в
+отдельном процессе для каждого модуля из BUDGETS. Проверяется, что
+импорт укладывается в бюджет, не тянет запрещённые тяжёлые пакеты
+(Gradio в не-UI точках входа) и не создаёт файлов (БД, outputs/).
+"""
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# модуль -> (бюджет суммарного времени импорта в мс, запрещённые пакеты)
+BUDGETS: Dict[str, Tuple[float, Tuple[str, ...]]] = {
+    "settings": (50, ("dotenv", "httpx", "numpy", "gradio")),
+    "storage": (100, ("httpx", "numpy", "gradio")),
+    "llm_adapter": (500, ("numpy", "gradio")),
+    "cli": (250, ("httpx", "numpy", "gradio")),
+    "api": (1000, ("numpy", "gradio")),
+}
+
+_LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_profile(module: str, cwd: str) -> Tuple[float, List[str]]:
+    """
+    Импортировать module в чистом процессе (каталог cwd, STORAGE_DB и
+    OUTPUTS_DIR — внутри cwd). Возвращает (суммарное время в мс, список
+    импортированных модулей верхнего уровня).
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    env["STORAGE_DB"] = os.path.join(cwd, "storage.db")
+    env["OUTPUTS_DIR"] = os.path.join(cwd, "outputs")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr}")
+    total_us = 0
+    packages = []
+    for line in proc.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        if name == module and len(indent) == 1:
+            total_us = int(cumulative)
+        packages.append(name.split(".")[0])
+    return total_us / 1000, sorted(set(packages))
+
+
+def check(repeat: int = 3, scale: float = 1.0) -> Dict:
+    """
+    Проверить все модули из BUDGETS (лучшее из repeat запусков; scale —
+    множитель бюджетов для медленных машин). В результате ok=False, если
+    хоть одна проверка не прошла.
+    """
+    results = {"ok": True, "modules": {}}
+    for module, (budget_ms, forbidden) in BUDGETS.items():
+        workdir = tempfile.mkdtemp(prefix="startup-")
+        try:
+            runs = [import_profile(module, workdir) for _ in range(repeat)]
+            created = sorted(os.listdir(workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        best_ms = min(ms for ms, _ in runs)
+        loaded = [p for p in forbidden if p in runs[0][1]]
+        problems = []
+        if best_ms > budget_ms * scale:
+            problems.append(
+                f"{best_ms:.0f} ms > budget {budget_ms * scale:.0f} ms"
+            )
+        if loaded:
+            problems.append("imports " + ", ".join(loaded))
+        if created:
+            problems.append("creates " + ", ".join(created))
+        results["modules"][module] = {
+            "import_ms": round(best_ms, 1),
+            "budget_ms": budget_ms * scale,
+            "problems": problems,
+        }
+        if problems:
+            results["ok"] = False
+    return results
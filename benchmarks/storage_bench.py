@@ -0,0 +1,198 @@
+"""
+Микробенчмарки storage на временной БД заданного размера: save
+(последовательно и из нескольких потоков, с отложенной записью и без),
+get, list (первая страница и страница по курсору из глубины),
+list_prompts, поиск и delete. Наполнение идёт пачками executemany в обход
+save_prompt — иначе 1M строк заполнялись бы часами.
+"""
+
+import os
+import time
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List
+
+import settings
+import storage
+
+from benchmarks.results import summarize
+
+DEFAULT_SIZES = (10_000, 100_000)
+
+# Потоков в замере одновременных сохранений
+SAVE_THREADS = 8
+
+_WORDS = (
+    "misty mountain valley river dawn golden light pine forest reflection "
+    "dramatic clouds cinematic wide angle ultra detailed soft haze rocky "
+    "shore glacier aurora meadow wildflowers volumetric rays moody dusk "
+    "desert dunes canyon waterfall lagoon island volcano tundra steppe"
+).split()
+_TAGS = ("landscape", "portrait", "night", "sunset", "macro", "city")
+
+
+def _record(rng: random.Random, created: datetime) -> Dict:
+    words = rng.choices(_WORDS, k=rng.randint(20, 60))
+    return {
+        "name": " ".join(words[:3]),
+        "prompt": " ".join(words),
+        "slider_value": rng.randint(0, 10),
+        "llm_input": " ".join(words[:5]),
+        "llm_raw_response": "",
+        "tags": rng.sample(_TAGS, rng.randint(0, 2)),
+        "created_at": created.isoformat() + "Z",
+    }
+
+
+def populate(rows: int, seed: int = 0, batch_size: int = 5000) -> None:
+    """Заполнить текущую БД rows записями (детерминированно по seed)."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    conn = storage._conn()
+    for offset in range(0, rows, batch_size):
+        batch = [
+            storage._record_params(
+                _record(rng, start + timedelta(seconds=offset + i))
+            )
+            for i in range(min(batch_size, rows - offset))
+        ]
+        with conn:
+            conn.executemany(
+                storage._INSERT_SQL.format(verb="OR REPLACE"), batch
+            )
+            storage._write_tags(conn, batch)
+    conn.execute("ANALYZE")
+    # Размер файла БД — без недозаписанного WAL
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def _measure(fn: Callable, args: Iterable) -> Dict:
+    latencies: List[float] = []
+    started = time.perf_counter()
+    for arg in args:
+        t0 = time.perf_counter()
+        fn(arg)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def _concurrent_save(
+    records: List[Dict], threads: int, write_behind: bool
+) -> Dict:
+    """save_prompt из threads потоков одновременно."""
+    previous = settings.get_settings().storage_write_behind
+    settings.configure(storage_write_behind=write_behind)
+
+    def save_all(chunk: List[Dict]) -> List[float]:
+        latencies = []
+        for record in chunk:
+            t0 = time.perf_counter()
+            storage.save_prompt(record)
+            latencies.append(time.perf_counter() - t0)
+        return latencies
+
+    chunks = [records[i::threads] for i in range(threads)]
+    latencies: List[float] = []
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(threads) as pool:
+            for chunk_latencies in pool.map(save_all, chunks):
+                latencies.extend(chunk_latencies)
+    finally:
+        settings.configure(storage_write_behind=previous)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def _deep_cursor(rows: int):
+    """Курсор страницы примерно из середины ленты."""
+    page, _ = storage.list_prompt_summaries(limit=max(1, rows // 2))
+    if not page:
+        return None
+    return storage.encode_cursor(page[-1]["created_at"], page[-1]["id"])
+
+
+def bench_size(rows: int, iterations: int = 200, seed: int = 0) -> Dict:
+    """Все операции на БД из rows записей."""
+    fd, path = tempfile.mkstemp(prefix=f"bench-{rows}-", suffix=".db")
+    os.close(fd)
+    old_path = storage.db_path()
+    settings.configure(storage_db=path)
+    try:
+        t0 = time.perf_counter()
+        populate(rows, seed=seed)
+        populate_s = time.perf_counter() - t0
+
+        rng = random.Random(seed + 1)
+        ids = [
+            row[0]
+            for row in storage._conn().execute(
+                "SELECT id FROM saved_prompts ORDER BY random() LIMIT ?",
+                (iterations,),
+            )
+        ]
+        cursor = _deep_cursor(rows)
+        new_records = [
+            _record(rng, datetime(2025, 1, 1) + timedelta(seconds=i))
+            for i in range(iterations * 3)
+        ]
+        concurrent = new_records[iterations:]
+        new_records = new_records[:iterations]
+        saved: List[str] = []
+        n = range(iterations)
+        results = {
+            "populate_s": round(populate_s, 3),
+            "db_bytes": os.path.getsize(path),
+            "save": _measure(
+                lambda r: saved.append(storage.save_prompt(r)), new_records
+            ),
+            "save_concurrent": _concurrent_save(
+                concurrent[:iterations], SAVE_THREADS, write_behind=False
+            ),
+            "save_concurrent_write_behind": _concurrent_save(
+                concurrent[iterations:], SAVE_THREADS, write_behind=True
+            ),
+            "get": _measure(storage.get_prompt, ids),
+            "list_first_page": _measure(
+                lambda _: storage.list_prompt_summaries(limit=50), n
+            ),
+            "list_deep_page": _measure(
+                lambda _: storage.list_prompt_summaries(
+                    limit=50, cursor=cursor
+                ),
+                n,
+            ),
+            "list_by_tag": _measure(
+                lambda _: storage.list_prompt_summaries(
+                    limit=50, tags=["sunset"]
+                ),
+                n,
+            ),
+            "list_prompts_100": _measure(
+                lambda _: storage.list_prompts(limit=100), n
+            ),
+            "search": _measure(
+                lambda i: storage.search_prompts(_WORDS[i % len(_WORDS)]),
+                n,
+            ),
+            "delete": _measure(storage.delete_prompt, saved),
+        }
+        return results
+    finally:
+        storage.close_all()
+        settings.configure(storage_db=old_path)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+
+
+def run(sizes=DEFAULT_SIZES, iterations: int = 200, seed: int = 0):
+    """Прогон по всем размерам: {размер: результаты}."""
+    results = {}
+    for rows in sizes:
+        print(f"storage: {rows} rows...")
+        results[str(rows)] = bench_size(rows, iterations, seed)
+    return results
@@ -0,0 +1,499 @@
+"""
+Консольные (headless) команды Flux Prompt Lab.
+
+    python cli.py batch ideas.jsonl --output results.jsonl --save
+    python cli.py export library.ndjson.gz
+    python cli.py import library.ndjson.gz --policy skip
+    python cli.py compact
+    python cli.py similar "misty mountain lake at dawn" -k 5
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import storage
+import tracing
+from settings import get_settings
+from token_budget import TokenBudgetExceeded
+
+# llm_adapter (httpx) и similarity (numpy) импортируются в командах,
+# которым они нужны: export/import не платят за их загрузку
+
+
+# --- batch ---
+
+
+def _count_lines(path: str) -> int:
+    """Посчитать строки файла, читая его блоками (без загрузки целиком)."""
+    count = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            count += chunk.count(b"\n")
+            last = chunk[-1:]
+    return count + (0 if last == b"\n" else 1)
+
+
+def _iter_ideas(
+    path: str, field: str, default_slider: int
+) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """
+    Построчно читать JSONL с идеями. Строка — JSON-объект (идея в поле
+    field, опционально slider/name/tags) или JSON-строка с идеей;
+    slider приводится к диапазону интерфейса 0..10.
+    Выдаёт (номер строки, задание или None, ошибка или None).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                yield line_no, None, None
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                yield line_no, None, f"invalid JSON: {e}"
+                continue
+            if isinstance(data, str):
+                data = {field: data}
+            if not isinstance(data, dict) or not str(
+                data.get(field) or ""
+            ).strip():
+                yield line_no, None, f"no '{field}' in line"
+                continue
+            slider = data.get("slider", default_slider)
+            try:
+                if isinstance(slider, bool):
+                    raise ValueError
+                slider = min(10, max(0, int(slider)))
+            except (TypeError, ValueError, OverflowError):
+                yield line_no, None, f"invalid slider: {slider!r}"
+                continue
+            task = {
+                "idea": str(data[field]).strip(),
+                "slider": slider,
+                "name": data.get("name"),
+                "tags": data.get("tags"),
+            }
+            yield line_no, task, None
+
+
+class Checkpoint:
+    """
+    Прогресс пакетной обработки: все строки с номером < done_through
+    обработаны, done — обработанные строки за этой границей (выполняются
+    не по порядку). Сохраняется атомарной заменой файла.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done_through = 0
+        self.done: Set[int] = set()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.done_through = int(data.get("done_through", 0))
+        self.done = set(data.get("done", []))
+
+    def is_done(self, line_no: int) -> bool:
+        return line_no < self.done_through or line_no in self.done
+
+    def mark(self, line_no: int) -> None:
+        self.done.add(line_no)
+        while self.done_through in self.done:
+            self.done.remove(self.done_through)
+            self.done_through += 1
+
+    def save(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"done_through": self.done_through, "done": sorted(self.done)},
+                f,
+            )
+        os.replace(tmp, self.path)
+
+
+def _record_id(input_path: str, line_no: int) -> str:
+    """Детерминированный id записи: повтор после сбоя не создаёт дублей."""
+    key = f"{os.path.abspath(input_path)}:{line_no}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+
+@tracing.traced("cli.expand", root=True)
+async def _expand_one(args, line_no: int, task: Dict) -> Dict:
+    import llm_adapter
+
+    variants = await llm_adapter.expand_prompt_async(
+        task["idea"], task["slider"], use_cache=args.cache
+    )
+    result = {"line": line_no, "idea": task["idea"], "slider": task["slider"]}
+    if not variants:
+        result["error"] = "Empty LLM response"
+        return result
+    first = variants[0]
+    if not isinstance(first, dict):
+        first = {"prompt": str(first)}
+    result["prompt"] = (first.get("prompt") or "").strip()
+    result["finish_reason"] = first.get("finish_reason", "")
+    if args.save and args.dedupe:
+        import similarity
+
+        duplicate = await asyncio.to_thread(
+            similarity.get_index().find_duplicate,
+            result["prompt"],
+            args.dedupe_threshold,
+        )
+        if duplicate:
+            # Почти такой же промпт уже есть в библиотеке — не сохраняем
+            result["duplicate_of"] = duplicate["id"]
+            result["similarity"] = duplicate["similarity"]
+            return result
+    if args.save:
+        record = {
+            "id": _record_id(args.input, line_no),
+            "name": task["name"] or task["idea"][:60],
+            "prompt": result["prompt"],
+            "slider_value": task["slider"],
+            "llm_input": task["idea"],
+            "llm_raw_response": first.get("llm_raw_response", ""),
+            "tags": task["tags"] or [],
+        }
+        if get_settings().storage_write_behind:
+            # Ждём коммита пачки писателя, не занимая поток
+            result["id"] = await asyncio.wrap_future(
+                storage.submit_prompt(record)
+            )
+        else:
+            result["id"] = await asyncio.to_thread(
+                storage.save_prompt, record
+            )
+    return result
+
+
+def _format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+async def _run_batch(args) -> int:
+    checkpoint = Checkpoint(args.checkpoint or args.input + ".checkpoint")
+    if not args.restart:
+        checkpoint.load()
+    total = _count_lines(args.input)
+    out = None
+    if args.output:
+        out = open(args.output, "w" if args.restart else "a", encoding="utf-8")
+
+    started = time.monotonic()
+    last_report = started
+    processed = failed = 0
+    remaining = total - checkpoint.done_through - len(checkpoint.done)
+    pending: Dict[asyncio.Task, int] = {}
+
+    def finish(line_no: int, result: Optional[Dict]) -> None:
+        nonlocal processed, failed, last_report
+        if result is not None:
+            if "error" in result:
+                failed += 1
+            if out is not None:
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+        # Сначала результат, затем чекпоинт: после сбоя строка может
+        # повториться в выходном файле, но не потеряется.
+        checkpoint.mark(line_no)
+        processed += 1
+        now = time.monotonic()
+        if now - last_report >= args.progress_interval:
+            last_report = now
+            checkpoint.save()
+            rate = processed / (now - started)
+            left = max(remaining - processed, 0)
+            eta = _format_eta(left / rate) if rate > 0 else "?"
+            print(
+                f"[batch] {processed}/{remaining} done, {failed} failed, "
+                f"{rate:.2f} ideas/s, ETA {eta}",
+                file=sys.stderr,
+            )
+
+    async def drain(return_when) -> None:
+        done, _ = await asyncio.wait(pending, return_when=return_when)
+        for t in done:
+            line_no = pending.pop(t)
+            try:
+                result = t.result()
+            except TokenBudgetExceeded:
+                # Остальные идеи бюджет тоже не пропустит: строка не
+                # отмечается, запуск останавливается
+                raise
+            except Exception as e:
+                result = {"line": line_no, "error": str(e)}
+            finish(line_no, result)
+
+    try:
+        for line_no, task, error in _iter_ideas(
+            args.input, args.field, args.slider
+        ):
+            if checkpoint.is_done(line_no):
+                continue
+            if task is None:
+                result = None
+                if error:
+                    result = {"line": line_no, "error": error}
+                finish(line_no, result)
+                continue
+            while len(pending) >= args.concurrency:
+                await drain(asyncio.FIRST_COMPLETED)
+            t = asyncio.create_task(_expand_one(args, line_no, task))
+            pending[t] = line_no
+        if pending:
+            await drain(asyncio.ALL_COMPLETED)
+    finally:
+        for t in pending:
+            t.cancel()
+        checkpoint.save()
+        if out is not None:
+            out.close()
+
+    elapsed = time.monotonic() - started
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(
+        f"[batch] finished: {processed} processed, {failed} failed "
+        f"in {elapsed:.1f}s ({rate:.2f} ideas/s)",
+        file=sys.stderr,
+    )
+    return 1 if failed else 0
+
+
+def cmd_batch(args) -> int:
+    """Пакетное расширение идей из JSONL-файла."""
+    if not args.output and not args.save:
+        print("Specify --output and/or --save", file=sys.stderr)
+        return 2
+    try:
+        return asyncio.run(_run_batch(args))
+    except KeyboardInterrupt:
+        print("[batch] interrupted, progress saved", file=sys.stderr)
+        return 130
+    except TokenBudgetExceeded as e:
+        print(f"[batch] stopped: {e}; progress saved", file=sys.stderr)
+        return 3
+
+
+# --- export / import ---
+
+
+class _Progress:
+    """Периодический вывод прогресса (записи/сек.) в stderr."""
+
+    def __init__(self, label: str, interval: float = 2.0):
+        self.label = label
+        self.interval = interval
+        self.started = time.monotonic()
+        self._last = 0.0
+
+    def rate(self, count: int) -> float:
+        elapsed = time.monotonic() - self.started
+        return count / elapsed if elapsed > 0 else 0.0
+
+    def __call__(self, count: int, extra: str = "") -> None:
+        now = time.monotonic()
+        if now - self._last < self.interval:
+            return
+        self._last = now
+        print(
+            f"[{self.label}] {count} records, "
+            f"{self.rate(count):.0f} rec/s{extra}",
+            file=sys.stderr,
+        )
+
+
+def cmd_export(args) -> int:
+    """Выгрузка библиотеки в NDJSON (gzip для .gz)."""
+    progress = _Progress("export")
+    count = storage.export_ndjson(
+        args.output,
+        compress=True if args.gzip else None,
+        query=args.query,
+        since=args.since,
+        until=args.until,
+        progress=progress,
+    )
+    print(
+        f"[export] {count} records written to {args.output} "
+        f"({progress.rate(count):.0f} rec/s)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def cmd_import(args) -> int:
+    """Загрузка библиотеки из NDJSON (gzip для .gz)."""
+    progress = _Progress("import")
+
+    def report(stats: Dict) -> None:
+        progress(
+            stats["read"],
+            f", {stats['skipped']} skipped, {stats['errors']} errors",
+        )
+
+    stats = storage.import_ndjson(
+        args.input,
+        policy=args.policy,
+        compress=True if args.gzip else None,
+        batch_size=args.batch_size,
+        progress=report,
+    )
+    print(
+        f"[import] read {stats['read']}, written {stats['written']}, "
+        f"skipped {stats['skipped']}, errors {stats['errors']} "
+        f"({progress.rate(stats['read']):.0f} rec/s)",
+        file=sys.stderr,
+    )
+    return 1 if stats["errors"] else 0
+
+
+def cmd_compact(args) -> int:
+    """Пересжать большие колонки новым словарём и выполнить VACUUM."""
+    progress = _Progress("compact")
+    stats = storage.compact(
+        train=not args.no_train, vacuum=not args.no_vacuum, progress=progress
+    )
+    mb = 1024 * 1024
+    print(
+        f"[compact] rewritten {stats['rewritten']} values "
+        f"(dictionary {stats['dict_id']}), "
+        f"{stats['bytes_before'] / mb:.1f} MB -> "
+        f"{stats['bytes_after'] / mb:.1f} MB",
+        file=sys.stderr,
+    )
+    return 0
+
+
+# --- similar ---
+
+
+def cmd_similar(args) -> int:
+    """Найти в библиотеке промпты, похожие на текст или запись (--id)."""
+    import similarity
+
+    index = similarity.get_index()
+    started = time.monotonic()
+    if args.id:
+        found = index.similar_to(args.id, k=args.k, min_similarity=args.min)
+    else:
+        found = index.similar_to_text(
+            args.text or "", k=args.k, min_similarity=args.min
+        )
+    elapsed = time.monotonic() - started
+    for item in found:
+        print(json.dumps(item, ensure_ascii=False))
+    print(
+        f"[similar] {len(found)} found in {elapsed * 1000:.1f}ms "
+        f"({index.stats()['records']} indexed)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="flux-prompt-lab")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("batch", help="expand ideas from a JSONL file")
+    p.add_argument("input", help="JSONL file with ideas")
+    p.add_argument("-o", "--output", help="append results to this JSONL")
+    p.add_argument(
+        "--save", action="store_true", help="save results to storage.db"
+    )
+    p.add_argument("-c", "--concurrency", type=int, default=4)
+    p.add_argument("--slider", type=int, default=5, help="default slider")
+    p.add_argument("--field", default="idea", help="JSON field with idea")
+    p.add_argument("--checkpoint", help="checkpoint file path")
+    p.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore checkpoint and overwrite output",
+    )
+    p.add_argument(
+        "--cache",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="force response cache on/off (default: by temperature)",
+    )
+    p.add_argument("--progress-interval", type=float, default=5.0)
+    p.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="with --save, skip prompts that near-duplicate saved ones",
+    )
+    p.add_argument(
+        "--dedupe-threshold",
+        type=float,
+        default=None,
+        help="default: SIMILARITY_DUPLICATE_THRESHOLD",
+    )
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("export", help="export prompts to NDJSON")
+    p.add_argument("output", help="output file (.gz for gzip)")
+    p.add_argument("--gzip", action="store_true", help="force gzip")
+    p.add_argument("-q", "--query", help="full-text filter")
+    p.add_argument("--since", help="created_at >= (ISO date)")
+    p.add_argument("--until", help="created_at < (ISO date)")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("import", help="import prompts from NDJSON")
+    p.add_argument("input", help="input file (.gz for gzip)")
+    p.add_argument("--gzip", action="store_true", help="force gzip")
+    p.add_argument(
+        "--policy",
+        choices=storage.IMPORT_POLICIES,
+        default="upsert",
+        help="what to do with existing ids",
+    )
+    p.add_argument("--batch-size", type=int, default=5000)
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser(
+        "compact", help="recompress large columns and VACUUM the database"
+    )
+    p.add_argument(
+        "--no-train",
+        action="store_true",
+        help="keep the current compression dictionary",
+    )
+    p.add_argument("--no-vacuum", action="store_true", help="skip VACUUM")
+    p.set_defaults(func=cmd_compact)
+
+    p = sub.add_parser("similar", help="find near-duplicate prompts")
+    p.add_argument("text", nargs="?", help="prompt text to compare")
+    p.add_argument("--id", help="compare with a saved record instead")
+    p.add_argument("-k", type=int, default=10, help="how many to return")
+    p.add_argument(
+        "--min", type=float, default=0.0, help="minimum similarity (0..1)"
+    )
+    p.set_defaults(func=cmd_similar)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
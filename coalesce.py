@@ -0,0 +1,141 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+
+class _Flight:
+    """Один выполняющийся запрос и число ожидающих его вызовов."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        # Для потоков: последний снимок, его номер и признак завершения
+        self.latest: Any = None
+        self.seq = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+
+    def publish(self, item: Any) -> None:
+        self.latest = item
+        self.seq += 1
+        self._wake()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+def _consume_result(task: asyncio.Task) -> None:
+    # Ошибку получают ожидающие; если их не осталось — не шуметь в лог
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов (single-flight): пока
+    запрос с ключом key выполняется, повторные вызовы с тем же ключом не
+    создают новый, а ждут результат первого. Результат или исключение
+    получают все ожидающие.
+
+    Отмена одного ожидающего не отменяет общий запрос, пока его ждут
+    другие; когда уходит последний — запрос отменяется.
+
+    Экземпляр привязан к одному event loop (loop адаптера).
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._stats = {"leaders": 0, "followers": 0, "cancelled": 0}
+
+    def _start(self, key: str, coro) -> _Flight:
+        task = asyncio.ensure_future(coro)
+        flight = _Flight(task)
+        self._flights[key] = flight
+
+        def forget(_task):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        task.add_done_callback(forget)
+        task.add_done_callback(_consume_result)
+        return flight
+
+    def _join(self, key: str, start: Callable[[], Any]) -> _Flight:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._start(key, start())
+            self._stats["leaders"] += 1
+        else:
+            self._stats["followers"] += 1
+        flight.waiters += 1
+        return flight
+
+    def _leave(self, flight: _Flight) -> None:
+        flight.waiters -= 1
+        if flight.waiters <= 0 and not flight.task.done():
+            self._stats["cancelled"] += 1
+            flight.task.cancel()
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]):
+        """Выполнить factory() или дождаться уже идущего вызова с key."""
+        flight = self._join(key, factory)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    async def stream(
+        self, key: str, factory: Callable[[], AsyncIterator[Any]]
+    ) -> AsyncIterator[Any]:
+        """
+        Общий поток для одинаковых запросов. Элементы потока — снимки
+        (накопленный текст), поэтому подключившийся позже сразу получает
+        текущий снимок и дальше все новые; промежуточные снимки, которые
+        он не успел забрать, пропускаются.
+        """
+
+        def start():
+            async def pump():
+                try:
+                    async for item in factory():
+                        flight.publish(item)
+                except asyncio.CancelledError:
+                    flight.finish(asyncio.CancelledError())
+                    raise
+                except Exception as e:
+                    flight.finish(e)
+                    return
+                flight.finish()
+
+            return pump()
+
+        flight = self._join(key, start)
+        seen = 0
+        try:
+            while True:
+                if flight.seq > seen:
+                    seen = flight.seq
+                    yield flight.latest
+                    continue
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            self._leave(flight)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats["in_flight"] = len(self._flights)
+        return stats
@@ -0,0 +1,128 @@
+"""
+Сжатие больших текстовых колонок SQLite: deflate (zlib) с общим
+словарём (zdict). Сжатое значение — BLOB с заголовком (MAGIC, id
+словаря); обычный TEXT читается как есть, так что строки, записанные до
+сжатия, остаются валидными.
+
+Словарь обучается на корпусе (train): в него попадают частые фрагменты
+ответов — JSON-обвязка chat/completions и типичные обороты промптов.
+Короткие записи тогда сжимаются почти так же хорошо, как длинные.
+"""
+
+import re
+import zlib
+import struct
+from collections import Counter
+from typing import Iterable, List
+
+MAGIC = 0x5A
+_HEADER = struct.Struct(">BH")
+
+# Окно deflate — больше словаря zlib не использует
+MAX_DICT_SIZE = 32 * 1024
+
+# Встроенный словарь (id 0) — для БД, где свой ещё не обучен. Менять
+# его нельзя: им сжаты уже записанные строки.
+BASE_DICT_ID = 0
+BASE_DICT = (
+    "highly detailed, ultra realistic, 8k, sharp focus, soft lighting, "
+    "volumetric light, golden hour, cinematic composition, depth of "
+    "field, wide angle, photorealistic, intricate details, atmospheric, "
+    "dramatic sky, in the foreground, in the background, "
+    "1. **Prompt 1:** 2. **Prompt 2:** 3. **Prompt 3:** "
+    '"usage": {"prompt_tokens": , "completion_tokens": , '
+    '"total_tokens": }, "system_fingerprint": null, '
+    '"logprobs": null, "finish_reason": "stop"}], '
+    '{"id": "chatcmpl-", "object": "chat.completion", "created": , '
+    '"model": "", "choices": [{"index": 0, "message": {"role": '
+    '"assistant", "content": "'
+).encode("utf-8")
+
+# Фрагменты словаря: последовательности из 2..8 токенов (слова,
+# пробелы, знаки)
+_TOKEN_RE = re.compile(r"\w+|\s+|[^\w\s]+")
+_NGRAM_SIZES = (2, 3, 4, 6, 8)
+_MIN_FRAGMENT = 6
+# Сколько текста корпуса анализировать при обучении (байт) и сколько
+# лучших фрагментов рассматривать
+_TRAIN_BYTES = 256 * 1024
+_MAX_CANDIDATES = 50000
+
+
+def is_compressed(value) -> bool:
+    return (
+        isinstance(value, (bytes, memoryview))
+        and len(value) >= _HEADER.size
+        and value[0] == MAGIC
+    )
+
+
+def dict_id(value) -> int:
+    """id словаря, которым сжато значение."""
+    return _HEADER.unpack_from(value)[1]
+
+
+def compress(text: str, zdict_id: int, zdict: bytes, level: int = 6):
+    """Сжать text словарём zdict; результат — BLOB с заголовком."""
+    # Сырой deflate (wbits < 0): без заголовка и контрольной суммы zlib
+    co = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    body = co.compress(text.encode("utf-8")) + co.flush()
+    return _HEADER.pack(MAGIC, zdict_id) + body
+
+
+def decompress(value, zdict: bytes) -> str:
+    do = zlib.decompressobj(-15, zdict=zdict)
+    data = do.decompress(bytes(value[_HEADER.size:])) + do.flush()
+    return data.decode("utf-8")
+
+
+def compressed_size(texts: Iterable[str], zdict: bytes, level=6) -> int:
+    """Суммарный размер texts, сжатых словарём (для сравнения словарей)."""
+    return sum(len(compress(t, 0, zdict, level)) for t in texts)
+
+
+def train(samples: Iterable[str], size: int = MAX_DICT_SIZE) -> bytes:
+    """
+    Обучить словарь на samples: частые фрагменты по выигрышу
+    (повторы × длина), без вложенных в уже выбранные. Самые выгодные —
+    в конце словаря: deflate кодирует близкие ссылки короче.
+    """
+    counts: Counter = Counter()
+    budget = _TRAIN_BYTES
+    for text in samples:
+        if budget <= 0:
+            break
+        text = text[:budget]
+        budget -= len(text)
+        tokens = _TOKEN_RE.findall(text)
+        seen = set()
+        for n in _NGRAM_SIZES:
+            for i in range(len(tokens) - n + 1):
+                seen.add("".join(tokens[i:i + n]))
+        # Считаем, в скольких образцах встречается фрагмент: общие для
+        # разных ответов фрагменты полезнее повторов внутри одного
+        counts.update(f for f in seen if len(f) >= _MIN_FRAGMENT)
+    scored = sorted(
+        (
+            ((count - 1) * len(fragment.encode("utf-8")), fragment)
+            for fragment, count in counts.items()
+            if count > 1
+        ),
+        reverse=True,
+    )
+    del scored[_MAX_CANDIDATES:]
+    chosen: List[bytes] = []
+    used = 0
+    joined = ""
+    for _, fragment in scored:
+        data = fragment.encode("utf-8")
+        if used + len(data) > size:
+            continue
+        if fragment in joined:
+            continue
+        chosen.append(data)
+        joined += fragment
+        used += len(data)
+        if used >= size:
+            break
+    return b"".join(reversed(chosen))
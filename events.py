@@ -0,0 +1,41 @@
+import json
+import time
+import logging
+import threading
+from typing import Callable, Dict, List
+
+logger = logging.getLogger("flux_prompt_lab.events")
+
+_listeners: List[Callable[[Dict], None]] = []
+_lock = threading.Lock()
+
+
+def subscribe(listener: Callable[[Dict], None]) -> None:
+    """Подписаться на структурированные события (dict)."""
+    with _lock:
+        if listener not in _listeners:
+            _listeners.append(listener)
+
+
+def unsubscribe(listener: Callable[[Dict], None]) -> None:
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def emit(event: str, level: int = logging.INFO, **fields) -> Dict:
+    """
+    Отправить структурированное событие: JSON-строка в логгер
+    flux_prompt_lab.events и вызов подписчиков. Ошибки подписчиков не
+    влияют на вызывающий код.
+    """
+    record = {"event": event, "ts": time.time(), **fields}
+    logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+    with _lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        try:
+            listener(record)
+        except Exception as e:
+            logger.debug("event listener failed: %s", e)
+    return record
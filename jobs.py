@@ -0,0 +1,586 @@
+"""
+Фоновые задания генерации. Обработчик интерфейса или API не ждёт ответа
+LLM сам: он ставит задание в очередь (submit) и следит за ним (watch),
+так что воркер Gradio/uvicorn не занят на время запроса.
+
+Задания хранятся в таблице jobs и переживают перезапуск: прерванные
+возвращаются в очередь (не больше JOBS_MAX_ATTEMPTS попыток). Выполняет
+их пул из JOBS_WORKERS корутин на loop адаптера. Порядок — по
+приоритету, внутри приоритета — по кругу между сессиями, чтобы сессия с
+пачкой заданий не задерживала остальных.
+"""
+
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional
+
+import llm_adapter
+import metrics
+import storage
+import tracing
+from settings import get_settings
+
+# Интерактивные запросы из интерфейса обслуживаются раньше пакетных
+PRIORITY_INTERACTIVE = 10
+PRIORITY_BATCH = 0
+
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+# Как часто удалять старые завершённые задания (сек.)
+PURGE_INTERVAL = 3600.0
+
+JOBS_FINISHED = metrics.REGISTRY.counter(
+    "jobs_finished",
+    "Finished background jobs by kind and status",
+    ("kind", "status"),
+)
+JOB_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "job_wait_seconds", "Time from job submit to start", ("kind",)
+)
+JOB_RUN_SECONDS = metrics.REGISTRY.histogram(
+    "job_run_seconds", "Job execution time", ("kind", "status")
+)
+
+
+class JobQueueFull(Exception):
+    """Очередь заданий или квота сессии заполнена."""
+
+
+async def _run_expand(params: Dict, publish: Callable[[str], None]) -> Dict:
+    """Потоковое расширение идеи; промежуточный текст — через publish."""
+    text = ""
+    async for text in llm_adapter.expand_prompt_stream_async(
+        params["idea"],
+        params.get("slider", 5),
+        params.get("use_cache"),
+        user=params.get("user"),
+    ):
+        publish(text)
+    text = text.strip()
+    if not text:
+        raise RuntimeError("Empty LLM response")
+    return {"prompt": text}
+
+
+# Виды заданий: kind -> async fn(params, publish) -> результат (JSON)
+KINDS = {"expand": _run_expand}
+
+
+class _Job:
+    """Задание в памяти (в очереди или выполняется)."""
+
+    __slots__ = (
+        "id",
+        "session",
+        "kind",
+        "params",
+        "priority",
+        "status",
+        "partial",
+        "result",
+        "error",
+        "created_at",
+        "started_at",
+        "finished_at",
+        "version",
+        "task",
+        "cancel_requested",
+        "watchers",
+        "trace",
+    )
+
+    def __init__(self, job_id, session, kind, params, priority, created_at):
+        self.id = job_id
+        self.session = session
+        self.kind = kind
+        self.params = params
+        self.priority = priority
+        self.status = "queued"
+        self.partial = ""
+        self.result = None
+        self.error = None
+        self.created_at = created_at
+        self.started_at = None
+        self.finished_at = None
+        # Растёт при каждом изменении; watch() по нему видит обновления
+        self.version = 0
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_requested = False
+        # (loop, asyncio.Event) наблюдателей из любых event loop-ов
+        self.watchers: List = []
+        # Спан, из которого поставлено задание: выполнение — его потомок
+        self.trace: Optional[tracing.Span] = None
+
+
+def _snapshot(job: _Job, position: Optional[int] = None) -> Dict:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "session": job.session,
+        "params": job.params,
+        "priority": job.priority,
+        "status": job.status,
+        "position": position,
+        "partial": job.partial,
+        "result": job.result,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+class JobQueue:
+    """
+    Очередь заданий с ограниченным пулом воркеров. Методы submit, cancel
+    и get можно вызывать из любого потока (они пишут в БД — из async-кода
+    лучше через asyncio.to_thread); watch — async-генератор для любого
+    event loop.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_queued: Optional[int] = None,
+        max_per_session: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        retention: Optional[float] = None,
+    ):
+        # Не заданные параметры — из настроек JOBS_*
+        s = get_settings()
+        self.workers = s.jobs_workers if workers is None else workers
+        self.max_queued = (
+            s.jobs_max_queued if max_queued is None else max_queued
+        )
+        self.max_per_session = (
+            s.jobs_max_per_session
+            if max_per_session is None
+            else max_per_session
+        )
+        self.max_attempts = (
+            s.jobs_max_attempts if max_attempts is None else max_attempts
+        )
+        self.retention = s.jobs_retention if retention is None else retention
+        self._lock = threading.Lock()
+        # Задания в очереди и выполняющиеся (завершённые — только в БД)
+        self._jobs: Dict[str, _Job] = {}
+        # priority -> session -> задания сессии; порядок сессий —
+        # очередь round robin
+        self._queued: Dict[int, "OrderedDict[str, Deque[_Job]]"] = {}
+        self._session_queued: Dict[str, int] = {}
+        self._queued_count = 0
+        # Незавершённые задания сессии (в очереди, выполняются или ещё
+        # записываются в БД) — для квоты max_per_session; _reserved —
+        # места в очереди, занятые submit до записи в БД
+        self._session_active: Dict[str, int] = {}
+        self._reserved = 0
+        self._running = 0
+        self._started = False
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    # --- Запуск ---
+
+    def start(self) -> None:
+        """
+        Запустить воркеры (однократно): вернуть в очередь задания,
+        прерванные прошлым запуском, и удалить устаревшие. Нельзя
+        вызывать с loop адаптера.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        try:
+            llm_adapter.submit_background(self._start()).result()
+        except BaseException:
+            with self._lock:
+                self._started = False
+            raise
+
+    async def _start(self) -> None:
+        self._wakeup = asyncio.Event()
+        recovered = await asyncio.to_thread(
+            storage.jobs_recover, self.max_attempts
+        )
+        with self._lock:
+            for row in recovered:
+                job = _Job(
+                    row["id"],
+                    row["session"],
+                    row["kind"],
+                    row["params"],
+                    row["priority"],
+                    row["created_at"],
+                )
+                self._enqueue(job)
+                self._activate(job.session)
+        if recovered:
+            print(f"Resuming {len(recovered)} queued job(s)")
+        self._tasks = [
+            asyncio.create_task(self._worker())
+            for _ in range(max(1, self.workers))
+        ]
+        self._tasks.append(asyncio.create_task(self._purge_loop()))
+
+    async def _purge_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(
+                    storage.jobs_purge, time.time() - self.retention
+                )
+            except Exception as e:
+                print(f"Warning: job purge failed: {e}")
+            await asyncio.sleep(PURGE_INTERVAL)
+
+    # --- Очередь (под self._lock) ---
+
+    def _enqueue(self, job: _Job) -> None:
+        sessions = self._queued.setdefault(job.priority, OrderedDict())
+        sessions.setdefault(job.session, deque()).append(job)
+        self._session_queued[job.session] = (
+            self._session_queued.get(job.session, 0) + 1
+        )
+        self._queued_count += 1
+        self._jobs[job.id] = job
+
+    def _activate(self, session: str) -> None:
+        self._session_active[session] = (
+            self._session_active.get(session, 0) + 1
+        )
+
+    def _deactivate(self, session: str) -> None:
+        left = self._session_active.get(session, 0) - 1
+        if left > 0:
+            self._session_active[session] = left
+        else:
+            self._session_active.pop(session, None)
+
+    def _unqueue(self, job: _Job) -> None:
+        sessions = self._queued[job.priority]
+        pending = sessions[job.session]
+        pending.remove(job)
+        if not pending:
+            del sessions[job.session]
+        if not sessions:
+            del self._queued[job.priority]
+        left = self._session_queued[job.session] - 1
+        if left:
+            self._session_queued[job.session] = left
+        else:
+            del self._session_queued[job.session]
+        self._queued_count -= 1
+
+    def _next(self) -> Optional[_Job]:
+        """Следующее задание: старший приоритет, сессии — по кругу."""
+        if not self._queued:
+            return None
+        sessions = self._queued[max(self._queued)]
+        session, pending = next(iter(sessions.items()))
+        job = pending[0]
+        self._unqueue(job)
+        if session in sessions:
+            sessions.move_to_end(session)
+        return job
+
+    def _position(self, job: _Job) -> int:
+        """Сколько заданий будет запущено раньше job (без новых)."""
+        ahead = sum(
+            len(pending)
+            for priority, sessions in self._queued.items()
+            if priority > job.priority
+            for pending in sessions.values()
+        )
+        sessions = self._queued[job.priority]
+        rank = sessions[job.session].index(job)
+        before = True
+        for session, pending in sessions.items():
+            if session == job.session:
+                before = False
+                ahead += rank
+                continue
+            ahead += min(len(pending), rank + (1 if before else 0))
+        return ahead
+
+    # --- Публичный интерфейс ---
+
+    def submit(
+        self,
+        kind: str,
+        params: Dict,
+        session: str = "",
+        priority: int = PRIORITY_BATCH,
+    ) -> str:
+        """
+        Поставить задание в очередь; возвращает его id. Место в очереди
+        и в квоте сессии занимается до записи в БД, так что одновременные
+        submit не превышают лимитов.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        self.start()
+        session = session or ""
+        with self._lock:
+            if self._queued_count + self._reserved >= self.max_queued:
+                raise JobQueueFull("Job queue is full")
+            if self._session_active.get(session, 0) >= self.max_per_session:
+                raise JobQueueFull("Too many active jobs for this session")
+            self._reserved += 1
+            self._activate(session)
+        job = _Job(
+            uuid.uuid4().hex,
+            session,
+            kind,
+            dict(params),
+            int(priority),
+            time.time(),
+        )
+        job.trace = tracing.current()
+        try:
+            storage.job_insert(
+                job.id,
+                job.session,
+                job.kind,
+                job.params,
+                job.priority,
+                job.created_at,
+            )
+        except BaseException:
+            with self._lock:
+                self._reserved -= 1
+                self._deactivate(session)
+            raise
+        with self._lock:
+            self._reserved -= 1
+            self._enqueue(job)
+            self._touch_queued()
+        llm_adapter.call_soon(self._wakeup.set)
+        return job.id
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Отменить задание: из очереди — сразу, выполняющееся — прервать.
+        False, если задания нет или оно уже завершено.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.cancel_requested:
+                return False
+            job.cancel_requested = True
+            task = job.task
+            if job.status == "queued":
+                self._unqueue(job)
+                self._deactivate(job.session)
+                del self._jobs[job_id]
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                self._touch_queued()
+        if job.status == "cancelled":
+            storage.job_update(
+                job_id, status="cancelled", finished_at=job.finished_at
+            )
+            JOBS_FINISHED.inc(kind=job.kind, status="cancelled")
+            self._publish(job)
+        elif task is not None:
+            llm_adapter.call_soon(task.cancel)
+        return True
+
+    def cancel_session(self, session: str) -> int:
+        """Отменить все незавершённые задания сессии; возвращает число."""
+        with self._lock:
+            ids = [j.id for j in self._jobs.values() if j.session == session]
+        return sum(self.cancel(job_id) for job_id in ids)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Состояние задания (из памяти или, если завершено, из БД)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return self._snapshot(job)
+        row = storage.job_get(job_id)
+        if row is None:
+            return None
+        row.pop("attempts", None)
+        result = row["result"] or {}
+        return dict(row, position=None, partial=result.get("prompt", ""))
+
+    async def watch(self, job_id: str) -> AsyncIterator[Dict]:
+        """
+        Состояния задания по мере изменения (статус, позиция в очереди,
+        промежуточный текст); последнее — завершённое. Промежуточные
+        состояния могут пропускаться, если потребитель не успевает.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.watchers.append((loop, event))
+        if job is None:
+            state = await asyncio.to_thread(self.get, job_id)
+            if state is not None:
+                yield state
+            return
+        seen = -1
+        try:
+            while True:
+                event.clear()
+                with self._lock:
+                    version = job.version
+                    state = self._snapshot(job)
+                if version != seen:
+                    seen = version
+                    yield state
+                if state["status"] in FINAL_STATUSES:
+                    return
+                await event.wait()
+        finally:
+            with self._lock:
+                job.watchers.remove((loop, event))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "queued": self._queued_count,
+                "running": self._running,
+                "workers": self.workers,
+                "sessions": len(self._session_queued),
+            }
+
+    # --- Выполнение ---
+
+    def _snapshot(self, job: _Job) -> Dict:
+        position = self._position(job) if job.status == "queued" else None
+        return _snapshot(job, position)
+
+    def _publish(self, job: _Job, partial: Optional[str] = None) -> None:
+        with self._lock:
+            if partial is not None:
+                job.partial = partial
+            job.version += 1
+            watchers = list(job.watchers)
+        for loop, event in watchers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # loop наблюдателя уже закрыт
+
+    def _touch_queued(self) -> None:
+        """Позиции в очереди изменились — разбудить наблюдателей (lock)."""
+        for job in self._jobs.values():
+            if job.status == "queued" and job.watchers:
+                job.version += 1
+                for loop, event in job.watchers:
+                    try:
+                        loop.call_soon_threadsafe(event.set)
+                    except RuntimeError:
+                        pass
+
+    async def _worker(self) -> None:
+        while True:
+            with self._lock:
+                job = self._next()
+                if job is not None:
+                    job.status = "running"
+                    job.started_at = time.time()
+                    self._running += 1
+                    self._touch_queued()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                with tracing.span(
+                    "job.run", parent=job.trace, job=job.id, kind=job.kind
+                ) as span:
+                    await self._run(job)
+                    span.set(status=job.status)
+            except Exception as e:
+                print(f"Warning: job {job.id} bookkeeping failed: {e}")
+
+    async def _run(self, job: _Job) -> None:
+        JOB_WAIT_SECONDS.observe(
+            job.started_at - job.created_at, kind=job.kind
+        )
+        tracing.record(
+            "job.queue_wait", job.created_at, job.started_at - job.created_at
+        )
+        self._publish(job)
+        await asyncio.to_thread(storage.job_start, job.id, job.started_at)
+        runner = KINDS.get(job.kind)
+        if runner is None:
+            task = asyncio.ensure_future(_unknown_kind(job.kind))
+        else:
+            task = asyncio.ensure_future(
+                runner(job.params, lambda text: self._publish(job, text))
+            )
+        with self._lock:
+            job.task = task
+            if job.cancel_requested:
+                task.cancel()
+        await asyncio.wait([task])
+
+        result = error = None
+        if task.cancelled():
+            status = "cancelled"
+        elif task.exception() is not None:
+            status, error = "failed", str(task.exception())
+        else:
+            status, result = "done", task.result()
+        finished_at = time.time()
+        try:
+            await asyncio.to_thread(
+                storage.job_update,
+                job.id,
+                status=status,
+                result=result,
+                error=error,
+                finished_at=finished_at,
+            )
+        finally:
+            with self._lock:
+                job.status = status
+                job.result = result
+                job.error = error
+                job.finished_at = finished_at
+                job.task = None
+                self._jobs.pop(job.id, None)
+                self._deactivate(job.session)
+                self._running -= 1
+            JOBS_FINISHED.inc(kind=job.kind, status=status)
+            JOB_RUN_SECONDS.observe(
+                finished_at - job.started_at, kind=job.kind, status=status
+            )
+            self._publish(job)
+
+
+async def _unknown_kind(kind: str):
+    raise ValueError(f"Unknown job kind: {kind}")
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    """Вернуть общую очередь (создаётся и запускается лениво)."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+            metrics.REGISTRY.collector(
+                "jobs_queued",
+                "Background jobs waiting in the queue",
+                lambda: _queue.stats()["queued"],
+            )
+            metrics.REGISTRY.collector(
+                "jobs_running",
+                "Background jobs being executed",
+                lambda: _queue.stats()["running"],
+            )
+        queue = _queue
+    queue.start()
+    return queue
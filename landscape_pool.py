@@ -0,0 +1,178 @@
+import time
+import asyncio
+import threading
+from typing import Dict, List, Optional
+
+import llm_adapter
+import metrics
+import storage
+from settings import get_settings
+
+# Идея для кнопки «Случайный пейзаж»
+LANDSCAPE_IDEA = "A detailed and imaginative landscape of your choice."
+
+# Пауза перед новой попыткой, если пополнение не удалось (сек.)
+POOL_RETRY_DELAY = 60.0
+
+
+def bands() -> List[float]:
+    """Полосы температуры, которые даёт слайдер (см. slider_to_temp)."""
+    return sorted({llm_adapter.slider_to_temp(s) for s in range(11)})
+
+
+def band_slider(band: float) -> int:
+    """Значение слайдера, соответствующее полосе (для запроса к LLM)."""
+    for s in range(11):
+        if llm_adapter.slider_to_temp(s) == band:
+            return s
+    raise ValueError(f"Unknown temperature band: {band}")
+
+
+class LandscapePool:
+    """
+    Пул готовых промптов для кнопки «Случайный пейзаж»: по size штук
+    на каждую полосу температуры, хранится в таблице landscape_pool
+    (переживает перезапуск). pop() забирает промпт мгновенно; когда в
+    полосе остаётся не больше low_water, на loop адаптера
+    запускается фоновое пополнение. Пополнение идёт по одному запросу и
+    уступает лимитер пользовательским запросам: пока кто-то ждёт в
+    очереди лимитера или заняты почти все слоты, оно не начинает новый
+    запрос.
+    """
+
+    def __init__(
+        self,
+        size: Optional[int] = None,
+        low_water: Optional[int] = None,
+        max_age: Optional[float] = None,
+        refill_interval: Optional[float] = None,
+    ):
+        # Не заданные параметры — из настроек LANDSCAPE_POOL_*
+        s = get_settings()
+        self.size = s.landscape_pool_size if size is None else size
+        if low_water is None:
+            low_water = s.landscape_pool_low_water
+        self.low_water = min(low_water, self.size)
+        self.max_age = s.landscape_pool_max_age if max_age is None else max_age
+        self.refill_interval = (
+            s.landscape_pool_refill_interval
+            if refill_interval is None
+            else refill_interval
+        )
+        self._refilling = False
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "generated": 0, "failed": 0}
+
+    def pop(self, slider: int) -> Optional[Dict]:
+        """Забрать готовый промпт для slider (None — пул полосы пуст)."""
+        band = llm_adapter.slider_to_temp(slider)
+        row = storage.pool_pop(band, max_age=self.max_age)
+        with self._lock:
+            self._stats["hits" if row else "misses"] += 1
+        self.ensure_refill()
+        if row is None:
+            return None
+        return {
+            "prompt": row["prompt"],
+            "finish_reason": row["finish_reason"],
+            "llm_raw_response": row["llm_raw_response"],
+        }
+
+    def _needs_refill(self, counts: Dict[float, int]) -> bool:
+        return any(counts.get(b, 0) <= self.low_water for b in bands())
+
+    def ensure_refill(self) -> None:
+        """Запустить фоновое пополнение, если какая-то полоса на исходе."""
+        with self._lock:
+            if self._refilling or time.monotonic() < self._retry_at:
+                return
+            if not self._needs_refill(storage.pool_counts()):
+                return
+            self._refilling = True
+        future = llm_adapter.submit_background(self._refill())
+        future.add_done_callback(self._refill_done)
+
+    def _refill_done(self, future) -> None:
+        with self._lock:
+            self._refilling = False
+        if not future.cancelled() and future.exception() is not None:
+            print(
+                "Warning: landscape pool refill failed: "
+                f"{future.exception()}"
+            )
+
+    async def _wait_for_capacity(self) -> None:
+        """Не занимать лимитер, пока есть пользовательские запросы."""
+        limiter = llm_adapter.get_limiter()
+        while limiter.waiting > 0 or (
+            limiter.in_flight >= limiter.max_in_flight - 1
+            and limiter.max_in_flight > 1
+        ):
+            await asyncio.sleep(self.refill_interval or 0.5)
+
+    async def _refill(self) -> None:
+        """Пополнить полосы до size; самые пустые — первыми."""
+        failures = 0
+        while True:
+            counts = await asyncio.to_thread(storage.pool_counts)
+            missing = {
+                b: self.size - counts.get(b, 0)
+                for b in bands()
+                if counts.get(b, 0) < self.size
+            }
+            if not missing:
+                return
+            band = max(missing, key=missing.get)
+            await self._wait_for_capacity()
+            variants = await llm_adapter.expand_prompt_async(
+                LANDSCAPE_IDEA,
+                band_slider(band),
+                use_cache=False,
+            )
+            added = await asyncio.to_thread(
+                storage.pool_push, band, variants or []
+            )
+            with self._lock:
+                self._stats["generated" if added else "failed"] += 1
+            if not added:
+                # LLM недоступен — не долбим его, пополним при следующем pop
+                failures += 1
+                if failures >= 3:
+                    with self._lock:
+                        self._retry_at = time.monotonic() + POOL_RETRY_DELAY
+                    return
+            await asyncio.sleep(self.refill_interval)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["refilling"] = self._refilling
+        stats["sizes"] = storage.pool_counts()
+        return stats
+
+
+_pool: Optional[LandscapePool] = None
+_pool_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    """Включён ли пул (LANDSCAPE_POOL)."""
+    return get_settings().landscape_pool
+
+
+def get_pool() -> LandscapePool:
+    """Вернуть общий пул (создаётся лениво)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = LandscapePool()
+            metrics.REGISTRY.collector(
+                "landscape_pool_size",
+                "Pre-generated landscape prompts by temperature band",
+                lambda: {
+                    (("band", band),): count
+                    for band, count in storage.pool_counts().items()
+                },
+            )
+        return _pool
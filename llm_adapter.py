@@ -1,18 +1,103 @@
-import os
-import requests
+import json
 import time
-from dotenv import load_dotenv
-from typing import List, Dict
+import queue
+import atexit
+import asyncio
+import threading
+import httpx
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from rate_limiter import RateLimiter, RateLimitExceeded, parse_retry_after
+from coalesce import SingleFlight
+from response_cache import ResponseCache, make_key, normalize_idea
+from router import Endpoint, Router, load_endpoints
+from token_budget import CompletionStats, TokenBudget, TokenBudgetExceeded
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    describe,
+    is_retryable,
+)
+import events
+import metrics
+import tracing
+from settings import get_settings
 
-load_dotenv()
+# --- Метрики ---
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    "llm_expand_duration_seconds",
+    "Duration of expand_prompt calls (end to end)",
+    ("mode", "outcome"),
+)
+PHASE_SECONDS = metrics.REGISTRY.histogram(
+    "llm_phase_duration_seconds",
+    "Time spent in each phase of an upstream LLM call",
+    ("phase",),
+)
+UPSTREAM_REQUESTS = metrics.REGISTRY.counter(
+    "llm_upstream_requests",
+    "Upstream HTTP requests by endpoint and status",
+    ("endpoint", "status"),
+)
+TOKENS = metrics.REGISTRY.counter(
+    "llm_tokens",
+    "Tokens reported in the upstream usage field",
+    ("endpoint", "kind"),
+)
+COST = metrics.REGISTRY.counter(
+    "llm_cost",
+    "Estimated upstream cost (LLM_PRICE_*_PER_1K)",
+    ("endpoint",),
+)
+FINISH_REASONS = metrics.REGISTRY.counter(
+    "llm_finish_reason",
+    "Completions by finish_reason",
+    ("reason",),
+)
+TRUNCATED = metrics.REGISTRY.counter(
+    "llm_truncated",
+    "Completions truncated by the token limit (finish_reason=length)",
+)
+CONTINUATIONS = metrics.REGISTRY.counter(
+    "llm_continuations",
+    "Continuation requests issued for truncated completions",
+)
+BUDGET_REJECTIONS = metrics.REGISTRY.counter(
+    "llm_budget_rejections",
+    "Requests rejected by the daily token budget",
+)
 
-LLM_API_URL = os.getenv("LLM_API_URL", "")
-LLM_API_KEY = os.getenv("LLM_API_KEY", "")
-MODEL = os.getenv("MODEL", "")
+PROMPT_TEMPLATE = (
+    "Expand the following idea into three different,\n"
+    "descriptive, long, real-language style prompts\n"
+    "for Stable Diffusion (Flux model): {idea}.\n"
+    "Only offer the three prompts in your response,\n"
+    "without any other text."
+)
 
-# Rate limiting
-MIN_CALL_INTERVAL = float(os.getenv("MIN_CALL_INTERVAL", "2.0"))
-_last_call_time = 0.0
+# Запрос-продолжение урезанного ответа (после него в messages — уже
+# полученный текст от имени assistant)
+CONTINUE_PROMPT = (
+    "Continue exactly where your previous message stopped, "
+    "without repeating any of it."
+)
+
+# Фоновый event loop, на котором живёт пул соединений. Синхронные
+# вызовы и вызовы из чужих loop-ов переадресуются сюда, чтобы все
+# запросы шли через один набор keep-alive соединений.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+_client: Optional[httpx.AsyncClient] = None
+_client_options: Dict = {}
+_limiter: Optional[RateLimiter] = None
+_cache: Optional[ResponseCache] = None
+_flights: Optional[SingleFlight] = None
+_router: Optional[Router] = None
+_breakers: Dict[Endpoint, CircuitBreaker] = {}
+_completion_stats: Optional[CompletionStats] = None
+_budget: Optional[TokenBudget] = None
 
 
 def slider_to_temp(slider: int) -> float:
@@ -26,95 +111,1304 @@ def slider_to_temp(slider: int) -> float:
     return 1.0
 
 
-def expand_prompt(idea: str, slider: int = 5) -> List[Dict]:
-    """Запрос к LLM для расширения идеи в несколько вариантов промптов."""
-    global _last_call_time
+def _ensure_loop() -> asyncio.AbstractEventLoop:
+    """Запустить (однократно) фоновый поток с event loop адаптера."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is not None and _loop_thread and _loop_thread.is_alive():
+            return _loop
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(
+            target=loop.run_forever, name="llm-adapter-loop", daemon=True
+        )
+        thread.start()
+        _loop, _loop_thread = loop, thread
+        return loop
 
-    # Проверка входящей идеи
-    if not idea or not idea.strip():
-        print("Warning: Empty or whitespace-only idea provided")
-        return []
 
-    # Rate limiting
-    current_time = time.time()
-    time_since_last_call = current_time - _last_call_time
-    if time_since_last_call < MIN_CALL_INTERVAL:
-        wait_time = MIN_CALL_INTERVAL - time_since_last_call
-        time.sleep(wait_time)
-    _last_call_time = time.time()
+def _on_adapter_loop() -> bool:
+    try:
+        return asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        return False
 
-    temperature = slider_to_temp(slider)
-    idea = idea.strip()
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {
-                "role": "user",
-                "content": (
-                    f"Expand the following idea into three different,\n"
-                    f"descriptive, long, real-language style prompts\n"
-                    f"for Stable Diffusion (Flux model): {idea}.\n"
-                    f"Only offer the three prompts in your response,\n"
-                    f"without any other text."
-                ),
-            }
-        ],
-        "temperature": temperature,
-        "max_tokens": 1000,
+
+def _submit(coro):
+    """Запланировать корутину на loop адаптера (concurrent Future)."""
+    return asyncio.run_coroutine_threadsafe(coro, _ensure_loop())
+
+
+def submit_background(coro):
+    """
+    Запустить фоновую задачу на loop адаптера (например, пополнение
+    пула); возвращает concurrent.futures.Future. Задача не входит в
+    трассу вызывающего.
+    """
+    return _submit(_detached(coro))
+
+
+async def _detached(coro):
+    tracing.attach(None)
+    return await coro
+
+
+def call_soon(fn, *args) -> None:
+    """Вызвать fn(*args) на loop адаптера (из любого потока)."""
+    _ensure_loop().call_soon_threadsafe(fn, *args)
+
+
+async def _call_on_loop(coro):
+    """Выполнить корутину на loop адаптера из любого другого loop."""
+    if _on_adapter_loop():
+        return await coro
+    return await asyncio.wrap_future(_submit(coro))
+
+
+def configure_client(
+    max_connections: Optional[int] = None,
+    max_keepalive: Optional[int] = None,
+    keepalive_expiry: Optional[float] = None,
+    connect_timeout: Optional[float] = None,
+    request_timeout: Optional[float] = None,
+    http2: Optional[bool] = None,
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+) -> None:
+    """
+    Переопределить параметры пула/таймаутов (например, для тестов против
+    локального фейкового OpenAI-совместимого сервера). Текущий клиент
+    закрывается, новый создаётся при следующем запросе.
+    """
+    options = {
+        "max_connections": max_connections,
+        "max_keepalive": max_keepalive,
+        "keepalive_expiry": keepalive_expiry,
+        "connect_timeout": connect_timeout,
+        "request_timeout": request_timeout,
+        "http2": http2,
+        "transport": transport,
     }
+    _client_options.clear()
+    _client_options.update(
+        {k: v for k, v in options.items() if v is not None}
+    )
+    close_client()
+
+
+def _build_client() -> httpx.AsyncClient:
+    """Создать AsyncClient с keep-alive пулом по текущим настройкам."""
+    opts = _client_options
+    s = get_settings()
+    limits = httpx.Limits(
+        max_connections=opts.get("max_connections", s.pool_max_connections),
+        max_keepalive_connections=opts.get(
+            "max_keepalive", s.pool_max_keepalive
+        ),
+        keepalive_expiry=opts.get(
+            "keepalive_expiry", s.pool_keepalive_expiry
+        ),
+    )
+    timeout = httpx.Timeout(
+        opts.get("request_timeout", s.request_timeout),
+        connect=opts.get("connect_timeout", s.connect_timeout),
+    )
+    return httpx.AsyncClient(
+        http2=opts.get("http2", s.http2),
+        limits=limits,
+        timeout=timeout,
+        transport=opts.get("transport"),
+    )
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Вернуть общий клиент (создаётся лениво на loop адаптера)."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+
+def close_client() -> None:
+    """Закрыть пул соединений (например, при завершении приложения)."""
+    global _client
+    client, _client = _client, None
+    if client is None or client.is_closed:
+        return
+    if _loop is not None and _loop.is_running() and not _on_adapter_loop():
+        _submit(client.aclose()).result(timeout=5)
+    elif _on_adapter_loop():
+        _loop.create_task(client.aclose())
+
+
+atexit.register(close_client)
+
+
+def get_limiter() -> RateLimiter:
+    """Вернуть общий лимитер запросов к LLM (создаётся лениво)."""
+    if _limiter is None:
+        configure_limiter()
+    return _limiter
+
+
+def configure_limiter(
+    rate: Optional[float] = None,
+    burst: Optional[int] = None,
+    max_in_flight: Optional[int] = None,
+    max_queue: Optional[int] = None,
+    queue_timeout: Optional[float] = None,
+) -> RateLimiter:
+    """
+    Пересоздать лимитер с другими параметрами (например, для нагрузочных
+    тестов против локального сервера). Не заданные — из настроек.
+    """
+    global _limiter
+    s = get_settings()
+
+    def pick(value, default):
+        return default if value is None else value
+
+    _limiter = RateLimiter(
+        rate=pick(rate, s.rate_limit_rps),
+        burst=pick(burst, s.rate_limit_burst),
+        max_in_flight=pick(max_in_flight, s.max_in_flight),
+        max_queue=pick(max_queue, s.max_queue),
+        queue_timeout=pick(queue_timeout, s.queue_timeout),
+    )
+    return _limiter
+
+
+def get_router() -> Router:
+    """Вернуть роутер endpoint-ов (создаётся лениво из настроек)."""
+    if _router is None:
+        s = get_settings()
+        configure_router(
+            load_endpoints(
+                s.llm_endpoints, s.llm_api_url, s.model, s.llm_api_key
+            )
+        )
+    return _router
+
+
+def configure_router(
+    endpoints: List[Endpoint], hedge: Optional[bool] = None
+) -> Router:
+    """Задать список endpoint-ов программно (статистика сбрасывается)."""
+    global _router
+    s = get_settings()
+    _router = Router(
+        endpoints,
+        hedge=s.hedge_enabled if hedge is None else hedge,
+        hedge_min_delay=s.hedge_min_delay,
+        hedge_default_delay=s.hedge_default_delay,
+    )
+    return _router
+
+
+def endpoint_stats() -> List[Dict]:
+    """Живая статистика по endpoint-ам (задержки, ошибки, нагрузка)."""
+    return get_router().stats()
+
+
+def get_breaker(endpoint: Endpoint) -> CircuitBreaker:
+    """Circuit breaker endpoint-а (создаётся при первом обращении)."""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        s = get_settings()
+        breaker = CircuitBreaker(
+            endpoint.label,
+            failure_threshold=s.breaker_failures,
+            recovery_timeout=s.breaker_recovery,
+        )
+        _breakers[endpoint] = breaker
+    return breaker
+
+
+def breaker_stats() -> List[Dict]:
+    """Состояние circuit breaker-ов по endpoint-ам."""
+    return [get_breaker(e).snapshot() for e in get_router().endpoints]
+
+
+def get_retry_policy() -> RetryPolicy:
+    s = get_settings()
+    return RetryPolicy(
+        max_attempts=s.retry_attempts,
+        base_delay=s.retry_base_delay,
+        max_delay=s.retry_max_delay,
+    )
+
+
+def _choose_endpoint(exclude=(), required: bool = True):
+    """
+    Выбрать endpoint, пропуская endpoint-ы с разомкнутой цепью. Если
+    доступных нет: required=True — CircuitOpenError, иначе None.
+    """
+    router = get_router()
+    skip = set(exclude)
+    skip.update(e for e in router.endpoints if get_breaker(e).is_open())
+    endpoint = router.choose(exclude=skip)
+    if endpoint is None and required:
+        raise CircuitOpenError("All LLM endpoints are unavailable")
+    return endpoint
+
+
+async def _retry_sleep(attempt: int, error: BaseException) -> None:
+    """Пауза перед повтором (экспоненциальная, с jitter) + событие."""
+    delay = get_retry_policy().delay(attempt)
+    events.emit(
+        "llm_retry",
+        attempt=attempt,
+        delay=round(delay, 3),
+        error=describe(error),
+    )
+    await asyncio.sleep(delay)
+
+
+def get_cache() -> ResponseCache:
+    """Вернуть общий кэш ответов LLM (создаётся лениво)."""
+    global _cache
+    if _cache is None:
+        s = get_settings()
+        _cache = ResponseCache(max_items=s.cache_max_items, ttl=s.cache_ttl)
+    return _cache
+
+
+def cache_stats() -> Dict[str, float]:
+    """Счётчики попаданий/промахов кэша ответов."""
+    return get_cache().stats()
+
+
+def cache_key(idea: str, temperature: float) -> str:
+    """Ключ кэша: нормализованная идея, температура, модель, шаблон."""
+    return make_key(
+        idea=normalize_idea(idea),
+        temperature=temperature,
+        model=get_router().models_key(),
+        template=PROMPT_TEMPLATE,
+    )
+
+
+def _use_cache(temperature: float, use_cache: Optional[bool]) -> bool:
+    s = get_settings()
+    if not s.cache_enabled:
+        return False
+    if use_cache is None:
+        return temperature <= s.cache_max_temperature
+    return use_cache
+
+
+def get_completion_stats() -> CompletionStats:
+    """Статистика длин ответов для адаптивного max_tokens (лениво)."""
+    global _completion_stats
+    if _completion_stats is None:
+        s = get_settings()
+        _completion_stats = CompletionStats(
+            percentile=s.llm_max_tokens_percentile,
+            headroom=s.llm_max_tokens_headroom,
+            min_tokens=s.llm_min_tokens,
+            max_tokens=s.llm_max_tokens,
+            min_samples=s.llm_max_tokens_min_samples,
+        )
+    return _completion_stats
+
+
+def _max_tokens(model: str, temperature: float) -> int:
+    s = get_settings()
+    if not s.llm_adaptive_max_tokens:
+        return s.llm_max_tokens
+    return get_completion_stats().max_tokens(model, temperature)
+
+
+def get_token_budget() -> TokenBudget:
+    """Дневные бюджеты токенов (создаются лениво)."""
+    if _budget is None:
+        configure_token_budget()
+    return _budget
+
+
+def configure_token_budget(
+    daily: Optional[int] = None, user_daily: Optional[int] = None
+) -> TokenBudget:
+    """Пересоздать бюджеты; не заданные лимиты — из настроек."""
+    global _budget
+    s = get_settings()
+    _budget = TokenBudget(
+        daily=s.token_budget_daily if daily is None else daily,
+        user_daily=(
+            s.token_budget_user_daily if user_daily is None else user_daily
+        ),
+    )
+    return _budget
+
+
+def get_flights() -> SingleFlight:
+    """Вернуть общий single-flight (только на loop адаптера)."""
+    global _flights
+    if _flights is None:
+        _flights = SingleFlight()
+    return _flights
+
+
+def coalesce_stats() -> Dict[str, int]:
+    """Счётчики объединения запросов: лидеры, присоединившиеся, отмены."""
+    return get_flights().stats()
+
+
+def _flight_key(
+    payload: Dict, cache_key_: Optional[str], user: Optional[str] = None
+) -> str:
+    """
+    Ключ объединения: payload запроса, набор моделей и ключ кэша. При
+    включённом бюджете токенов — ещё и пользователь: вызов оплачивает
+    бюджет лидера, поэтому запросы разных пользователей не объединяются.
+    """
+    parts = {}
+    if get_token_budget().enabled:
+        parts["user"] = user or ""
+    return make_key(
+        payload=payload,
+        model=get_router().models_key(),
+        cache=cache_key_,
+        **parts,
+    )
+
+
+def _register_collectors() -> None:
+    """
+    Текущие значения кэша, лимитера, single-flight, breaker-ов,
+    адаптивного max_tokens и бюджета токенов.
+    """
+    registry = metrics.REGISTRY
+
+    def cache_counters():
+        stats = cache_stats() if _cache is not None else {}
+        return {
+            (("result", name),): stats.get(name, 0)
+            for name in ("memory_hits", "disk_hits", "misses")
+        }
+
+    registry.collector(
+        "llm_cache_lookups",
+        "Response cache lookups by result",
+        cache_counters,
+    )
+    registry.collector(
+        "llm_cache_hit_ratio",
+        "Response cache hit ratio since start",
+        lambda: cache_stats()["hit_rate"] if _cache is not None else 0.0,
+    )
+    registry.collector(
+        "llm_limiter_waiting",
+        "Requests waiting in the rate limiter queue",
+        lambda: _limiter.waiting if _limiter is not None else 0,
+    )
+    registry.collector(
+        "llm_limiter_in_flight",
+        "Upstream requests in flight",
+        lambda: _limiter.in_flight if _limiter is not None else 0,
+    )
+    registry.collector(
+        "llm_coalesced_requests",
+        "Single-flight counters (leaders, followers, cancelled)",
+        lambda: {
+            (("kind", k),): v
+            for k, v in (
+                _flights.stats() if _flights is not None else {}
+            ).items()
+            if k != "in_flight"
+        },
+    )
+    registry.collector(
+        "llm_max_tokens",
+        "Adaptive max_tokens by model and temperature",
+        lambda: {
+            (
+                ("model", st["model"]),
+                ("temperature", str(st["temperature"])),
+            ): st["max_tokens"]
+            for st in (
+                _completion_stats.stats()
+                if _completion_stats is not None
+                else []
+            )
+        },
+    )
+    registry.collector(
+        "llm_budget_used_tokens",
+        "Tokens used today against the daily budget",
+        lambda: (
+            _budget.usage()["used"]
+            if _budget is not None and _budget.enabled
+            else 0
+        ),
+    )
+    states = {
+        CircuitBreaker.CLOSED: 0,
+        CircuitBreaker.HALF_OPEN: 1,
+        CircuitBreaker.OPEN: 2,
+    }
+    registry.collector(
+        "llm_circuit_state",
+        "Circuit breaker state (0 closed, 1 half-open, 2 open)",
+        lambda: {
+            (("breaker", b["breaker"]),): states.get(b["state"], 0)
+            for b in breaker_stats()
+        },
+    )
+
+
+_register_collectors()
+
+
+def build_messages(idea: str) -> List[Dict]:
+    """Сформировать messages для chat/completions по шаблону."""
+    return [{"role": "user", "content": PROMPT_TEMPLATE.format(idea=idea)}]
+
+
+def _parse_response(result, raw: Optional[str] = None) -> List[Dict]:
+    """
+    Разобрать JSON-ответ chat/completions в список вариантов. Вариант
+    содержит prompt, finish_reason и исходный ответ (llm_raw_response).
+    """
+    if isinstance(result, dict) and "choices" in result:
+        choices = result["choices"]
+        if choices and len(choices) > 0:
+            message = choices[0].get("message", {})
+            content = message.get("content", "")
+
+            # Урезанный ответ дописывается в _complete_variant
+            finish_reason = choices[0].get("finish_reason", "")
+            content = content.strip() if content else ""
+            if content:
+                if raw is None:
+                    raw = json.dumps(result, ensure_ascii=False)
+                return [
+                    {
+                        "prompt": content,
+                        "finish_reason": finish_reason,
+                        "llm_raw_response": raw,
+                    }
+                ]
+            else:
+                print(
+                    f"Warning: Empty content in response.\n"
+                    f"Finish reason: {finish_reason}"
+                )
+                print(f"Response structure: {result}")
+                return []
+        else:
+            print(f"Warning: Empty choices array in response: {result}")
+            return []
+
+    if isinstance(result, list):
+        return result
+
+    # Блок для неожиданного формата ответа
+    print(f"Warning: Unexpected response format: {type(result)}")
+    print(f"Response: {result}")
+    return []
+
+
+@asynccontextmanager
+async def _chat_response(
+    payload: Dict, endpoint: Endpoint, stream: bool = False
+):
+    """
+    POST на endpoint через лимитер; слот in-flight удерживается, пока
+    открыт ответ (для stream — до конца чтения тела). На 429 лимитер
+    приостанавливается на Retry-After, и запрос повторяется (до
+    max_429_retries раз). Задержка до ответа учитывается в статистике
+    роутера.
+    """
     headers = {
-        "Authorization": f"Bearer {LLM_API_KEY}",
+        "Authorization": f"Bearer {endpoint.key}",
         "Content-Type": "application/json",
     }
-
-    try:
-        response = requests.post(
-            LLM_API_URL, json=payload, headers=headers, timeout=15
+    payload = dict(payload, model=endpoint.model)
+    if "max_tokens" not in payload:
+        payload["max_tokens"] = _max_tokens(
+            endpoint.model, payload.get("temperature", 0.0)
         )
+    limiter = get_limiter()
+    router = get_router()
+    breaker = get_breaker(endpoint)
+    client = _get_client()
+    attempt = 0
+    while True:
+        # Разомкнутая цепь отклоняет запрос сразу, без ожидания таймаута
+        breaker.before_call()
+        try:
+            queue_wait, token_wait = await limiter.acquire()
+        except BaseException:
+            breaker.on_cancel()
+            raise
+        PHASE_SECONDS.observe(queue_wait, phase="queue_wait")
+        PHASE_SECONDS.observe(token_wait, phase="rate_limit_wait")
+        if tracing.current() is not None:
+            now = time.time()
+            tracing.record(
+                "llm.queue_wait", now - queue_wait - token_wait, queue_wait
+            )
+            tracing.record("llm.rate_limit_wait", now - token_wait, token_wait)
+        router.started(endpoint)
+        started = time.monotonic()
+        latency, outcome, reason = None, "cancel", ""
+        try:
+            request = client.build_request(
+                "POST", endpoint.url, json=payload, headers=headers
+            )
+            with tracing.span(
+                "llm.http", endpoint=endpoint.label, attempt=attempt
+            ) as span:
+                trace = tracing.http_trace()
+                if trace is not None:
+                    request.extensions["trace"] = trace
+                response = await client.send(request, stream=stream)
+                span.set(status=response.status_code)
+            latency = time.monotonic() - started
+            status = response.status_code
+            PHASE_SECONDS.observe(
+                latency, phase="headers" if stream else "network"
+            )
+            UPSTREAM_REQUESTS.inc(endpoint=endpoint.label, status=status)
+            if status >= 500:
+                outcome, reason = "fail", f"HTTP {status}"
+            elif status != 429:
+                outcome = "ok"
+            if status != 429 or attempt >= get_settings().max_429_retries:
+                try:
+                    if stream and response.is_error:
+                        await response.aread()
+                    yield response
+                finally:
+                    await response.aclose()
+                return
+            await response.aclose()
+        except asyncio.CancelledError:
+            # Отменённый (например, проигравший hedge) запрос был как
+            # минимум настолько медленным — учитываем это как задержку.
+            if latency is None:
+                latency = time.monotonic() - started
+            raise
+        except Exception as e:
+            # Обрыв соединения посреди потока — тоже сбой upstream
+            if latency is None or isinstance(e, httpx.TransportError):
+                outcome, reason = "fail", describe(e)
+            if latency is None:
+                UPSTREAM_REQUESTS.inc(
+                    endpoint=endpoint.label, status=type(e).__name__
+                )
+            raise
+        finally:
+            router.finished(endpoint, latency, outcome != "fail")
+            if outcome == "ok":
+                breaker.on_success()
+            elif outcome == "fail":
+                breaker.on_failure(reason)
+            else:
+                breaker.on_cancel()
+            limiter.release()
+        attempt += 1
+        delay = parse_retry_after(response.headers.get("Retry-After"))
+        if delay is None:
+            delay = get_settings().default_retry_after
+        print(f"Warning: LLM rate limited (429), retrying in {delay:.1f}s")
+        limiter.defer(delay)
+
+
+def _record_usage(endpoint: Endpoint, usage) -> None:
+    """Учесть токены и стоимость из поля usage ответа."""
+    if not isinstance(usage, dict):
+        return
+    prompt = usage.get("prompt_tokens") or 0
+    completion = usage.get("completion_tokens") or 0
+    TOKENS.inc(prompt, endpoint=endpoint.label, kind="prompt")
+    TOKENS.inc(completion, endpoint=endpoint.label, kind="completion")
+    s = get_settings()
+    cost = (
+        prompt * s.price_prompt_per_1k
+        + completion * s.price_completion_per_1k
+    ) / 1000
+    if cost:
+        COST.inc(cost, endpoint=endpoint.label)
+
+
+def _record_finish(finish_reason: str) -> None:
+    FINISH_REASONS.inc(reason=finish_reason or "unknown")
+    if finish_reason == "length":
+        TRUNCATED.inc()
+
+
+async def _attempt(payload: Dict, endpoint: Endpoint):
+    """
+    Один (не потоковый) запрос к endpoint-у: (JSON, текст ответа,
+    endpoint).
+    """
+    async with _chat_response(payload, endpoint) as response:
         response.raise_for_status()
         result = response.json()
+        if isinstance(result, dict):
+            _record_usage(endpoint, result.get("usage"))
+        return result, response.text, endpoint
 
-        if isinstance(result, dict) and "choices" in result:
-            choices = result["choices"]
-            if choices and len(choices) > 0:
-                message = choices[0].get("message", {})
-                content = message.get("content", "")
-
-                # Проверка на урезанный ответ
-                finish_reason = choices[0].get("finish_reason", "")
-                if finish_reason == "length":
-                    print("Warning: Response was truncated due to token limit")
-
-                content = content.strip() if content else ""
-                if content:
-                    return [{"prompt": content}]
-                else:
-                    print(
-                        f"Warning: Empty content in response.\n"
-                        f"Finish reason: {finish_reason}"
-                    )
-                    print(f"Response structure: {result}")
-                    return []
-            else:
-                print(f"Warning: Empty choices array in response: {result}")
-                return []
 
-        if isinstance(result, list):
-            return result
+async def _hedged_request(payload: Dict):
+    """
+    Запрос с hedging: если основной endpoint не ответил за свой текущий
+    p95, отправляется резервный запрос на другой endpoint; берётся первый
+    успешный ответ, проигравший запрос отменяется.
+    """
+    router = get_router()
+    primary = _choose_endpoint()
+    if not router.hedge:
+        return await _attempt(payload, primary)
 
-        # Блок для неожиданного формата ответа
-        print(f"Warning: Unexpected response format: {type(result)}")
-        print(f"Response: {result}")
-        return []
-    except requests.exceptions.RequestException as e:
+    tasks = {asyncio.ensure_future(_attempt(payload, primary))}
+    try:
+        done, _ = await asyncio.wait(
+            tasks, timeout=router.hedge_delay(primary)
+        )
+        if not done:
+            backup = _choose_endpoint(exclude=[primary], required=False)
+            if backup is not None:
+                tasks.add(asyncio.ensure_future(_attempt(payload, backup)))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for t in done:
+                if t.exception() is None:
+                    return t.result()
+                error = error or t.exception()
+        raise error
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+def _build_payload(idea: str, temperature: float, stream: bool = False):
+    # max_tokens подставляется под выбранный endpoint (_chat_response)
+    payload = {
+        "messages": build_messages(idea),
+        "temperature": temperature,
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+def _continuation_payload(payload: Dict, text: str) -> Dict:
+    """
+    Запрос-продолжение: прежние messages, полученный текст и просьба
+    продолжить; max_tokens — верхний предел.
+    """
+    messages = list(payload["messages"]) + [
+        {"role": "assistant", "content": text},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
+    return dict(
+        payload, messages=messages, max_tokens=get_settings().llm_max_tokens
+    )
+
+
+def _join_continuation(text: str, more: str) -> str:
+    """Склеить текст и продолжение (пробел — если его нет на стыке)."""
+    if not text or not more:
+        return text + more
+    if text[-1].isspace() or more[0].isspace() or more[0] in ",.;:!?)":
+        return text + more
+    return text + " " + more
+
+
+def _estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (около 4 символов на токен)."""
+    return len(text) // 4 + 1
+
+
+def _prompt_tokens(payload: Dict) -> int:
+    return sum(
+        _estimate_tokens(str(m.get("content", "")))
+        for m in payload.get("messages") or []
+    )
+
+
+def _completion_tokens(usage, text: str) -> int:
+    """completion_tokens из usage, без него — оценка по тексту."""
+    if isinstance(usage, dict) and usage.get("completion_tokens"):
+        return int(usage["completion_tokens"])
+    return _estimate_tokens(text) if text else 0
+
+
+def _used_tokens(payload: Dict, usage, text: str) -> int:
+    """Расход запроса для бюджета: usage или оценка prompt + ответ."""
+    if isinstance(usage, dict) and usage.get("total_tokens"):
+        return int(usage["total_tokens"])
+    return _prompt_tokens(payload) + _completion_tokens(usage, text)
+
+
+@asynccontextmanager
+async def _budgeted(payload: Dict, user: Optional[str]):
+    """
+    Резерв дневного бюджета на время запроса: максимальная стоимость
+    (оценка prompt + max_tokens; endpoint ещё не выбран — наибольший
+    max_tokens по моделям). Вызывающий записывает фактический расход в
+    spent["tokens"]; резерв заменяется им на выходе.
+    """
+    spent = {"tokens": 0}
+    budget = get_token_budget()
+    if not budget.enabled:
+        yield spent
+        return
+    max_tokens = payload.get("max_tokens") or max(
+        _max_tokens(e.model, payload.get("temperature", 0.0))
+        for e in get_router().endpoints
+    )
+    cost = _prompt_tokens(payload) + max_tokens
+    try:
+        reservation = await asyncio.to_thread(budget.reserve, user, cost)
+    except TokenBudgetExceeded:
+        BUDGET_REJECTIONS.inc()
+        raise
+    try:
+        yield spent
+    finally:
+        # Резерв снимается сразу (и при отмене), запись в БД — после
+        budget.release(reservation, spent["tokens"])
+        if spent["tokens"]:
+            await asyncio.to_thread(
+                budget.save, reservation, spent["tokens"]
+            )
+
+
+def _report_error(e: Exception) -> None:
+    """Вывести диагностику ошибки запроса к LLM."""
+    if isinstance(
+        e, (RateLimitExceeded, CircuitOpenError, TokenBudgetExceeded)
+    ):
+        print(f"Warning: {e}")
+    elif isinstance(e, httpx.HTTPError):
         print(f"Ошибка запроса к LLM: {e}")
-        if hasattr(e, "response") and e.response is not None:
+        if isinstance(e, httpx.HTTPStatusError):
             try:
                 error_detail = e.response.json()
                 print(f"Error details: {error_detail}")
             except Exception:
                 print(f"Error response text: {e.response.text}")
-        return []
-    except Exception as e:
+    else:
         print(f"Unexpected error in expand_prompt: {e}")
+
+
+def _trace_request(temperature=None, cacheable=None, **attrs) -> None:
+    """Атрибуты запроса в спане llm.expand/llm.stream (если трасса есть)."""
+    span = tracing.current()
+    if span is None:
+        return
+    if temperature is not None:
+        attrs.update(temperature=temperature, cacheable=cacheable)
+    span.set(**attrs)
+
+
+@tracing.traced("llm.expand")
+async def _expand_on_loop(
+    idea: str,
+    slider: int,
+    use_cache: Optional[bool] = None,
+    force_fresh: bool = False,
+    user: Optional[str] = None,
+) -> List[Dict]:
+    """Основная логика expand_prompt; выполняется на loop адаптера."""
+    started = time.perf_counter()
+    temperature = slider_to_temp(slider)
+    cacheable = _use_cache(temperature, use_cache)
+    key = cache_key(idea, temperature) if cacheable else None
+    _trace_request(temperature, cacheable)
+    if cacheable and not force_fresh:
+        cached = await asyncio.to_thread(get_cache().get, key)
+        if cached:
+            _trace_request(cache="hit")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started, mode="expand", outcome="cache"
+            )
+            return cached
+
+    async def fetch() -> List[Dict]:
+        variants = await _request_variants(idea, temperature, user)
+        if cacheable and variants:
+            await asyncio.to_thread(get_cache().put, key, variants)
+        return variants
+
+    if not get_settings().coalesce_enabled:
+        variants = await fetch()
+    else:
+        flight_key = _flight_key(
+            _build_payload(idea, temperature), key, user
+        )
+        variants = await get_flights().do(flight_key, fetch)
+        # Каждый ожидающий получает свою копию вариантов
+        variants = [dict(v) for v in variants]
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        mode="expand",
+        outcome="ok" if variants else "empty",
+    )
+    return variants
+
+
+async def _request_variants(
+    idea: str, temperature: float, user: Optional[str] = None
+) -> List[Dict]:
+    """
+    Запрос к LLM (через лимитер) и разбор ответа; урезанный ответ
+    дописывается продолжениями. Транзиентные ошибки повторяются с
+    экспоненциальной задержкой и jitter. Исчерпанный дневной бюджет —
+    TokenBudgetExceeded.
+    """
+    payload = _build_payload(idea, temperature)
+    max_attempts = get_retry_policy().max_attempts
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            result, raw, endpoint = await _budgeted_request(payload, user)
+            with PHASE_SECONDS.time(phase="parse"), tracing.span(
+                "llm.parse"
+            ):
+                variants = _parse_response(result, raw=raw)
+            break
+        except TokenBudgetExceeded:
+            raise
+        except Exception as e:
+            if attempt >= max_attempts or not is_retryable(e):
+                _report_error(e)
+                return []
+            await _retry_sleep(attempt, e)
+    if variants and isinstance(result, dict):
+        variants[0] = await _complete_variant(
+            payload, variants[0], result, endpoint, user
+        )
+    for v in variants:
+        if isinstance(v, dict):
+            _record_finish(v.get("finish_reason", ""))
+    return variants
+
+
+def _message(result) -> Tuple[str, str]:
+    """(content, finish_reason) первого варианта ответа chat/completions."""
+    choices = result.get("choices") if isinstance(result, dict) else None
+    if not choices:
+        return "", ""
+    message = choices[0].get("message") or {}
+    return message.get("content") or "", choices[0].get("finish_reason") or ""
+
+
+async def _budgeted_request(payload: Dict, user: Optional[str]):
+    """_hedged_request в пределах дневного бюджета токенов."""
+    async with _budgeted(payload, user) as spent:
+        result, raw, endpoint = await _hedged_request(payload)
+        if isinstance(result, dict):
+            spent["tokens"] = _used_tokens(
+                payload, result.get("usage"), _message(result)[0]
+            )
+        return result, raw, endpoint
+
+
+async def _complete_variant(
+    payload: Dict,
+    variant: Dict,
+    result: Dict,
+    endpoint: Endpoint,
+    user: Optional[str],
+) -> Dict:
+    """
+    Дописать урезанный (finish_reason=length) ответ запросами-
+    продолжениями (не больше llm_max_continuations) и учесть полную
+    длину ответа в статистике max_tokens. Исходные ответы всех запросов
+    сохраняются в llm_raw_response построчно.
+    """
+    text, finish_reason = _message(result)
+    completion = _completion_tokens(result.get("usage"), text)
+    raws = [variant.get("llm_raw_response", "")]
+    continuations = 0
+    while (
+        finish_reason == "length"
+        and continuations < get_settings().llm_max_continuations
+    ):
+        continuations += 1
+        CONTINUATIONS.inc()
+        request = _continuation_payload(payload, text.strip())
+        try:
+            more_result, raw, _ = await _budgeted_request(request, user)
+        except Exception as e:
+            # Продолжение не удалось — отдаём то, что уже получено
+            _report_error(e)
+            break
+        more, finish_reason = _message(more_result)
+        completion += _completion_tokens(more_result.get("usage"), more)
+        text = _join_continuation(text, more)
+        raws.append(raw)
+    if finish_reason == "length":
+        print("Warning: Response was truncated due to token limit")
+    get_completion_stats().observe(
+        endpoint.model, payload["temperature"], completion
+    )
+    if not continuations:
+        return variant
+    _trace_request(continuations=continuations)
+    return dict(
+        variant,
+        prompt=text.strip(),
+        finish_reason=finish_reason,
+        llm_raw_response="\n".join(raws),
+    )
+
+
+async def _iter_sse(response: httpx.Response) -> AsyncIterator[Dict]:
+    """Разобрать поток Server-Sent Events в JSON-события до [DONE]."""
+    data_lines: List[str] = []
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data_lines.append(line[5:].lstrip())
+            continue
+        if line or not data_lines:
+            # Комментарии (": keep-alive") и прочие поля SSE игнорируем
+            continue
+        data, data_lines = "\n".join(data_lines), []
+        if data == "[DONE]":
+            return
+        try:
+            yield json.loads(data)
+        except ValueError:
+            print(f"Warning: Malformed SSE chunk: {data[:200]}")
+    if data_lines and "\n".join(data_lines) != "[DONE]":
+        try:
+            yield json.loads("\n".join(data_lines))
+        except ValueError:
+            pass
+
+
+@tracing.traced("llm.stream")
+async def _stream_on_loop(
+    idea: str,
+    slider: int,
+    use_cache: Optional[bool] = None,
+    force_fresh: bool = False,
+    user: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    Потоковая генерация на loop адаптера: выдаёт накопленный текст после
+    каждого полученного фрагмента. Кэш работает так же, как в
+    _expand_on_loop (при попадании текст выдаётся целиком).
+    """
+    started = time.perf_counter()
+    temperature = slider_to_temp(slider)
+    cacheable = _use_cache(temperature, use_cache)
+    key = cache_key(idea, temperature) if cacheable else None
+    _trace_request(temperature, cacheable)
+    if cacheable and not force_fresh:
+        cached = await asyncio.to_thread(get_cache().get, key)
+        if cached:
+            _trace_request(cache="hit")
+            first = cached[0]
+            yield first.get("prompt", "") if isinstance(first, dict) else (
+                str(first)
+            )
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started, mode="stream", outcome="cache"
+            )
+            return
+
+    payload = _build_payload(idea, temperature, stream=True)
+    if not get_settings().coalesce_enabled:
+        partials = _stream_upstream(payload, key, user)
+    else:
+        partials = get_flights().stream(
+            _flight_key(payload, key, user),
+            lambda: _stream_upstream(payload, key, user),
+        )
+    outcome = "empty"
+    async for partial in partials:
+        outcome = "ok"
+        yield partial
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - started, mode="stream", outcome=outcome
+    )
+
+
+async def _stream_request(
+    request: Dict, endpoint: Endpoint, state: Dict
+) -> AsyncIterator[str]:
+    """
+    Один потоковый запрос: выдаёт фрагменты текста, usage и
+    finish_reason записывает в state.
+    """
+    async with _chat_response(request, endpoint, stream=True) as response:
+        response.raise_for_status()
+        body_started = time.perf_counter()
+        chunks = 0
+        async for event in _iter_sse(response):
+            if event.get("usage"):
+                state["usage"] = event["usage"]
+                _record_usage(endpoint, event["usage"])
+            choices = event.get("choices") or []
+            if not choices:
+                continue
+            delta = choices[0].get("delta") or {}
+            piece = delta.get("content") or ""
+            finish_reason = choices[0].get("finish_reason")
+            if finish_reason:
+                state["finish_reason"] = finish_reason
+            if piece:
+                chunks += 1
+                yield piece
+        body_seconds = time.perf_counter() - body_started
+        PHASE_SECONDS.observe(body_seconds, phase="stream_body")
+        tracing.record(
+            "llm.stream_body",
+            time.time() - body_seconds,
+            body_seconds,
+            chunks=chunks,
+        )
+
+
+async def _stream_upstream(
+    payload: Dict, key: Optional[str], user: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    Потоковый запрос к LLM с повторами до первого фрагмента; урезанный
+    ответ дописывается потоковыми запросами-продолжениями. Итоговый
+    текст сохраняется в кэш, если key задан.
+    """
+    parts: List[str] = []
+    finish_reason = ""
+    completion = 0
+    model = None
+    max_attempts = get_retry_policy().max_attempts
+    request = payload
+    continuations = 0
+    attempt = 0
+    while True:
+        attempt += 1
+        # Уже полученный текст: продолжение приклеивается к нему
+        base = "".join(parts)
+        received: List[str] = []
+        state = {"usage": None, "finish_reason": ""}
+        try:
+            endpoint = _choose_endpoint()
+            async with _budgeted(request, user) as spent, aclosing(
+                _stream_request(request, endpoint, state)
+            ) as pieces:
+                try:
+                    async for piece in pieces:
+                        if base and not received:
+                            piece = _join_continuation(base, piece)[
+                                len(base):
+                            ]
+                        received.append(piece)
+                        parts.append(piece)
+                        yield "".join(parts).lstrip()
+                finally:
+                    spent["tokens"] = _used_tokens(
+                        request, state["usage"], "".join(received)
+                    )
+        except Exception as e:
+            if continuations:
+                # Продолжение не удалось — отдаём то, что уже получено
+                _report_error(e)
+                break
+            if isinstance(e, TokenBudgetExceeded):
+                raise
+            # Повторяем, только если пользователь ещё ничего не получил
+            if parts or attempt >= max_attempts or not is_retryable(e):
+                _report_error(e)
+                return
+            await _retry_sleep(attempt, e)
+            continue
+        finish_reason = state["finish_reason"]
+        completion += _completion_tokens(state["usage"], "".join(received))
+        if model is None:
+            model = endpoint.model
+        if (
+            finish_reason != "length"
+            or continuations >= get_settings().llm_max_continuations
+        ):
+            break
+        continuations += 1
+        CONTINUATIONS.inc()
+        request = _continuation_payload(payload, "".join(parts).strip())
+        attempt = 0
+
+    # Проверка на урезанный ответ
+    _record_finish(finish_reason)
+    if finish_reason == "length":
+        print("Warning: Response was truncated due to token limit")
+    if model is not None:
+        get_completion_stats().observe(
+            model, payload["temperature"], completion
+        )
+    if continuations:
+        _trace_request(continuations=continuations)
+    content = "".join(parts).strip()
+    if not content:
+        print(
+            f"Warning: Empty content in response.\n"
+            f"Finish reason: {finish_reason}"
+        )
+        return
+    yield content
+    if key is not None:
+        variant = {"prompt": content, "finish_reason": finish_reason}
+        await asyncio.to_thread(get_cache().put, key, [variant])
+
+
+class _Raise:
+    """Обёртка исключения, передаваемого из loop адаптера потребителю."""
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+_DONE = object()
+
+
+def _iterate_sync(agen) -> Iterator:
+    """Итерировать async-генератор loop адаптера из синхронного кода."""
+    items: "queue.Queue" = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put(item)
+        except Exception as e:
+            items.put(_Raise(e))
+        finally:
+            items.put(_DONE)
+
+    future = _submit(pump())
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Raise):
+                raise item.exc
+            yield item
+    finally:
+        # Потребитель прервал итерацию — отменяем запрос к LLM
+        future.cancel()
+
+
+async def _iterate_async(agen) -> AsyncIterator:
+    """Итерировать async-генератор loop адаптера из другого event loop."""
+    if _on_adapter_loop():
+        async for item in agen:
+            yield item
+        return
+    caller = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+
+    def put(item):
+        try:
+            caller.call_soon_threadsafe(items.put_nowait, item)
+        except RuntimeError:
+            pass  # loop вызывающего уже закрыт
+
+    async def pump():
+        try:
+            async for item in agen:
+                put(item)
+        except Exception as e:
+            put(_Raise(e))
+        finally:
+            put(_DONE)
+
+    future = _submit(pump())
+    try:
+        while True:
+            item = await items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Raise):
+                raise item.exc
+            yield item
+    finally:
+        future.cancel()
+
+
+async def expand_prompt_async(
+    idea: str,
+    slider: int = 5,
+    use_cache: Optional[bool] = None,
+    force_fresh: bool = False,
+    user: Optional[str] = None,
+) -> List[Dict]:
+    """
+    Асинхронный запрос к LLM для расширения идеи в варианты промптов.
+    Использует общий keep-alive пул соединений (HTTP/2, если доступен).
+
+    use_cache=None — кэш только для температур <= cache_max_temperature,
+    True/False — принудительно включить/выключить кэш для запроса.
+    force_fresh=True — не читать из кэша, но обновить его результатом.
+    user — чей дневной бюджет токенов расходуется (None — только общий);
+    при исчерпанном бюджете — TokenBudgetExceeded.
+    """
+    # Проверка входящей идеи
+    if not idea or not idea.strip():
+        print("Warning: Empty or whitespace-only idea provided")
         return []
+    return await _call_on_loop(
+        _expand_on_loop(idea.strip(), slider, use_cache, force_fresh, user)
+    )
+
+
+def expand_prompt(
+    idea: str,
+    slider: int = 5,
+    use_cache: Optional[bool] = None,
+    force_fresh: bool = False,
+    user: Optional[str] = None,
+) -> List[Dict]:
+    """Запрос к LLM для расширения идеи в несколько вариантов промптов."""
+    if not idea or not idea.strip():
+        print("Warning: Empty or whitespace-only idea provided")
+        return []
+    if _on_adapter_loop():
+        raise RuntimeError(
+            "expand_prompt() нельзя вызывать из loop адаптера, "
+            "используйте expand_prompt_async()"
+        )
+    return _submit(
+        _expand_on_loop(idea.strip(), slider, use_cache, force_fresh, user)
+    ).result()
+
+
+async def expand_prompt_stream_async(
+    idea: str,
+    slider: int = 5,
+    use_cache: Optional[bool] = None,
+    force_fresh: bool = False,
+    user: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    Потоковый (stream=True) запрос к LLM. Выдаёт накопленный текст промпта
+    по мере поступления фрагментов; последнее значение — итоговый текст.
+    """
+    if not idea or not idea.strip():
+        print("Warning: Empty or whitespace-only idea provided")
+        return
+    agen = _stream_on_loop(idea.strip(), slider, use_cache, force_fresh, user)
+    async for partial in _iterate_async(agen):
+        yield partial
+
+
+def expand_prompt_stream(
+    idea: str,
+    slider: int = 5,
+    use_cache: Optional[bool] = None,
+    force_fresh: bool = False,
+    user: Optional[str] = None,
+) -> Iterator[str]:
+    """Синхронная обёртка над expand_prompt_stream_async (генератор)."""
+    if not idea or not idea.strip():
+        print("Warning: Empty or whitespace-only idea provided")
+        return
+    agen = _stream_on_loop(idea.strip(), slider, use_cache, force_fresh, user)
+    yield from _iterate_sync(agen)
@@ -0,0 +1,309 @@
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Границы бакетов гистограмм задержки (сек.)
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict) -> Tuple:
+    if set(labels) != set(labelnames):
+        raise ValueError(
+            f"Expected labels {labelnames}, got {tuple(sorted(labels))}"
+        )
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [
+        f'{n}="{_escape(v)}"' for n, v in zip(names, values)
+    ]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+class Counter:
+    """Монотонный счётчик с метками (prometheus counter)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[Tuple[str, Tuple, float]]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name + "_total", key, value) for key, value in items]
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            {"labels": dict(zip(self.labelnames, key)), "value": value}
+            for key, value in items
+        ]
+
+
+class Histogram:
+    """Гистограмма с метками: бакеты, сумма и число наблюдений."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счётчики по бакетам (+Inf последним), сумма, число]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = item
+            item[0][idx] += 1
+            item[1] += value
+            item[2] += 1
+
+    def time(self, **labels) -> "_Timer":
+        """Контекстный менеджер: измерить длительность блока."""
+        return _Timer(self, labels)
+
+    def samples(self) -> List[Tuple[str, Tuple, float]]:
+        with self._lock:
+            items = sorted(
+                (k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()
+            )
+        result = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            bounds = [str(b) for b in self.buckets] + ["+Inf"]
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                result.append(
+                    (self.name + "_bucket", key + (bound,), cumulative)
+                )
+            result.append((self.name + "_sum", key, total))
+            result.append((self.name + "_count", key, count))
+        return result
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Оценка квантиля по бакетам (верхняя граница бакета)."""
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None or not item[2]:
+                return None
+            counts, count = list(item[0]), item[2]
+        target = q * count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            items = sorted(
+                (k, (v[1], v[2])) for k, v in self._values.items()
+            )
+        result = []
+        for key, (total, count) in items:
+            labels = dict(zip(self.labelnames, key))
+            result.append(
+                {
+                    "labels": labels,
+                    "count": count,
+                    "sum": round(total, 6),
+                    "avg": round(total / count, 6) if count else None,
+                    "p50": self.quantile(0.5, **labels),
+                    "p95": self.quantile(0.95, **labels),
+                    "p99": self.quantile(0.99, **labels),
+                }
+            )
+        return result
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(
+            time.perf_counter() - self.started, **self.labels
+        )
+
+
+class Registry:
+    """
+    Набор метрик процесса. Кроме счётчиков и гистограмм, поддерживает
+    коллекторы — функции, возвращающие текущие значения (gauge) из
+    других компонентов (кэш, лимитер, пул) в момент запроса метрик.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._collectors: Dict[str, Tuple[str, Callable]] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, name: str, help: str, fn: Callable) -> None:
+        """
+        Зарегистрировать gauge-коллектор: fn() -> {labels-tuple или
+        dict меток: значение} или просто число.
+        """
+        with self._lock:
+            self._collectors[name] = (help, fn)
+
+    def _collect(self):
+        with self._lock:
+            collectors = list(self._collectors.items())
+        for name, (help, fn) in collectors:
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"Warning: metrics collector {name} failed: {e}")
+                continue
+            if isinstance(value, dict):
+                items = sorted(value.items(), key=lambda kv: str(kv[0]))
+            else:
+                items = [((), value)]
+            yield name, help, items
+
+    def render_prometheus(self) -> str:
+        """Текст в формате Prometheus exposition (text/plain 0.0.4)."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            names = metric.labelnames
+            for sample, key, value in metric.samples():
+                label_names = names + ("le",) if sample.endswith(
+                    "_bucket"
+                ) else names
+                lines.append(
+                    f"{sample}{_format_labels(label_names, key)} {value}"
+                )
+        for name, help, items in self._collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in items:
+                if value is None:
+                    continue
+                label_str = ""
+                if isinstance(labels, tuple) and labels:
+                    label_str = _format_labels(*zip(*labels))
+                lines.append(f"{name}{label_str} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict:
+        """Все метрики одним JSON-совместимым словарём."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {m.name: m.snapshot() for m in metrics}
+        for name, _, items in self._collect():
+            result[name] = [
+                {"labels": dict(labels), "value": value}
+                for labels, value in items
+            ]
+        return result
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram: Histogram, **labels):
+    """Декоратор: время выполнения функции в гистограмму."""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def mount(app, prefix: str = "") -> None:
+    """
+    Подключить к FastAPI-приложению GET /metrics (Prometheus) и
+    GET /api/metrics (JSON-снимок).
+    """
+    from fastapi.responses import JSONResponse, PlainTextResponse
+
+    @app.get(prefix + "/metrics", include_in_schema=False)
+    def prometheus_metrics():
+        return PlainTextResponse(
+            REGISTRY.render_prometheus(),
+            media_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+    @app.get(prefix + "/api/metrics")
+    def metrics_snapshot():
+        return JSONResponse(REGISTRY.snapshot())
@@ -0,0 +1,160 @@
+import time
+import asyncio
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+
+class RateLimitExceeded(Exception):
+    """Очередь ожидания переполнена или истёк таймаут ожидания слота."""
+
+
+class RateLimiter:
+    """
+    Асинхронный лимитер: token bucket (запросов в секунду + burst) и
+    ограничение числа одновременных запросов (max in-flight).
+
+    Ожидающие запросы стоят в ограниченной очереди: при её переполнении
+    или по истечении queue_timeout выбрасывается RateLimitExceeded.
+    Ответы 429/Retry-After приостанавливают выдачу токенов через defer().
+
+    Экземпляр привязан к одному event loop (loop адаптера).
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int = 1,
+        max_in_flight: int = 4,
+        max_queue: int = 64,
+        queue_timeout: float = 30.0,
+    ):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting = 0
+        self._in_flight = 0
+        self._bucket_lock: Optional[asyncio.Lock] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _refill(self, now: float) -> None:
+        if self.rate <= 0:
+            self._tokens = float(self.burst)
+            return
+        elapsed = now - self._updated
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def _delay(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 — токен доступен)."""
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def _take_token(self) -> None:
+        # asyncio.Lock выдаётся в порядке FIFO — ожидающие
+        # обслуживаются по очереди, без гонок за токен.
+        async with self._bucket_lock:
+            while True:
+                delay = self._delay(time.monotonic())
+                if delay <= 0:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep(delay)
+
+    async def _acquire_slot_and_token(self) -> Tuple[float, float]:
+        started = time.monotonic()
+        await self._slots.acquire()
+        got_slot = time.monotonic()
+        try:
+            await self._take_token()
+        except BaseException:
+            self._slots.release()
+            raise
+        return got_slot - started, time.monotonic() - got_slot
+
+    async def acquire(
+        self, timeout: Optional[float] = None
+    ) -> Tuple[float, float]:
+        """
+        Дождаться слота и токена; timeout=None — queue_timeout.
+        Возвращает (ожидание слота, ожидание токена) в секундах.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._bucket_lock = asyncio.Lock()
+        if self._waiting >= self.max_queue:
+            raise RateLimitExceeded(
+                f"Rate limiter queue is full ({self.max_queue} waiting)"
+            )
+        timeout = self.queue_timeout if timeout is None else timeout
+        self._waiting += 1
+        try:
+            waits = await asyncio.wait_for(
+                self._acquire_slot_and_token(), timeout
+            )
+        except asyncio.TimeoutError:
+            raise RateLimitExceeded(
+                f"Timed out after {timeout:.1f}s waiting for rate limiter"
+            ) from None
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+        return waits
+
+    def release(self) -> None:
+        """Освободить слот in-flight после завершения запроса."""
+        self._in_flight -= 1
+        self._slots.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def defer(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие seconds секунд (429/Retry-After)."""
+        if seconds <= 0:
+            return
+        until = time.monotonic() + seconds
+        if until > self._blocked_until:
+            self._blocked_until = until
+        # После паузы начинаем с пустого ведра, без всплеска запросов
+        self._tokens = 0.0
+        self._updated = until
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разобрать заголовок Retry-After (секунды или HTTP-дата)."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
@@ -0,0 +1,154 @@
+import time
+import random
+import logging
+import threading
+from typing import Optional
+
+import httpx
+
+import events
+
+# Статусы, при которых повтор запроса безопасен и имеет смысл
+RETRYABLE_STATUSES = {500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Цепь разомкнута: upstream недоступен, запрос не отправляется."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Транзиентная ли ошибка (таймаут, сеть, 5xx) — можно повторить."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUSES
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError))
+
+
+class RetryPolicy:
+    """Экспоненциальная задержка между попытками с full jitter."""
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """Задержка перед повтором номер attempt (1, 2, ...)."""
+        cap = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, cap)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker: после failure_threshold ошибок подряд цепь
+    размыкается (open) и запросы сразу отклоняются. Через
+    recovery_timeout пропускается пробный запрос (half_open): успех
+    замыкает цепь, ошибка снова размыкает. Каждая смена состояния
+    отправляется событием circuit_state.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str, reason: str = "") -> None:
+        previous, self.state = self.state, state
+        if previous == state:
+            return
+        level = logging.WARNING if state == self.OPEN else logging.INFO
+        events.emit(
+            "circuit_state",
+            level=level,
+            breaker=self.name,
+            previous=previous,
+            state=state,
+            failures=self.failures,
+            reason=reason,
+        )
+
+    def is_open(self) -> bool:
+        """Разомкнута ли цепь (с учётом наступления времени пробы)."""
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at < (
+                    self.recovery_timeout
+                )
+            if self.state == self.HALF_OPEN:
+                return self._probe_in_flight
+            return False
+
+    def before_call(self) -> None:
+        """Проверить цепь перед запросом; CircuitOpenError, если закрыто."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                elapsed = time.monotonic() - self._opened_at
+                if elapsed < self.recovery_timeout:
+                    raise CircuitOpenError(
+                        f"Circuit '{self.name}' is open, retry in "
+                        f"{self.recovery_timeout - elapsed:.1f}s"
+                    )
+                self._set_state(self.HALF_OPEN, "recovery timeout elapsed")
+            if self._probe_in_flight:
+                raise CircuitOpenError(
+                    f"Circuit '{self.name}' is half-open, probe in progress"
+                )
+            self._probe_in_flight = True
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._probe_in_flight = False
+            self.failures = 0
+            self._set_state(self.CLOSED, "call succeeded")
+
+    def on_failure(self, reason: str = "") -> None:
+        with self._lock:
+            self._probe_in_flight = False
+            self.failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self.failures >= self.failure_threshold
+            ):
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN, reason)
+
+    def on_cancel(self) -> None:
+        """Запрос отменён — результат пробы неизвестен."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "breaker": self.name,
+                "state": self.state,
+                "failures": self.failures,
+            }
+
+
+def describe(exc: Optional[BaseException]) -> str:
+    if exc is None:
+        return ""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return f"HTTP {exc.response.status_code}"
+    return f"{type(exc).__name__}: {exc}"
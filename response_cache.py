@@ -0,0 +1,113 @@
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import storage
+
+
+def make_key(**parts) -> str:
+    """Стабильный ключ кэша (sha256 от канонического JSON частей)."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def normalize_idea(idea: str) -> str:
+    """Нормализовать идею для ключа: регистр и пробелы не важны."""
+    return " ".join((idea or "").lower().split())
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и TTL."""
+
+    def __init__(self, max_items: int = 512, ttl: float = 3600.0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов LLM: LRU в памяти + таблица llm_cache в
+    storage.db. Промах в памяти проверяет SQLite и «поднимает» запись
+    обратно в LRU. Ведёт счётчики попаданий/промахов.
+    """
+
+    def __init__(self, max_items: int = 512, ttl: float = 86400.0):
+        self.ttl = ttl
+        self.memory = LRUCache(max_items=max_items, ttl=ttl)
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return value
+        cached = storage.cache_get(key, max_age=self.ttl)
+        if cached is not None:
+            try:
+                value = json.loads(cached["value"])
+            except ValueError:
+                value = None
+        if value is None:
+            self._count("misses")
+            return None
+        remaining = self.ttl - (time.time() - cached["created_at"])
+        self.memory.put(key, value, ttl=max(remaining, 0.0))
+        self._count("disk_hits")
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self.memory.put(key, value)
+        try:
+            storage.cache_put(key, json.dumps(value, ensure_ascii=False))
+        except Exception as e:
+            print(f"Warning: failed to persist LLM cache entry: {e}")
+
+    def clear(self) -> None:
+        self.memory.clear()
+        storage.cache_clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = sum(stats.values())
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        stats["memory_size"] = len(self.memory)
+        return stats
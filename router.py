@@ -0,0 +1,191 @@
+import json
+import random
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    """OpenAI-совместимый endpoint: адрес, модель, ключ и вес в роутинге."""
+
+    url: str
+    model: str
+    key: str = ""
+    weight: float = 1.0
+    name: str = ""
+
+    @property
+    def label(self) -> str:
+        return self.name or f"{self.model}@{self.url}"
+
+
+class EndpointStats:
+    """
+    Живая статистика endpoint-а: скользящее окно задержек (для p50/p95),
+    EWMA задержки и доли ошибок, число запросов в полёте.
+    """
+
+    def __init__(self, window: int = 200, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latencies = deque(maxlen=window)
+        self.ewma_latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    def record(self, latency: Optional[float], ok: bool) -> None:
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        outcome = 0.0 if ok else 1.0
+        self.error_rate += self.alpha * (outcome - self.error_rate)
+        if ok and latency is not None:
+            self.latencies.append(latency)
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency += self.alpha * (latency - self.ewma_latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[idx]
+
+
+class Router:
+    """
+    Выбор endpoint-а для запроса: взвешенный случайный выбор, где вес
+    endpoint-а делится на его текущую задержку и штрафуется за ошибки.
+    Медленные и сбоящие endpoint-ы получают меньше трафика, но не
+    исключаются полностью, чтобы статистика по ним обновлялась.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        hedge: bool = False,
+        hedge_min_delay: float = 0.5,
+        hedge_default_delay: float = 5.0,
+        error_penalty: float = 10.0,
+    ):
+        if not endpoints:
+            raise ValueError("Router requires at least one endpoint")
+        self.endpoints = list(endpoints)
+        self.hedge = hedge and len(self.endpoints) > 1
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.error_penalty = error_penalty
+        self._stats = {e: EndpointStats() for e in self.endpoints}
+        self._lock = threading.Lock()
+
+    def _score(self, endpoint: Endpoint) -> float:
+        st = self._stats[endpoint]
+        # Без статистики считаем endpoint «средним» по задержке
+        known = [
+            s.ewma_latency
+            for s in self._stats.values()
+            if s.ewma_latency is not None
+        ]
+        latency = st.ewma_latency
+        if latency is None:
+            latency = sum(known) / len(known) if known else 1.0
+        latency = max(latency, 0.001) * (1 + st.in_flight)
+        return endpoint.weight / latency / (
+            1 + self.error_penalty * st.error_rate
+        )
+
+    def choose(self, exclude: Iterable[Endpoint] = ()) -> Optional[Endpoint]:
+        """Выбрать endpoint (None, если все кандидаты исключены)."""
+        excluded = set(exclude)
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in excluded]
+            if not candidates:
+                return None
+            scores = [self._score(e) for e in candidates]
+        if sum(scores) <= 0:
+            return random.choice(candidates)
+        return random.choices(candidates, weights=scores, k=1)[0]
+
+    def hedge_delay(self, endpoint: Endpoint) -> float:
+        """Через сколько секунд отправлять резервный запрос (p95)."""
+        with self._lock:
+            p95 = self._stats[endpoint].percentile(0.95)
+        if p95 is None:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, p95)
+
+    def started(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            self._stats[endpoint].in_flight += 1
+
+    def finished(
+        self, endpoint: Endpoint, latency: Optional[float], ok: bool
+    ) -> None:
+        """Учесть завершённый запрос (задержку до ответа и успех)."""
+        with self._lock:
+            st = self._stats[endpoint]
+            st.in_flight -= 1
+            st.record(latency, ok)
+
+    def models_key(self) -> str:
+        """Набор моделей (для ключа кэша ответов)."""
+        return ",".join(sorted({e.model for e in self.endpoints}))
+
+    def stats(self) -> List[Dict]:
+        """Статистика по каждому endpoint-у."""
+        result = []
+        with self._lock:
+            for e in self.endpoints:
+                st = self._stats[e]
+                result.append(
+                    {
+                        "endpoint": e.label,
+                        "url": e.url,
+                        "model": e.model,
+                        "weight": e.weight,
+                        "requests": st.requests,
+                        "errors": st.errors,
+                        "error_rate": round(st.error_rate, 4),
+                        "in_flight": st.in_flight,
+                        "ewma_latency": st.ewma_latency,
+                        "p50": st.percentile(0.5),
+                        "p95": st.percentile(0.95),
+                        "score": self._score(e),
+                    }
+                )
+        return result
+
+
+def load_endpoints(
+    spec: str, default_url: str, default_model: str, default_key: str
+) -> List[Endpoint]:
+    """
+    Разобрать список endpoint-ов: JSON-массив объектов
+    {"url", "model", "key", "weight", "name"} или путь к JSON-файлу.
+    Пустая строка — единственный endpoint из LLM_API_URL/MODEL/LLM_API_KEY.
+    """
+    if not spec or not spec.strip():
+        return [
+            Endpoint(url=default_url, model=default_model, key=default_key)
+        ]
+    spec = spec.strip()
+    if not spec.startswith("["):
+        with open(spec, "r", encoding="utf-8") as f:
+            spec = f.read()
+    endpoints = []
+    for item in json.loads(spec):
+        endpoints.append(
+            Endpoint(
+                url=item.get("url") or default_url,
+                model=item.get("model") or default_model,
+                key=item.get("key", default_key),
+                weight=float(item.get("weight", 1.0)),
+                name=item.get("name", ""),
+            )
+        )
+    return endpoints
@@ -0,0 +1,140 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import storage
+
+
+def display_name(row: Dict) -> str:
+    """Подпись записи в Dropdown: "Name (id1234)"."""
+    return f"{row.get('name') or 'untitled'} ({row['id'][:8]})"
+
+
+class SavedIndex:
+    """
+    Общий для всех сессий индекс последних сохранённых записей
+    (id, name, created_at), новые сверху. Загружается из БД при первом
+    обращении и дальше обновляется write-through хуками storage:
+    сохранение и удаление меняют только затронутую запись, без
+    перезапроса страницы. Счётчик version растёт при каждом изменении —
+    сессия, видевшая ту же версию, может не обновлять список.
+
+    Записи, изменённые другим процессом (например, cli.py batch), индекс
+    не видит до reload().
+    """
+
+    def __init__(self, page_size: int = 200, slack: int = 50):
+        self.page_size = page_size
+        # Запас сверх страницы, чтобы удаления не требовали перезагрузки
+        self.slack = slack
+        self.version = 0
+        self._rows: List[Dict] = []
+        self._ids = set()
+        self._more = False
+        self._loaded = False
+        self._view: Optional[Tuple] = None
+        self._tags: Optional[List[Tuple[str, int]]] = None
+        self._lock = threading.RLock()
+
+    def _load(self) -> None:
+        rows, next_cursor = storage.list_prompt_summaries(
+            limit=self.page_size + self.slack
+        )
+        self._rows = [dict(r) for r in rows]
+        self._ids = {r["id"] for r in self._rows}
+        self._more = next_cursor is not None
+        self._loaded = True
+        self._view = None
+
+    def _remove(self, record_id: str) -> None:
+        if record_id not in self._ids:
+            return
+        self._ids.discard(record_id)
+        for i, row in enumerate(self._rows):
+            if row["id"] == record_id:
+                del self._rows[i]
+                break
+
+    def _insert(self, summary: Dict) -> None:
+        key = (summary["created_at"] or "", summary["id"])
+        pos = 0
+        # Новая запись почти всегда самая свежая — цикл завершается сразу
+        while pos < len(self._rows) and (
+            self._rows[pos]["created_at"] or "",
+            self._rows[pos]["id"],
+        ) > key:
+            pos += 1
+        if pos == len(self._rows) and self._more:
+            # Запись старше окна — попадёт в следующие страницы
+            return
+        self._rows.insert(pos, dict(summary))
+        self._ids.add(summary["id"])
+        if len(self._rows) > self.page_size + self.slack:
+            dropped = self._rows.pop()
+            self._ids.discard(dropped["id"])
+            self._more = True
+
+    def on_write(self, action: str, **fields) -> None:
+        """Хук storage.add_write_hook: применить изменение к индексу."""
+        with self._lock:
+            self.version += 1
+            self._view = None
+            self._tags = None
+            if not self._loaded:
+                return
+            if action == "save":
+                summary = fields["summary"]
+                self._remove(summary["id"])
+                self._insert(summary)
+            elif action == "delete":
+                self._remove(fields["record_id"])
+                if len(self._rows) < self.page_size and self._more:
+                    self._loaded = False
+            else:
+                self._loaded = False
+
+    def reload(self) -> bool:
+        """Перечитать индекс из БД; True, если содержимое изменилось."""
+        with self._lock:
+            before = [(r["id"], r["name"]) for r in self._rows]
+            was_loaded = self._loaded
+            self._load()
+            changed = not was_loaded or before != [
+                (r["id"], r["name"]) for r in self._rows
+            ]
+            if changed:
+                self.version += 1
+                self._tags = None
+            return changed
+
+    def page(self) -> Tuple[List[str], Dict[str, str], Optional[str], int]:
+        """
+        Первая страница для Dropdown: (choices, mapping display -> id,
+        курсор следующей страницы или None, version). Результат
+        строится один раз на версию и общий для всех сессий.
+        """
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if self._view is None:
+                rows = self._rows[: self.page_size]
+                choices = []
+                mapping = {}
+                for r in rows:
+                    display = display_name(r)
+                    choices.append(display)
+                    mapping[display] = r["id"]
+                next_cursor = None
+                if rows and (len(self._rows) > len(rows) or self._more):
+                    next_cursor = storage.encode_cursor(
+                        rows[-1]["created_at"], rows[-1]["id"]
+                    )
+                self._view = (choices, mapping, next_cursor)
+            choices, mapping, next_cursor = self._view
+            return list(choices), dict(mapping), next_cursor, self.version
+
+    def tag_counts(self, limit: int = 200) -> List[Tuple[str, int]]:
+        """Фасеты тегов (кэшируются до следующего изменения)."""
+        with self._lock:
+            if self._tags is None:
+                self._tags = storage.tag_counts(limit=limit)
+            return list(self._tags)
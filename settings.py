@@ -0,0 +1,282 @@
+"""
+Настройки приложения из переменных окружения (и .env). Читаются один
+раз — при первом вызове get_settings(), а не при импорте модулей, так
+что импорт storage/llm_adapter ничего не читает и не открывает.
+"""
+
+import os
+import threading
+from dataclasses import dataclass, fields, replace
+from typing import Mapping, Optional
+
+# Допустимые значения строковых настроек-перечислений
+WRITE_ACK_MODES = ("sync", "async")
+PROFILE_MODES = ("cprofile", "sample")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Все настройки процесса; имена переменных окружения — см. from_env."""
+
+    # --- LLM ---
+    llm_api_url: str = ""
+    llm_api_key: str = ""
+    model: str = ""
+    # Rate limiting: token bucket + ограничение одновременных запросов.
+    # По умолчанию темп задаётся старым MIN_CALL_INTERVAL (1 запрос в
+    # N сек.), см. from_env
+    min_call_interval: float = 2.0
+    rate_limit_rps: float = 0.5
+    rate_limit_burst: int = 1
+    max_in_flight: int = 4
+    max_queue: int = 64
+    queue_timeout: float = 30.0
+    max_429_retries: int = 2
+    default_retry_after: float = 2.0
+    # Пул соединений HTTP-клиента; HTTP/2 — только если установлен h2
+    pool_max_connections: int = 20
+    pool_max_keepalive: int = 10
+    pool_keepalive_expiry: float = 60.0
+    connect_timeout: float = 5.0
+    request_timeout: float = 15.0
+    http2: bool = True
+    # Несколько endpoint-ов (JSON-массив или путь к файлу) и hedging
+    llm_endpoints: str = ""
+    hedge_enabled: bool = False
+    hedge_min_delay: float = 0.5
+    hedge_default_delay: float = 5.0
+    # Повторы транзиентных ошибок (таймауты, сеть, 5xx) и circuit breaker
+    retry_attempts: int = 3
+    retry_base_delay: float = 0.5
+    retry_max_delay: float = 8.0
+    breaker_failures: int = 5
+    breaker_recovery: float = 30.0
+    # Кэш ответов: по умолчанию только для низких температур
+    cache_enabled: bool = True
+    cache_max_items: int = 512
+    cache_ttl: float = 86400.0
+    cache_max_temperature: float = 0.2
+    # Объединение одинаковых одновременных запросов в один вызов LLM
+    coalesce_enabled: bool = True
+    # Цена токенов (для метрики стоимости), за 1000 токенов
+    price_prompt_per_1k: float = 0.0
+    price_completion_per_1k: float = 0.0
+    # max_tokens запроса: верхний предел, а с llm_adaptive_max_tokens —
+    # перцентиль длин ответов (по модели и температуре) × запас, как
+    # только накопится llm_max_tokens_min_samples ответов
+    llm_max_tokens: int = 1000
+    llm_adaptive_max_tokens: bool = True
+    llm_max_tokens_percentile: float = 0.98
+    llm_max_tokens_headroom: float = 1.2
+    llm_min_tokens: int = 64
+    llm_max_tokens_min_samples: int = 20
+    # Сколько раз дописывать урезанный (finish_reason=length) ответ
+    llm_max_continuations: int = 2
+    # Дневные бюджеты токенов (0 — без ограничения): на всех и на
+    # пользователя (сессию интерфейса, поле user в API)
+    token_budget_daily: int = 0
+    token_budget_user_daily: int = 0
+
+    # --- Хранилище (SQLite) ---
+    storage_db: str = "storage.db"
+    outputs_dir: str = "outputs"
+    storage_busy_timeout: float = 5.0
+    storage_mmap_size: int = 256 * 1024 * 1024
+    storage_cache_size_kb: int = 20000
+    storage_cached_statements: int = 256
+    # Сколько самых новых совпадений ранжируется по BM25 при поиске
+    storage_search_rank_window: int = 2000
+    # Отложенная запись save_prompt: поток-писатель коммитит пачками до
+    # storage_write_batch записей; записи, пришедшие во время коммита,
+    # идут следующей пачкой. storage_write_delay — сколько ещё (сек.)
+    # добирать пачку перед коммитом (0 — не ждать).
+    # storage_write_ack: sync — save_prompt ждёт коммита, async — нет
+    storage_write_behind: bool = False
+    storage_write_batch: int = 100
+    storage_write_delay: float = 0.0
+    storage_write_ack: str = "sync"
+    # Сжатие больших колонок (llm_raw_response, кэш ответов): zlib с
+    # общим словарём; значения короче storage_compress_min_size — как есть
+    storage_compress: bool = True
+    storage_compress_min_size: int = 256
+    storage_compress_level: int = 6
+
+    # --- Пул «Случайного пейзажа» ---
+    landscape_pool: bool = True
+    landscape_pool_size: int = 5
+    landscape_pool_low_water: int = 2
+    # Промпты старше этого возраста (сек.) не выдаются
+    landscape_pool_max_age: float = 7 * 86400.0
+    # Пауза между фоновыми запросами пополнения (сек.)
+    landscape_pool_refill_interval: float = 1.0
+
+    # --- Похожие промпты ---
+    # Число хэш-функций MinHash; при изменении сигнатуры пересчитываются
+    similarity_num_perm: int = 64
+    # Порог сходства (оценка Жаккара по словным биграммам) для дубликатов
+    similarity_duplicate_threshold: float = 0.8
+
+    # --- Фоновые задания генерации (jobs.py) ---
+    # Воркеры — одновременно выполняемые задания (запросы к LLM)
+    jobs_workers: int = 4
+    jobs_max_queued: int = 256
+    jobs_max_per_session: int = 4
+    # Сколько раз задание, прерванное перезапуском, запускается заново
+    jobs_max_attempts: int = 3
+    # Сколько хранить завершённые задания (сек.)
+    jobs_retention: float = 7 * 86400.0
+
+    # --- Трассировка и профилирование (tracing.py) ---
+    # Спаны UI -> адаптер -> хранилище в JSONL с ротацией; sample_rate —
+    # доля трассируемых запросов
+    trace_enabled: bool = False
+    trace_file: str = "traces/spans.jsonl"
+    trace_max_bytes: int = 10 * 1024 * 1024
+    trace_backups: int = 5
+    trace_sample_rate: float = 1.0
+    # Профилировать первые profile_count вызовов обработчиков, имя
+    # которых подходит под profile_handlers (fnmatch, например
+    # "ui.generate*"); режим cprofile или sample. Пусто — выключено
+    profile_handlers: str = ""
+    profile_count: int = 1
+    profile_mode: str = "cprofile"
+    # Куда писать профили и период сэмплирования (сек.)
+    profile_dir: str = "profiles"
+    profile_interval: float = 0.005
+
+    # --- Веб-сервер ---
+    server_name: str = "127.0.0.1"
+    server_port: int = 7860
+    # Очередь Gradio: одновременные обработчики по умолчанию и размер
+    # очереди событий (генерация ждёт задание и в лимит не входит)
+    gradio_concurrency_limit: int = 4
+    gradio_max_queue: int = 64
+
+    @classmethod
+    def from_env(cls, env: Optional[Mapping[str, str]] = None):
+        """
+        Собрать настройки из env (по умолчанию os.environ). Пустая
+        переменная — значение по умолчанию; недопустимое значение —
+        ValueError с именем переменной.
+        """
+        env = os.environ if env is None else env
+        values = {}
+        for field in fields(cls):
+            name = _ENV_NAMES.get(field.name, field.name.upper())
+            raw = env.get(name)
+            if raw is None or not raw.strip():
+                continue
+            if field.type is bool:
+                values[field.name] = _parse_bool(name, raw)
+            elif field.type in (int, float):
+                values[field.name] = field.type(raw)
+            elif field.name in _CHOICES:
+                values[field.name] = _parse_choice(
+                    name, raw, _CHOICES[field.name]
+                )
+            else:
+                values[field.name] = raw
+        if not env.get("RATE_LIMIT_RPS", "").strip():
+            interval = values.get("min_call_interval", cls.min_call_interval)
+            values["rate_limit_rps"] = 1 / interval if interval > 0 else 0
+        if values.get("http2", True):
+            import importlib.util
+
+            values["http2"] = bool(importlib.util.find_spec("h2"))
+        return cls(**values)
+
+
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off")
+
+
+def _parse_bool(name: str, raw: str) -> bool:
+    """Флаг из переменной окружения: 1/true/yes/on или 0/false/no/off."""
+    value = raw.strip().lower()
+    if value in _TRUE:
+        return True
+    if value in _FALSE:
+        return False
+    raise ValueError(
+        f"{name}: expected 1/true/yes/on or 0/false/no/off, got {raw!r}"
+    )
+
+
+def _parse_choice(name: str, raw: str, choices) -> str:
+    """Значение перечисления (регистр не важен)."""
+    value = raw.strip().lower()
+    if value not in choices:
+        raise ValueError(
+            f"{name}: expected one of {', '.join(choices)}, got {raw!r}"
+        )
+    return value
+
+
+# Строковые настройки с фиксированным набором значений
+_CHOICES = {
+    "storage_write_ack": WRITE_ACK_MODES,
+    "profile_mode": PROFILE_MODES,
+}
+
+# Поля, у которых имя переменной окружения не совпадает с NAME.upper()
+_ENV_NAMES = {
+    "max_in_flight": "LLM_MAX_IN_FLIGHT",
+    "max_queue": "LLM_MAX_QUEUE",
+    "queue_timeout": "LLM_QUEUE_TIMEOUT",
+    "max_429_retries": "LLM_MAX_429_RETRIES",
+    "default_retry_after": "LLM_DEFAULT_RETRY_AFTER",
+    "pool_max_connections": "LLM_POOL_MAX_CONNECTIONS",
+    "pool_max_keepalive": "LLM_POOL_MAX_KEEPALIVE",
+    "pool_keepalive_expiry": "LLM_POOL_KEEPALIVE_EXPIRY",
+    "connect_timeout": "LLM_CONNECT_TIMEOUT",
+    "request_timeout": "LLM_REQUEST_TIMEOUT",
+    "http2": "LLM_HTTP2",
+    "hedge_enabled": "LLM_HEDGE",
+    "hedge_min_delay": "LLM_HEDGE_MIN_DELAY",
+    "hedge_default_delay": "LLM_HEDGE_DEFAULT_DELAY",
+    "retry_attempts": "LLM_RETRY_ATTEMPTS",
+    "retry_base_delay": "LLM_RETRY_BASE_DELAY",
+    "retry_max_delay": "LLM_RETRY_MAX_DELAY",
+    "breaker_failures": "LLM_BREAKER_FAILURES",
+    "breaker_recovery": "LLM_BREAKER_RECOVERY",
+    "cache_enabled": "LLM_CACHE_ENABLED",
+    "cache_max_items": "LLM_CACHE_MAX_ITEMS",
+    "cache_ttl": "LLM_CACHE_TTL",
+    "cache_max_temperature": "LLM_CACHE_MAX_TEMPERATURE",
+    "coalesce_enabled": "LLM_COALESCE",
+    "price_prompt_per_1k": "LLM_PRICE_PROMPT_PER_1K",
+    "price_completion_per_1k": "LLM_PRICE_COMPLETION_PER_1K",
+    "server_name": "GRADIO_SERVER_NAME",
+    "server_port": "GRADIO_SERVER_PORT",
+}
+
+_settings: Optional[Settings] = None
+_settings_lock = threading.Lock()
+
+
+def get_settings() -> Settings:
+    """Текущие настройки (при первом вызове — загрузить .env и env)."""
+    global _settings
+    settings = _settings
+    if settings is not None:
+        return settings
+    with _settings_lock:
+        if _settings is None:
+            from dotenv import load_dotenv
+
+            load_dotenv()
+            _settings = Settings.from_env()
+        return _settings
+
+
+def configure(**overrides) -> Settings:
+    """
+    Переопределить отдельные настройки (бенчмарки, скрипты). Уже
+    созданные объекты (лимитер, клиент, пул) их не видят — для них
+    есть свои configure_*.
+    """
+    global _settings
+    current = get_settings()
+    with _settings_lock:
+        _settings = replace(current, **overrides)
+        return _settings
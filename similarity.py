@@ -0,0 +1,307 @@
+import re
+import zlib
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import storage
+from settings import get_settings
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Множитель для комбинирования хэшей соседних слов в хэш биграммы
+_PAIR_MULT = np.uint64(0x9E3779B97F4A7C15)
+_EMPTY = np.uint32(0xFFFFFFFF)
+# Сколько шинглов хэшировать за раз (матрица num_perm x N из uint64)
+_CHUNK_SHINGLES = 1 << 15
+# Кэш хэшей слов (сбрасывается целиком при переполнении)
+_WORD_HASHES: Dict[str, int] = {}
+_WORD_CACHE_SIZE = 200_000
+
+
+def _word_codes(words: List[str]) -> List[int]:
+    """crc32 слов; словарь промптов небольшой, поэтому хэши кэшируются."""
+    cache = _WORD_HASHES
+    try:
+        return [cache[w] for w in words]
+    except KeyError:
+        if len(cache) > _WORD_CACHE_SIZE:
+            cache.clear()
+        for w in words:
+            if w not in cache:
+                cache[w] = zlib.crc32(w.encode("utf-8"))
+        return [cache[w] for w in words]
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    """64-битные хэши словных биграмм (униграмм для одного слова)."""
+    words = _WORD_RE.findall((text or "").lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    h = np.array(_word_codes(words), dtype=np.uint64)
+    if len(h) == 1:
+        return h
+    return np.unique(h[:-1] * _PAIR_MULT + h[1:])
+
+
+class SimilarityIndex:
+    """
+    Индекс похожих промптов на MinHash: сигнатура записи — минимумы
+    num_perm универсальных хэшей (multiply-shift) по множеству её
+    словных биграмм, доля совпавших позиций двух сигнатур оценивает
+    коэффициент Жаккара. Сигнатуры всех записей лежат в одной матрице
+    NumPy, запрос сравнивает её с сигнатурой целиком, без цикла по
+    парам.
+
+    Сигнатуры хранятся в таблице prompt_minhash (считаются один раз) и
+    обновляются инкрементально write-through хуком storage.
+    """
+
+    def __init__(self, num_perm: Optional[int] = None, seed: int = 1):
+        if num_perm is None:
+            num_perm = get_settings().similarity_num_perm
+        self.num_perm = num_perm
+        rng = np.random.default_rng(seed)
+        # a — нечётные 64-битные множители, b — сдвиги
+        self._a = rng.integers(
+            0, 2**63, size=num_perm, dtype=np.uint64
+        ) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+        self._sigs = np.empty((0, num_perm), dtype=np.uint32)
+        self._alive = np.empty(0, dtype=bool)
+        self._ids: List[str] = []
+        self._names: List[str] = []
+        self._pos: Dict[str, int] = {}
+        self._size = 0
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash-сигнатура текста (uint32[num_perm])."""
+        return self.signatures([text])[0]
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """
+        Сигнатуры пакета текстов (uint32[len(texts), num_perm]): хэши
+        всех текстов считаются одной операцией, минимумы по каждому
+        тексту — через np.minimum.reduceat.
+        """
+        result = np.full((len(texts), self.num_perm), _EMPTY, dtype=np.uint32)
+        shingles = [_shingle_hashes(t) for t in texts]
+        chunk: List[int] = []
+        total = 0
+        for i, h in enumerate(shingles):
+            if not len(h):
+                continue
+            chunk.append(i)
+            total += len(h)
+            if total >= _CHUNK_SHINGLES:
+                self._minhash_rows(shingles, chunk, result)
+                chunk, total = [], 0
+        if chunk:
+            self._minhash_rows(shingles, chunk, result)
+        return result
+
+    def _minhash_rows(
+        self, shingles: List[np.ndarray], rows: List[int], out: np.ndarray
+    ) -> None:
+        parts = [shingles[i] for i in rows]
+        starts = np.cumsum([0] + [len(h) for h in parts[:-1]])
+        h = np.concatenate(parts)
+        # Переполнение uint64 — это и есть умножение по модулю 2**64
+        with np.errstate(over="ignore"):
+            hashed = (self._a[:, None] * h[None, :] + self._b[:, None]) >> (
+                np.uint64(32)
+            )
+        out[rows] = np.minimum.reduceat(hashed, starts, axis=1).T
+
+    # --- хранение в матрице ---
+
+    def _reserve(self, extra: int) -> None:
+        need = self._size + extra
+        if need <= len(self._sigs):
+            return
+        capacity = max(need, 2 * len(self._sigs), 1024)
+        sigs = np.empty((capacity, self.num_perm), dtype=np.uint32)
+        sigs[: self._size] = self._sigs[: self._size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[: self._size] = self._alive[: self._size]
+        self._sigs, self._alive = sigs, alive
+
+    def _put(self, record_id: str, name: str, sig: np.ndarray) -> None:
+        row = self._pos.get(record_id)
+        if row is None:
+            self._reserve(1)
+            row = self._size
+            self._size += 1
+            self._ids.append(record_id)
+            self._names.append(name)
+            self._pos[record_id] = row
+        else:
+            self._names[row] = name
+        self._sigs[row] = sig
+        # Пустой текст ни на что не похож
+        self._alive[row] = not (sig == _EMPTY).all()
+
+    def _append(
+        self, ids: List[str], names: List[str], sigs: np.ndarray
+    ) -> None:
+        """Добавить пакет новых записей (при загрузке) без цикла по строкам."""
+        self._reserve(len(ids))
+        start, end = self._size, self._size + len(ids)
+        self._sigs[start:end] = sigs
+        self._alive[start:end] = ~(sigs == _EMPTY).all(axis=1)
+        self._ids.extend(ids)
+        self._names.extend(names)
+        self._pos.update(zip(ids, range(start, end)))
+        self._size = end
+
+    def _remove(self, record_id: str) -> None:
+        row = self._pos.pop(record_id, None)
+        if row is not None:
+            self._alive[row] = False
+
+    def _load(self) -> None:
+        self._sigs = np.empty((0, self.num_perm), dtype=np.uint32)
+        self._alive = np.empty(0, dtype=bool)
+        self._ids, self._names, self._pos = [], [], {}
+        self._size = 0
+        width = self.num_perm * 4
+        stale = False
+        for batch in storage.iter_signatures():
+            if any(len(blob) != width for _, _, blob in batch):
+                stale = True
+                break
+            sigs = np.frombuffer(
+                b"".join(blob for _, _, blob in batch), dtype=np.uint32
+            ).reshape(-1, self.num_perm)
+            self._append(
+                [r[0] for r in batch], [r[1] for r in batch], sigs
+            )
+        if stale:
+            # Сигнатуры с другим num_perm — пересчитать всё
+            storage.clear_signatures()
+            return self._load()
+        # Записи без сигнатуры (старые, импортированные) — досчитать
+        for batch in storage.iter_unsigned_prompts():
+            ids = [r[0] for r in batch]
+            sigs = self.signatures([r[2] for r in batch])
+            self._append(ids, [r[1] for r in batch], sigs)
+            storage.put_signatures(
+                [(rid, sig.tobytes()) for rid, sig in zip(ids, sigs)]
+            )
+        self._loaded = True
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self._load()
+
+    def sign(self, prompts: List[str]) -> List[bytes]:
+        """Сигнатуры для storage.set_signer (одним пакетом)."""
+        return [sig.tobytes() for sig in self.signatures(prompts)]
+
+    def on_write(self, action: str, **fields) -> None:
+        """Хук storage.add_write_hook: обновить сигнатуру записи."""
+        with self._lock:
+            if action == "save":
+                summary = fields["summary"]
+                blob = fields.get("sig")
+                if blob is not None and len(blob) == self.num_perm * 4:
+                    # Уже записана storage в транзакции сохранения
+                    sig = np.frombuffer(blob, dtype=np.uint32)
+                else:
+                    sig = self.signature(fields.get("prompt") or "")
+                    storage.put_signatures([(summary["id"], sig.tobytes())])
+                if self._loaded:
+                    self._put(summary["id"], summary["name"], sig)
+            elif action == "delete":
+                self._remove(fields["record_id"])
+            else:
+                self._loaded = False
+
+    # --- запросы ---
+
+    def _top(
+        self,
+        sig: np.ndarray,
+        k: int,
+        min_similarity: float,
+        exclude: Optional[str] = None,
+    ) -> List[Dict]:
+        with self._lock:
+            self._ensure_loaded()
+            n = self._size
+            if not n or (sig == _EMPTY).all():
+                return []
+            matches = np.count_nonzero(self._sigs[:n] == sig, axis=1)
+            scores = matches / np.float32(self.num_perm)
+            scores[~self._alive[:n]] = -1.0
+            if exclude is not None and exclude in self._pos:
+                scores[self._pos[exclude]] = -1.0
+            k = min(k, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [
+                {
+                    "id": self._ids[i],
+                    "name": self._names[i],
+                    "similarity": round(float(scores[i]), 4),
+                }
+                for i in top
+                if scores[i] >= min_similarity and scores[i] > 0
+            ]
+
+    def similar_to_text(
+        self, text: str, k: int = 10, min_similarity: float = 0.0
+    ) -> List[Dict]:
+        """Top-k записей, похожих на текст: [{"id", "name", "similarity"}]."""
+        return self._top(self.signature(text), k, min_similarity)
+
+    def similar_to(
+        self, record_id: str, k: int = 10, min_similarity: float = 0.0
+    ) -> List[Dict]:
+        """Top-k записей, похожих на сохранённую запись (кроме неё самой)."""
+        with self._lock:
+            self._ensure_loaded()
+            row = self._pos.get(record_id)
+            if row is None:
+                return []
+            sig = self._sigs[row].copy()
+        return self._top(sig, k, min_similarity, exclude=record_id)
+
+    def find_duplicate(
+        self, text: str, threshold: Optional[float] = None
+    ) -> Optional[Dict]:
+        """
+        Самый похожий почти-дубликат текста (None, если нет); порог по
+        умолчанию — SIMILARITY_DUPLICATE_THRESHOLD.
+        """
+        if threshold is None:
+            threshold = get_settings().similarity_duplicate_threshold
+        found = self.similar_to_text(text, k=1, min_similarity=threshold)
+        return found[0] if found else None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "records": len(self._pos),
+                "rows": self._size,
+                "num_perm": self.num_perm,
+                "loaded": self._loaded,
+            }
+
+
+_index: Optional[SimilarityIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> SimilarityIndex:
+    """Общий индекс похожих (создаётся и подписывается на storage лениво)."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SimilarityIndex()
+            storage.set_signer(_index.sign)
+            storage.add_write_hook(_index.on_write)
+        return _index
+
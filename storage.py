@@ -1,23 +1,124 @@
 import os
+import gzip
 import sqlite3
 import uuid
 import json
+import time
+import base64
+import atexit
+import threading
+from concurrent.futures import Future
 from datetime import datetime
 
-DB_PATH = os.getenv("STORAGE_DB", "storage.db")
-OUTPUTS_DIR = "outputs"
-os.makedirs(OUTPUTS_DIR, exist_ok=True)
+import compression
+import metrics
+import tracing
+from settings import get_settings
 
+# Соединения живут в потоке, который их открыл (thread-local), и
+# переиспользуются всеми вызовами в этом потоке. Список всех соединений
+# нужен, чтобы закрыть их при завершении процесса.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+# Пути БД, для которых схема уже создана/мигрирована в этом процессе
+_ready_paths = set()
+_schema_lock = threading.Lock()
 
-def _conn():
-    """Открыть соединение с БД."""
-    conn = sqlite3.connect(DB_PATH)
+# Подписчики на изменения saved_prompts (write-through кэши в памяти)
+_write_hooks = []
+# Функция сигнатур prompt_minhash для сохраняемых записей (см. set_signer)
+_signer = None
+
+# Очередь отложенной записи save_prompt (STORAGE_WRITE_BEHIND)
+_writer = None
+_writer_lock = threading.Lock()
+
+STORAGE_SECONDS = metrics.REGISTRY.histogram(
+    "storage_operation_duration_seconds",
+    "Duration of storage operations",
+    ("op",),
+)
+
+
+def _timed(fn):
+    """
+    Учитывать время операции в storage_operation_duration_seconds и
+    писать её спаном storage.<имя> в текущую трассу.
+    """
+    fn = tracing.traced("storage." + fn.__name__)(fn)
+    return metrics.timed(STORAGE_SECONDS, op=fn.__name__)(fn)
+
+
+def _open(path):
+    """Открыть соединение и настроить его (WAL и прагмы)."""
+    s = get_settings()
+    conn = sqlite3.connect(
+        path,
+        timeout=s.storage_busy_timeout,
+        check_same_thread=False,
+        cached_statements=s.storage_cached_statements,
+    )
     conn.row_factory = sqlite3.Row
+    # WAL: читатели не блокируют писателя и наоборот
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={s.storage_mmap_size:d}")
+    conn.execute(f"PRAGMA cache_size=-{s.storage_cache_size_kb:d}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    # INSERT OR REPLACE должен вызывать DELETE-триггеры (синхронизация FTS)
+    conn.execute("PRAGMA recursive_triggers=ON")
     return conn
 
 
-def _ensure_table():
-    """Создать таблицу saved_prompts, если её ещё нет."""
+def db_path():
+    """Путь к файлу БД (STORAGE_DB)."""
+    return get_settings().storage_db
+
+
+def _conn():
+    """
+    Соединение с БД для текущего потока (открывается при первом
+    обращении, тогда же при необходимости создаётся схема). Закрывать
+    его не нужно — см. close_all().
+    """
+    path = db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == path:
+        return conn
+    conn = _open(path)
+    if path not in _ready_paths:
+        with _schema_lock:
+            if path not in _ready_paths:
+                _ensure_table(conn)
+                _ready_paths.add(path)
+    _local.conn, _local.path = conn, path
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+
+def close_all():
+    """Закрыть все соединения (хук завершения приложения)."""
+    flush_writes()
+    with _connections_lock:
+        conns = list(_connections)
+        _connections.clear()
+    for conn in conns:
+        try:
+            conn.execute("PRAGMA optimize")
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
+
+
+atexit.register(close_all)
+
+
+def _ensure_table(conn):
+    """Создать таблицы и применить миграции (первое соединение с БД)."""
     sql = """
     CREATE TABLE IF NOT EXISTS saved_prompts (
         id TEXT PRIMARY KEY,
@@ -30,119 +131,821 @@ def _ensure_table():
         created_at TEXT
     );
     """
-    conn = _conn()
-    conn.execute(sql)
-    conn.commit()
-    conn.close()
+    cache_sql = """
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        created_at REAL
+    );
+    """
+    with conn:
+        conn.execute(sql)
+        conn.execute(cache_sql)
+    _migrate(conn)
 
 
-_ensure_table()
+# Миграции схемы: (версия, список SQL-команд). Применённая версия
+# хранится в PRAGMA user_version; миграция выполняется в одной транзакции.
+MIGRATIONS = [
+    (
+        1,
+        [
+            # Покрывающий индекс для списка «последние сверху» и
+            # keyset-пагинации
+            """
+            CREATE INDEX IF NOT EXISTS idx_saved_prompts_created
+            ON saved_prompts (created_at DESC, id DESC, name)
+            """,
+        ],
+    ),
+    (
+        2,
+        [
+            # Полнотекстовый индекс (external content), синхронизируется
+            # триггерами
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS saved_prompts_fts USING fts5(
+                name, prompt, llm_input, tags,
+                content='saved_prompts', content_rowid='rowid',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3 4 5 6'
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS saved_prompts_fts_ai
+            AFTER INSERT ON saved_prompts BEGIN
+                INSERT INTO saved_prompts_fts
+                    (rowid, name, prompt, llm_input, tags)
+                VALUES
+                    (new.rowid, new.name, new.prompt, new.llm_input, new.tags);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS saved_prompts_fts_ad
+            AFTER DELETE ON saved_prompts BEGIN
+                INSERT INTO saved_prompts_fts
+                    (saved_prompts_fts, rowid, name, prompt, llm_input, tags)
+                VALUES
+                    ('delete', old.rowid, old.name, old.prompt,
+                     old.llm_input, old.tags);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS saved_prompts_fts_au
+            AFTER UPDATE ON saved_prompts BEGIN
+                INSERT INTO saved_prompts_fts
+                    (saved_prompts_fts, rowid, name, prompt, llm_input, tags)
+                VALUES
+                    ('delete', old.rowid, old.name, old.prompt,
+                     old.llm_input, old.tags);
+                INSERT INTO saved_prompts_fts
+                    (rowid, name, prompt, llm_input, tags)
+                VALUES
+                    (new.rowid, new.name, new.prompt, new.llm_input, new.tags);
+            END
+            """,
+            "INSERT INTO saved_prompts_fts(saved_prompts_fts) "
+            "VALUES ('rebuild')",
+        ],
+    ),
+    (
+        3,
+        [
+            # Нормализованные теги: фильтрация и фасеты по индексу вместо
+            # json.loads каждой строки. Колонка saved_prompts.tags остаётся
+            # денормализованной копией (FTS, экспорт).
+            """
+            CREATE TABLE IF NOT EXISTS prompt_tags (
+                prompt_id TEXT NOT NULL
+                    REFERENCES saved_prompts(id) ON DELETE CASCADE,
+                tag TEXT NOT NULL COLLATE NOCASE,
+                PRIMARY KEY (tag, prompt_id)
+            ) WITHOUT ROWID
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_prompt_tags_prompt
+            ON prompt_tags (prompt_id, tag)
+            """,
+            """
+            INSERT OR IGNORE INTO prompt_tags (prompt_id, tag)
+            SELECT p.id, trim(j.value)
+            FROM saved_prompts AS p,
+                 json_each(
+                     CASE WHEN json_valid(p.tags) THEN p.tags ELSE '[]' END
+                 ) AS j
+            WHERE j.type = 'text' AND trim(j.value) <> ''
+            """,
+        ],
+    ),
+    (
+        4,
+        [
+            # MinHash-сигнатуры промптов для поиска похожих (similarity.py)
+            """
+            CREATE TABLE IF NOT EXISTS prompt_minhash (
+                prompt_id TEXT PRIMARY KEY
+                    REFERENCES saved_prompts(id) ON DELETE CASCADE,
+                sig BLOB NOT NULL
+            ) WITHOUT ROWID
+            """,
+        ],
+    ),
+    (
+        5,
+        [
+            # Заранее сгенерированные промпты для кнопки «Случайный
+            # пейзаж» по полосам температуры (landscape_pool.py)
+            """
+            CREATE TABLE IF NOT EXISTS landscape_pool (
+                id INTEGER PRIMARY KEY,
+                band REAL NOT NULL,
+                prompt TEXT NOT NULL,
+                finish_reason TEXT,
+                llm_raw_response TEXT,
+                created_at REAL NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_landscape_pool_band
+            ON landscape_pool (band, id)
+            """,
+        ],
+    ),
+    (
+        6,
+        [
+            # Фоновые задания генерации (jobs.py); params/result — JSON
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                session TEXT NOT NULL DEFAULT '',
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_jobs_status
+            ON jobs (status, priority DESC, created_at)
+            """,
+        ],
+    ),
+    (
+        7,
+        [
+            # Словари сжатия больших колонок (compression.py); id 0 —
+            # встроенный словарь, в таблице не хранится
+            """
+            CREATE TABLE IF NOT EXISTS compression_dicts (
+                id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                samples INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """,
+            # FTS переиндексируется только при изменении индексируемых
+            # колонок: пересжатие llm_raw_response его не трогает
+            "DROP TRIGGER IF EXISTS saved_prompts_fts_au",
+            """
+            CREATE TRIGGER saved_prompts_fts_au
+            AFTER UPDATE OF name, prompt, llm_input, tags ON saved_prompts
+            BEGIN
+                INSERT INTO saved_prompts_fts
+                    (saved_prompts_fts, rowid, name, prompt, llm_input, tags)
+                VALUES
+                    ('delete', old.rowid, old.name, old.prompt,
+                     old.llm_input, old.tags);
+                INSERT INTO saved_prompts_fts
+                    (rowid, name, prompt, llm_input, tags)
+                VALUES
+                    (new.rowid, new.name, new.prompt, new.llm_input, new.tags);
+            END
+            """,
+        ],
+    ),
+    (
+        8,
+        [
+            # Расход токенов LLM за сутки (UTC) по пользователям для
+            # дневных бюджетов (token_budget.py); "" — без пользователя
+            """
+            CREATE TABLE IF NOT EXISTS token_usage (
+                day TEXT NOT NULL,
+                user TEXT NOT NULL,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, user)
+            ) WITHOUT ROWID
+            """,
+        ],
+    ),
+]
 
 
-def save_prompt(record):
-    """Сохранить запись промпта."""
-    try:
-        rid = record.get("id") or str(uuid.uuid4())
-        name = record.get("name") or ""
-        prompt = record.get("prompt") or ""
-        slider = record.get("slider_value")
-        llm_input = record.get("llm_input") or ""
-        llm_raw = record.get("llm_raw_response") or ""
-        tags = record.get("tags") or []
-        if isinstance(tags, str):
-            tags_list = [t.strip() for t in tags.split(",") if t.strip()]
-        else:
-            tags_list = list(tags)
-        tags_json = json.dumps(tags_list, ensure_ascii=False)
-        created = record.get("created_at") or datetime.now().isoformat() + "Z"
-
-        sql = """
-        INSERT OR REPLACE INTO saved_prompts
-        (id, name, prompt, slider_value, llm_input, llm_raw_response, tags,
-        created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """
-        params = (
-            rid,
-            name,
-            prompt,
-            slider,
-            llm_input,
-            llm_raw,
-            tags_json,
-            created,
+def _migrate(conn):
+    """Применить недостающие миграции схемы."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Миграцию мог применить параллельный процесс
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current < target:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version={target:d}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        version = target
+
+
+# Колонки, которые пишет приложение (в старых БД могут быть и другие)
+RECORD_COLUMNS = (
+    "id",
+    "name",
+    "prompt",
+    "slider_value",
+    "llm_input",
+    "llm_raw_response",
+    "tags",
+    "created_at",
+)
+
+_INSERT_SQL = """
+INSERT {verb} INTO saved_prompts
+(id, name, prompt, slider_value, llm_input, llm_raw_response, tags,
+created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_UPSERT_SQL = _INSERT_SQL.format(verb="") + """
+ON CONFLICT(id) DO UPDATE SET
+    name = excluded.name,
+    prompt = excluded.prompt,
+    slider_value = excluded.slider_value,
+    llm_input = excluded.llm_input,
+    llm_raw_response = excluded.llm_raw_response,
+    tags = excluded.tags,
+    created_at = excluded.created_at
+"""
+
+
+def _record_params(record):
+    """Нормализовать запись в параметры INSERT (порядок RECORD_COLUMNS)."""
+    rid = record.get("id") or str(uuid.uuid4())
+    name = record.get("name") or ""
+    prompt = record.get("prompt") or ""
+    slider = record.get("slider_value")
+    llm_input = record.get("llm_input") or ""
+    llm_raw = record.get("llm_raw_response") or ""
+    tags = record.get("tags") or []
+    if isinstance(tags, str):
+        tags_list = [t.strip() for t in tags.split(",") if t.strip()]
+    else:
+        tags_list = list(tags)
+    tags_json = json.dumps(tags_list, ensure_ascii=False)
+    created = record.get("created_at") or datetime.now().isoformat() + "Z"
+    return (
+        rid,
+        name,
+        prompt,
+        slider,
+        llm_input,
+        _pack(llm_raw),
+        tags_json,
+        created,
+    )
+
+
+def _tag_rows(params_batch):
+    """Пары (prompt_id, tag) для prompt_tags из параметров записей."""
+    rows = []
+    for params in params_batch:
+        seen = set()
+        for tag in json.loads(params[6]):
+            tag = str(tag).strip()
+            if tag and tag.lower() not in seen:
+                seen.add(tag.lower())
+                rows.append((params[0], tag))
+    return rows
+
+
+def _write_tags(conn, params_batch):
+    """Перезаписать теги записей в prompt_tags (внутри транзакции)."""
+    conn.executemany(
+        "DELETE FROM prompt_tags WHERE prompt_id = ?",
+        [(params[0],) for params in params_batch],
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO prompt_tags (prompt_id, tag) VALUES (?, ?)",
+        _tag_rows(params_batch),
+    )
+
+
+def add_write_hook(hook):
+    """
+    Подписаться на изменения saved_prompts. hook(action, **fields)
+    вызывается после фиксации транзакции:
+      - "save": summary={"id", "name", "created_at"}, prompt, sig
+        (сигнатура от set_signer или None)
+      - "delete": record_id
+      - "bulk": массовое изменение (импорт), кэши нужно сбросить
+    """
+    if hook not in _write_hooks:
+        _write_hooks.append(hook)
+
+
+def remove_write_hook(hook):
+    if hook in _write_hooks:
+        _write_hooks.remove(hook)
+
+
+def set_signer(signer):
+    """
+    signer(prompts) -> [bytes]: сигнатуры prompt_minhash для текстов
+    сохраняемых записей. Считаются до транзакции и пишутся в ней же,
+    так что пачка save_prompts — один коммит; хук "save" получает
+    сигнатуру в поле sig. None — не считать.
+    """
+    global _signer
+    _signer = signer
+
+
+def _sign(batch):
+    """Сигнатуры для пачки параметров записей (None — без сигнатур)."""
+    signer = _signer
+    if signer is None:
+        return None
+    try:
+        return signer([params[2] for params in batch])
+    except Exception as e:
+        print(f"Warning: prompt signatures failed: {e}")
+        return None
+
+
+def _write_saved(conn, batch, sigs):
+    conn.executemany(_INSERT_SQL.format(verb="OR REPLACE"), batch)
+    _write_tags(conn, batch)
+    if sigs is not None:
+        conn.executemany(
+            _SIGNATURE_SQL,
+            [(params[0], sig) for params, sig in zip(batch, sigs)],
         )
-        conn = _conn()
-        conn.execute(sql, params)
-        conn.commit()
-        conn.close()
-        return rid
+
+
+def _notify_saved(batch, sigs):
+    for i, params in enumerate(batch):
+        _notify(
+            "save",
+            summary={
+                "id": params[0],
+                "name": params[1],
+                "created_at": params[7],
+            },
+            prompt=params[2],
+            sig=sigs[i] if sigs is not None else None,
+        )
+
+
+def _notify(action, **fields):
+    for hook in list(_write_hooks):
+        try:
+            hook(action, **fields)
+        except Exception as e:
+            print(f"Warning: storage write hook failed: {e}")
+
+
+def _get_writer():
+    """Очередь отложенной записи (создаётся при первом сохранении)."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            from write_behind import WriteBehindQueue
+
+            s = get_settings()
+            _writer = WriteBehindQueue(
+                save_prompts,
+                max_batch=s.storage_write_batch,
+                max_delay=s.storage_write_delay,
+                name="storage-writer",
+            )
+            metrics.REGISTRY.collector(
+                "write_behind_pending",
+                "Records waiting in the write-behind queue",
+                lambda: _writer.pending,
+            )
+        return _writer
+
+
+def flush_writes(timeout=None):
+    """
+    Дождаться записи отложенных сохранений (STORAGE_WRITE_BEHIND).
+    False — не успели за timeout.
+    """
+    writer = _writer
+    return writer.flush(timeout) if writer is not None else True
+
+
+def _enqueue_save(record):
+    record = dict(record, id=record.get("id") or str(uuid.uuid4()))
+    return record["id"], _get_writer().submit(record)
+
+
+def _report_failed_save(future):
+    if future.exception() is not None:
+        print(f"Error in deferred save_prompt: {future.exception()}")
+
+
+def submit_prompt(record):
+    """
+    Сохранить запись; возвращает concurrent Future с её id. При
+    STORAGE_WRITE_BEHIND запись уходит в очередь писателя, и Future
+    завершается после коммита её пачки; иначе запись сохраняется сразу.
+    """
+    if get_settings().storage_write_behind:
+        return _enqueue_save(record)[1]
+    future = Future()
+    try:
+        future.set_result(save_prompt(record))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+@_timed
+def save_prompt(record):
+    """
+    Сохранить запись промпта. При STORAGE_WRITE_BEHIND запись пишется
+    потоком-писателем пачками (одна транзакция на несколько записей):
+    при STORAGE_WRITE_ACK=sync вызов ждёт коммита, при async сразу
+    возвращает id (ошибка записи попадёт только в лог).
+    """
+    s = get_settings()
+    if s.storage_write_behind:
+        record_id, future = _enqueue_save(record)
+        if s.storage_write_ack == "async":
+            future.add_done_callback(_report_failed_save)
+            return record_id
+        return future.result()
+    try:
+        batch = [_record_params(record)]
+        sigs = _sign(batch)
+        with _conn() as conn:
+            _write_saved(conn, batch, sigs)
+        _notify_saved(batch, sigs)
+        return batch[0][0]
     except Exception as e:
         print(f"Error in save_prompt: {e}")
         raise
 
 
-def get_prompt(record_id):
-    """Получить запись по id."""
+@_timed
+def save_prompts(records):
+    """
+    Сохранить несколько записей одной транзакцией (как save_prompt для
+    каждой, вместе с сигнатурами). Возвращает список id в порядке
+    записей.
+    """
     try:
-        conn = _conn()
-        cur = conn.execute(
-            "SELECT * FROM saved_prompts WHERE id = ? LIMIT 1", (record_id,)
+        batch = [_record_params(record) for record in records]
+        if not batch:
+            return []
+        sigs = _sign(batch)
+        with _conn() as conn:
+            _write_saved(conn, batch, sigs)
+        _notify_saved(batch, sigs)
+        return [params[0] for params in batch]
+    except Exception as e:
+        print(f"Error in save_prompts: {e}")
+        raise
+
+
+# Разделитель тегов в group_concat (не встречается в тексте тегов)
+_TAG_SEP = "\x1f"
+
+# Теги записи одной строкой, без json.loads на стороне Python
+_TAGS_COLUMN = f"""
+(SELECT group_concat(tag, '{_TAG_SEP}') FROM (
+    SELECT tag FROM prompt_tags WHERE prompt_id = p.id ORDER BY tag
+)) AS tag_list
+"""
+
+
+def _split_tags(d):
+    tag_list = d.pop("tag_list", None)
+    d["tags"] = tag_list.split(_TAG_SEP) if tag_list else []
+    return d
+
+
+def _normalize_tags(tags):
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    return [t.strip() for t in (tags or []) if t and t.strip()]
+
+
+def _tag_filter(tags, match="any"):
+    """
+    Условие фильтрации по тегам для запроса с алиасом p и его параметры.
+    match="any" — хотя бы один из тегов, "all" — все теги.
+    """
+    tags = _normalize_tags(tags)
+    if not tags:
+        return "", []
+    if match not in ("any", "all"):
+        raise ValueError(f"Unknown tag match mode: {match!r}")
+    marks = ",".join("?" * len(tags))
+    if match == "any":
+        sql = (
+            "p.id IN (SELECT prompt_id FROM prompt_tags "
+            f"WHERE tag IN ({marks}))"
+        )
+        return sql, tags
+    sql = (
+        "p.id IN (SELECT prompt_id FROM prompt_tags "
+        f"WHERE tag IN ({marks}) GROUP BY prompt_id "
+        "HAVING count(DISTINCT lower(tag)) = ?)"
+    )
+    return sql, tags + [len({t.lower() for t in tags})]
+
+
+def _record_columns(include_raw):
+    """Колонки записи для SELECT (без llm_raw_response — не читаем его)."""
+    if include_raw:
+        return "p.*"
+    return ", ".join(
+        f"p.{name}" for name in RECORD_COLUMNS if name != "llm_raw_response"
+    )
+
+
+def _unpack_raw(d):
+    if "llm_raw_response" in d:
+        d["llm_raw_response"] = _unpack(d["llm_raw_response"])
+    return d
+
+
+@_timed
+def get_prompt(record_id, include_raw=True):
+    """
+    Получить запись по id; include_raw=False — без llm_raw_response
+    (не читать и не распаковывать исходный ответ LLM).
+    """
+    try:
+        cur = _conn().execute(
+            f"SELECT {_record_columns(include_raw)}, {_TAGS_COLUMN} "
+            "FROM saved_prompts AS p WHERE p.id = ? LIMIT 1",
+            (record_id,),
         )
         row = cur.fetchone()
-        conn.close()
         if not row:
             return None
-        d = dict(row)
-        try:
-            d["tags"] = json.loads(d.get("tags") or "[]")
-        except Exception:
-            d["tags"] = []
-        return d
+        return _split_tags(_unpack_raw(dict(row)))
     except Exception as e:
         print(f"Error in get_prompt: {e}")
         return None
 
 
-def list_prompts(limit=100):
-    """Вернуть список последних сохранённых промптов."""
+@_timed
+def list_prompts(limit=100, tags=None, match="any", include_raw=False):
+    """
+    Вернуть список последних сохранённых промптов; tags — фильтр по
+    тегам (match="any" — любой из тегов, "all" — все). Исходный ответ
+    LLM (llm_raw_response) — только с include_raw=True.
+    """
     try:
-        conn = _conn()
-        cur = conn.execute(
-            "SELECT * FROM saved_prompts ORDER BY created_at DESC LIMIT ?",
-            (limit,),
+        where, params = _tag_filter(tags, match)
+        cur = _conn().execute(
+            f"SELECT {_record_columns(include_raw)}, {_TAGS_COLUMN} "
+            "FROM saved_prompts AS p "
+            + (f"WHERE {where} " if where else "")
+            + "ORDER BY p.created_at DESC, p.id DESC LIMIT ?",
+            (*params, limit),
         )
-        rows = cur.fetchall()
-        conn.close()
-        result = []
-        for r in rows:
-            d = dict(r)
-            try:
-                d["tags"] = json.loads(d.get("tags") or "[]")
-            except Exception:
-                d["tags"] = []
-            result.append(d)
-        return result
+        return [_split_tags(_unpack_raw(dict(r))) for r in cur.fetchall()]
+    except ValueError:
+        raise
     except Exception as e:
         print(f"Error in list_prompts: {e}")
         return []
 
 
+@_timed
+def tag_counts(limit=100, within_tags=None, match="all"):
+    """
+    Фасеты тегов: [(tag, count)] по убыванию числа записей. within_tags —
+    считать только среди записей, отфильтрованных по этим тегам.
+    """
+    try:
+        where, params = _tag_filter(within_tags, match)
+        if where:
+            where = "WHERE " + where.replace("p.id", "t.prompt_id", 1)
+        cur = _conn().execute(
+            f"""
+            SELECT t.tag AS tag, count(*) AS count
+            FROM prompt_tags AS t {where}
+            GROUP BY t.tag
+            ORDER BY count DESC, t.tag
+            LIMIT ?
+            """,
+            (*params, limit),
+        )
+        return [(r["tag"], r["count"]) for r in cur.fetchall()]
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"Error in tag_counts: {e}")
+        return []
+
+
+def encode_cursor(created_at, record_id):
+    """Курсор keyset-пагинации: позиция (created_at, id) в списке."""
+    raw = f"{created_at or ''}|{record_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Разобрать курсор в (created_at, id); ValueError для неверного."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at, record_id = raw.split("|", 1)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from None
+    return created_at, record_id
+
+
+@_timed
+def list_prompt_summaries(limit=50, cursor=None, tags=None, match="any"):
+    """
+    Лёгкий список записей (id, name, created_at), новые сверху, с
+    keyset-пагинацией по индексу (created_at, id). Возвращает
+    (rows, next_cursor); next_cursor=None — больше записей нет.
+    tags/match — фильтр по тегам, как в list_prompts.
+    """
+    try:
+        where, params = _tag_filter(tags, match)
+        conditions = [where] if where else []
+        if cursor:
+            conditions.append("(p.created_at, p.id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        params.append(limit + 1)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        cur = _conn().execute(
+            f"""
+            SELECT p.id, p.name, p.created_at FROM saved_prompts AS p
+            {where}
+            ORDER BY p.created_at DESC, p.id DESC LIMIT ?
+            """,
+            params,
+        )
+        rows = [dict(r) for r in cur.fetchall()]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(last["created_at"], last["id"])
+        return rows, next_cursor
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"Error in list_prompt_summaries: {e}")
+        return [], None
+
+
+def _fts_query(text):
+    """
+    Превратить пользовательский ввод в безопасный запрос FTS5: каждое
+    слово в кавычках (AND), последнее — как префикс для поиска по мере
+    набора.
+    """
+    words = [w.replace('"', "") for w in (text or "").split()]
+    words = [w for w in words if w]
+    if not words:
+        return ""
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+@_timed
+def search_prompts(query, limit=20, cursor=None, raw=False):
+    """
+    Полнотекстовый поиск по name, prompt, llm_input и tags (FTS5, BM25).
+    Возвращает (rows, next_cursor); строки содержат id, name, created_at,
+    snippet (фрагмент с подсветкой [..]) и score (меньше — релевантнее).
+    raw=True — query передаётся в синтаксисе FTS5 как есть.
+
+    Чтобы запрос оставался интерактивным на больших библиотеках, по BM25
+    ранжируются только STORAGE_SEARCH_RANK_WINDOW самых новых совпадений (для
+    редких слов это все совпадения), а snippet считается только для
+    возвращаемой страницы.
+    """
+    match = query if raw else _fts_query(query)
+    if not match or not match.strip():
+        return [], None
+    try:
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from None
+    window = max(get_settings().storage_search_rank_window, offset + limit + 1)
+    try:
+        conn = _conn()
+        ranked = conn.execute(
+            """
+            SELECT rowid, bm25(saved_prompts_fts, 5.0, 1.0, 0.5, 2.0)
+            FROM saved_prompts_fts
+            WHERE saved_prompts_fts MATCH ?
+            ORDER BY rowid DESC LIMIT ?
+            """,
+            (match, window),
+        ).fetchall()
+        ranked.sort(key=lambda r: r[1])
+        page = ranked[offset:offset + limit + 1]
+        scores = {r[0]: r[1] for r in page[:limit]}
+        rows = []
+        if scores:
+            marks = ",".join("?" * len(scores))
+            cur = conn.execute(
+                f"""
+                SELECT p.rowid AS rid, p.id, p.name, p.created_at,
+                       snippet(saved_prompts_fts, -1, '[', ']', '…', 12)
+                           AS snippet
+                FROM saved_prompts_fts
+                JOIN saved_prompts AS p ON p.rowid = saved_prompts_fts.rowid
+                WHERE saved_prompts_fts MATCH ?
+                  AND saved_prompts_fts.rowid IN ({marks})
+                """,
+                (match, *scores),
+            )
+            for r in cur.fetchall():
+                d = dict(r)
+                d["score"] = scores[d.pop("rid")]
+                rows.append(d)
+            rows.sort(key=lambda d: d["score"])
+    except sqlite3.OperationalError as e:
+        print(f"Error in search_prompts: {e}")
+        return [], None
+    next_cursor = str(offset + limit) if len(page) > limit else None
+    return rows, next_cursor
+
+
+@_timed
 def delete_prompt(record_id):
     """Удалить запись по id."""
+    # Иначе отложенное сохранение этой записи может вернуть её обратно
+    flush_writes()
     try:
-        conn = _conn()
-        cur = conn.execute(
-            "DELETE FROM saved_prompts WHERE id = ?", (record_id,)
-        )
-        conn.commit()
-        conn.close()
+        with _conn() as conn:
+            cur = conn.execute(
+                "DELETE FROM saved_prompts WHERE id = ?", (record_id,)
+            )
+        if cur.rowcount > 0:
+            _notify("delete", record_id=record_id)
         return cur.rowcount > 0
     except Exception as e:
         print(f"Error in delete_prompt: {e}")
         return False
 
 
+@_timed
+def delete_prompts(record_ids):
+    """Удалить записи одной транзакцией; возвращает удалённые id."""
+    flush_writes()
+    ids = list(dict.fromkeys(record_ids))
+    found = set()
+    try:
+        with _conn() as conn:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                found.update(
+                    r[0]
+                    for r in conn.execute(
+                        f"SELECT id FROM saved_prompts WHERE id IN ({marks})",
+                        chunk,
+                    )
+                )
+                conn.execute(
+                    f"DELETE FROM saved_prompts WHERE id IN ({marks})", chunk
+                )
+    except Exception as e:
+        print(f"Error in delete_prompts: {e}")
+        return []
+    deleted = [record_id for record_id in ids if record_id in found]
+    for record_id in deleted:
+        _notify("delete", record_id=record_id)
+    return deleted
+
+
+@_timed
 def export_prompt_json(record_id, filename=None):
     """Экспортировать запись в JSON-файл в папке outputs/."""
     rec = get_prompt(record_id)
@@ -150,7 +953,668 @@ def export_prompt_json(record_id, filename=None):
         return None
     if not filename:
         filename = f"{record_id}.json"
-    outpath = os.path.join(OUTPUTS_DIR, filename)
+    outputs_dir = get_settings().outputs_dir
+    os.makedirs(outputs_dir, exist_ok=True)
+    outpath = os.path.join(outputs_dir, filename)
     with open(outpath, "w", encoding="utf-8") as f:
         json.dump(rec, f, ensure_ascii=False, indent=2)
     return outpath
+
+
+def _open_text(path, mode, compress=None):
+    """Открыть текстовый файл, gzip — по флагу или расширению .gz."""
+    if compress is None:
+        compress = str(path).endswith(".gz")
+    if compress:
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+    return open(path, mode, encoding="utf-8")
+
+
+@_timed
+def export_ndjson(
+    path,
+    compress=None,
+    query=None,
+    since=None,
+    until=None,
+    ids=None,
+    batch_size=1000,
+    progress=None,
+):
+    """
+    Потоково выгрузить библиотеку (или её часть) в NDJSON, по записи на
+    строку; при compress=True или расширении .gz — с gzip. Память не
+    зависит от размера таблицы: строки читаются порциями fetchmany.
+
+    Фильтры: query — полнотекстовый поиск, since/until — границы
+    created_at (ISO-строки), ids — список id. progress(n) вызывается
+    после каждой порции. Возвращает число выгруженных записей.
+    """
+    flush_writes()
+    where, params = [], []
+    if query:
+        match = _fts_query(query)
+        if not match:
+            return 0
+        where.append(
+            "rowid IN (SELECT rowid FROM saved_prompts_fts "
+            "WHERE saved_prompts_fts MATCH ?)"
+        )
+        params.append(match)
+    if since:
+        where.append("created_at >= ?")
+        params.append(since)
+    if until:
+        where.append("created_at < ?")
+        params.append(until)
+    if ids is not None:
+        ids = list(ids)
+        if not ids:
+            return 0
+        where.append(f"id IN ({','.join('?' * len(ids))})")
+        params.extend(ids)
+    sql = f"SELECT {', '.join(RECORD_COLUMNS)} FROM saved_prompts"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at, id"
+
+    count = 0
+    # Отдельное соединение: длинное чтение не мешает потоку приложения
+    _conn()  # схема должна существовать
+    conn = _open(db_path())
+    try:
+        cur = conn.execute(sql, params)
+        with _open_text(path, "w", compress) as f:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    d = _unpack_raw(dict(row))
+                    try:
+                        d["tags"] = json.loads(d.get("tags") or "[]")
+                    except Exception:
+                        d["tags"] = []
+                    f.write(json.dumps(d, ensure_ascii=False))
+                    f.write("\n")
+                count += len(rows)
+                if progress:
+                    progress(count)
+    finally:
+        conn.close()
+    return count
+
+
+IMPORT_POLICIES = ("upsert", "skip", "replace")
+
+
+@_timed
+def import_ndjson(
+    path, policy="upsert", compress=None, batch_size=5000, progress=None
+):
+    """
+    Потоково загрузить записи из NDJSON (.gz поддерживается) пакетами
+    executemany, по одной транзакции на пакет. Политика для
+    существующих id:
+      upsert  — обновить поля записи;
+      skip    — оставить существующую запись;
+      replace — удалить и вставить заново (как save_prompt).
+    progress(stats) вызывается после каждого пакета. Возвращает
+    {"read", "written", "skipped", "errors"}.
+    """
+    if policy not in IMPORT_POLICIES:
+        raise ValueError(f"Unknown import policy: {policy!r}")
+    flush_writes()
+    if policy == "upsert":
+        sql = _UPSERT_SQL
+    elif policy == "skip":
+        sql = _INSERT_SQL.format(verb="OR IGNORE")
+    else:
+        sql = _INSERT_SQL.format(verb="OR REPLACE")
+
+    stats = {"read": 0, "written": 0, "skipped": 0, "errors": 0}
+    conn = _conn()
+
+    def existing_ids(batch):
+        found = set()
+        ids = [params[0] for params in batch]
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cur = conn.execute(
+                "SELECT id FROM saved_prompts "
+                f"WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            found.update(r[0] for r in cur)
+        return found
+
+    def flush(batch):
+        with conn:
+            if policy == "skip":
+                # Существующие и повторные внутри пакета id пропускаем
+                seen = existing_ids(batch)
+                fresh = []
+                for params in batch:
+                    if params[0] not in seen:
+                        seen.add(params[0])
+                        fresh.append(params)
+                stats["skipped"] += len(batch) - len(fresh)
+                batch = fresh
+            conn.executemany(sql, batch)
+            _write_tags(conn, batch)
+        stats["written"] += len(batch)
+        if progress:
+            progress(dict(stats))
+
+    batch = []
+    try:
+        with _open_text(path, "r", compress) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                stats["read"] += 1
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("record is not an object")
+                    batch.append(_record_params(record))
+                except (ValueError, TypeError) as e:
+                    stats["errors"] += 1
+                    print(
+                        f"Error in import_ndjson, line {stats['read']}: {e}"
+                    )
+                    continue
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+        if batch:
+            flush(batch)
+    finally:
+        if stats["written"]:
+            _notify("bulk")
+    return stats
+
+
+@_timed
+def cache_get(key, max_age=None):
+    """Получить запись кэша ответов LLM (None, если нет или устарела)."""
+    try:
+        cur = _conn().execute(
+            "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        if max_age is not None and time.time() - row["created_at"] > max_age:
+            return None
+        return {
+            "value": _unpack(row["value"]),
+            "created_at": row["created_at"],
+        }
+    except Exception as e:
+        print(f"Error in cache_get: {e}")
+        return None
+
+
+@_timed
+def cache_put(key, value):
+    """Сохранить (или перезаписать) запись кэша ответов LLM."""
+    with _conn() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, created_at) "
+            "VALUES (?, ?, ?)",
+            (key, _pack(value), time.time()),
+        )
+
+
+@_timed
+def cache_clear():
+    """Очистить кэш ответов LLM."""
+    with _conn() as conn:
+        conn.execute("DELETE FROM llm_cache")
+
+
+def iter_signatures(batch_size=5000):
+    """Все сохранённые MinHash-сигнатуры: пакеты [(id, name, sig)]."""
+    cur = _conn().execute(
+        """
+        SELECT m.prompt_id, p.name, m.sig
+        FROM prompt_minhash AS m JOIN saved_prompts AS p ON p.id = m.prompt_id
+        """
+    )
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        yield [(r[0], r[1], r[2]) for r in rows]
+
+
+def iter_unsigned_prompts(batch_size=5000):
+    """
+    Записи без сигнатуры: пакеты [(id, name, prompt)] по порядку id.
+    Каждый пакет — отдельный запрос, так что между пакетами можно писать
+    сигнатуры.
+    """
+    last_id = ""
+    while True:
+        rows = _conn().execute(
+            """
+            SELECT p.id, p.name, p.prompt FROM saved_prompts AS p
+            WHERE p.id > ? AND NOT EXISTS (
+                SELECT 1 FROM prompt_minhash AS m WHERE m.prompt_id = p.id
+            )
+            ORDER BY p.id LIMIT ?
+            """,
+            (last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield [(r[0], r[1], r[2]) for r in rows]
+
+
+_SIGNATURE_SQL = (
+    "INSERT OR REPLACE INTO prompt_minhash (prompt_id, sig) "
+    "SELECT ?, ? WHERE EXISTS "
+    "(SELECT 1 FROM saved_prompts WHERE id = ?1)"
+)
+
+
+@_timed
+def put_signatures(rows):
+    """Сохранить сигнатуры [(prompt_id, sig bytes)] одной транзакцией."""
+    with _conn() as conn:
+        conn.executemany(_SIGNATURE_SQL, rows)
+
+
+@_timed
+def clear_signatures():
+    """Удалить все сигнатуры (например, при смене параметров MinHash)."""
+    with _conn() as conn:
+        conn.execute("DELETE FROM prompt_minhash")
+
+
+@_timed
+def pool_push(band, variants):
+    """Добавить варианты [{"prompt", ...}] в пул полосы band."""
+    now = time.time()
+    rows = [
+        (
+            band,
+            v.get("prompt") or "",
+            v.get("finish_reason") or "",
+            v.get("llm_raw_response") or "",
+            now,
+        )
+        for v in variants
+        if (v.get("prompt") or "").strip()
+    ]
+    with _conn() as conn:
+        conn.executemany(
+            "INSERT INTO landscape_pool "
+            "(band, prompt, finish_reason, llm_raw_response, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+    return len(rows)
+
+
+@_timed
+def pool_pop(band, max_age=None):
+    """
+    Забрать самый старый (но не старше max_age сек.) промпт полосы band;
+    None, если пул пуст. Устаревшие записи удаляются.
+    """
+    conn = _conn()
+    while True:
+        with conn:
+            if max_age is not None:
+                conn.execute(
+                    "DELETE FROM landscape_pool "
+                    "WHERE band = ? AND created_at < ?",
+                    (band, time.time() - max_age),
+                )
+            row = conn.execute(
+                "SELECT * FROM landscape_pool WHERE band = ? "
+                "ORDER BY id LIMIT 1",
+                (band,),
+            ).fetchone()
+            if row is None:
+                return None
+            cur = conn.execute(
+                "DELETE FROM landscape_pool WHERE id = ?", (row["id"],)
+            )
+        # Запись мог забрать другой поток — берём следующую
+        if cur.rowcount:
+            return dict(row)
+
+
+@_timed
+def pool_counts():
+    """Размер пула по полосам: {band: count}."""
+    cur = _conn().execute(
+        "SELECT band, count(*) FROM landscape_pool GROUP BY band"
+    )
+    return {r[0]: r[1] for r in cur.fetchall()}
+
+
+@_timed
+def pool_clear():
+    with _conn() as conn:
+        conn.execute("DELETE FROM landscape_pool")
+
+
+# --- Фоновые задания (jobs.py) ---
+
+_JOB_COLUMNS = {"status", "result", "error", "started_at", "finished_at"}
+
+
+def _job_row(row):
+    d = dict(row)
+    d["params"] = json.loads(d["params"])
+    d["result"] = json.loads(d["result"]) if d["result"] else None
+    return d
+
+
+@_timed
+def job_insert(job_id, session, kind, params, priority, created_at):
+    """Записать новое задание в статусе queued."""
+    with _conn() as conn:
+        conn.execute(
+            "INSERT INTO jobs "
+            "(id, session, kind, params, priority, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+            (
+                job_id,
+                session,
+                kind,
+                json.dumps(params, ensure_ascii=False),
+                priority,
+                created_at,
+            ),
+        )
+
+
+@_timed
+def job_start(job_id, started_at):
+    """Отметить начало выполнения (попытки считаются для восстановления)."""
+    with _conn() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'running', started_at = ?, "
+            "attempts = attempts + 1 WHERE id = ?",
+            (started_at, job_id),
+        )
+
+
+@_timed
+def job_update(job_id, **fields):
+    """Обновить status/result/error/started_at/finished_at задания."""
+    unknown = set(fields) - _JOB_COLUMNS
+    if unknown:
+        raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+    if "result" in fields and fields["result"] is not None:
+        fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _conn() as conn:
+        conn.execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?",
+            (*fields.values(), job_id),
+        )
+
+
+@_timed
+def job_get(job_id):
+    row = _conn().execute(
+        "SELECT * FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+    return _job_row(row) if row else None
+
+
+@_timed
+def jobs_recover(max_attempts):
+    """
+    После перезапуска: прерванные (running) задания вернуть в очередь,
+    а исчерпавшие попытки — пометить failed. Возвращает все задания в
+    очереди (приоритетные и старые — первыми).
+    """
+    now = time.time()
+    with _conn() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', finished_at = ?, "
+            "error = 'Interrupted too many times' "
+            "WHERE status = 'running' AND attempts >= ?",
+            (now, max_attempts),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = 'queued' WHERE status = 'running'"
+        )
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' "
+            "ORDER BY priority DESC, created_at"
+        ).fetchall()
+    return [_job_row(r) for r in rows]
+
+
+@_timed
+def jobs_purge(before):
+    """Удалить завершённые задания, закончившиеся раньше before."""
+    with _conn() as conn:
+        cur = conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed', "
+            "'cancelled') AND finished_at < ?",
+            (before,),
+        )
+    return cur.rowcount
+
+
+# --- Расход токенов (token_budget.py) ---
+
+
+@_timed
+def token_usage_add(day, user, tokens):
+    """Прибавить tokens к расходу пользователя user за сутки day."""
+    with _conn() as conn:
+        conn.execute(
+            "INSERT INTO token_usage (day, user, tokens) VALUES (?, ?, ?) "
+            "ON CONFLICT(day, user) DO UPDATE SET "
+            "tokens = tokens + excluded.tokens",
+            (day, user or "", int(tokens)),
+        )
+
+
+@_timed
+def token_usage_get(day):
+    """Расход за сутки day: {пользователь: токены}."""
+    rows = _conn().execute(
+        "SELECT user, tokens FROM token_usage WHERE day = ?", (day,)
+    ).fetchall()
+    return {row["user"]: row["tokens"] for row in rows}
+
+
+@_timed
+def token_usage_purge(before_day):
+    """Удалить расход за сутки раньше before_day (YYYY-MM-DD)."""
+    with _conn() as conn:
+        cur = conn.execute(
+            "DELETE FROM token_usage WHERE day < ?", (before_day,)
+        )
+    return cur.rowcount
+
+
+# --- Сжатие больших колонок (compression.py) ---
+
+# Колонки, которые хранятся сжатыми: (таблица, колонка). prompt и
+# llm_input не сжимаются — их читает FTS5 (external content).
+COMPRESSED_COLUMNS = (
+    ("saved_prompts", "llm_raw_response"),
+    ("llm_cache", "value"),
+)
+
+# Минимум образцов для обучения словаря и сколько последних брать
+MIN_TRAIN_SAMPLES = 20
+TRAIN_SAMPLES = 2000
+
+# Словари сжатия по пути БД: {id: zdict}
+_dicts = {}
+_dicts_lock = threading.Lock()
+
+
+def _dictionaries():
+    path = db_path()
+    dicts = _dicts.get(path)
+    if dicts is not None:
+        return dicts
+    conn = _conn()
+    with _dicts_lock:
+        dicts = _dicts.get(path)
+        if dicts is None:
+            dicts = {compression.BASE_DICT_ID: compression.BASE_DICT}
+            for row in conn.execute("SELECT id, data FROM compression_dicts"):
+                dicts[row[0]] = bytes(row[1])
+            _dicts[path] = dicts
+        return dicts
+
+
+def _pack(text):
+    """
+    Значение большой колонки для записи: сжатое последним словарём или,
+    если сжатие выключено или текст короткий, как есть.
+    """
+    s = get_settings()
+    if (
+        not s.storage_compress
+        or not isinstance(text, str)
+        or len(text) < s.storage_compress_min_size
+    ):
+        return text
+    dicts = _dictionaries()
+    zdict_id = max(dicts)
+    return compression.compress(
+        text, zdict_id, dicts[zdict_id], s.storage_compress_level
+    )
+
+
+def _unpack(value):
+    """Прочитать значение большой колонки (сжатое или обычный текст)."""
+    if not compression.is_compressed(value):
+        return value
+    zdict_id = compression.dict_id(value)
+    dicts = _dictionaries()
+    if zdict_id not in dicts:
+        # Словарь обучил другой процесс — перечитать
+        with _dicts_lock:
+            _dicts.pop(db_path(), None)
+        dicts = _dictionaries()
+    return compression.decompress(value, dicts[zdict_id])
+
+
+def _train_samples(limit):
+    conn = _conn()
+    samples = []
+    for table, column in COMPRESSED_COLUMNS:
+        cur = conn.execute(
+            f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL "
+            "ORDER BY rowid DESC LIMIT ?",
+            (limit,),
+        )
+        samples.extend(
+            text for text in (_unpack(r[0]) for r in cur) if text
+        )
+    return samples
+
+
+@_timed
+def train_compression_dict(samples=TRAIN_SAMPLES):
+    """
+    Обучить словарь сжатия на последних samples значениях сжимаемых
+    колонок. Новый словарь сохраняется, только если на отложенной части
+    выборки он сжимает лучше текущего. Возвращает id словаря, которым
+    будут сжиматься новые записи.
+    """
+    texts = _train_samples(samples)
+    dicts = _dictionaries()
+    current = max(dicts)
+    if len(texts) < MIN_TRAIN_SAMPLES:
+        return current
+    # Каждая пятая запись — для проверки, остальные — для обучения
+    held_out = texts[::5]
+    train_on = [t for i, t in enumerate(texts) if i % 5]
+    zdict = compression.train(train_on)
+    level = get_settings().storage_compress_level
+    if compression.compressed_size(
+        held_out, zdict, level
+    ) >= compression.compressed_size(held_out, dicts[current], level):
+        return current
+    with _conn() as conn:
+        cur = conn.execute(
+            "INSERT INTO compression_dicts (data, samples, created_at) "
+            "VALUES (?, ?, ?)",
+            (zdict, len(train_on), time.time()),
+        )
+    with _dicts_lock:
+        _dicts.pop(db_path(), None)
+    return cur.lastrowid
+
+
+def _db_bytes(path):
+    return sum(
+        os.path.getsize(path + suffix)
+        for suffix in ("", "-wal")
+        if os.path.exists(path + suffix)
+    )
+
+
+@_timed
+def compact(train=True, vacuum=True, batch_size=500, progress=None):
+    """
+    Пересжать большие колонки и освободить место в файле БД: обучить
+    словарь на текущих данных (train), переписать значения, сжатые
+    другим словарём или ещё хранящиеся текстом (при STORAGE_COMPRESS=0 —
+    распаковать), затем VACUUM. progress(n) вызывается после каждой
+    порции. Возвращает {"dict_id", "rewritten", "bytes_before",
+    "bytes_after"}.
+    """
+    flush_writes()
+    path = db_path()
+    conn = _conn()
+    bytes_before = _db_bytes(path)
+    if train and get_settings().storage_compress:
+        zdict_id = train_compression_dict()
+    else:
+        zdict_id = max(_dictionaries())
+    rewritten = 0
+    for table, column in COMPRESSED_COLUMNS:
+        last = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT rowid, {column} FROM {table} WHERE rowid > ? "
+                "ORDER BY rowid LIMIT ?",
+                (last, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            updates = []
+            for rowid, value in rows:
+                packed = _pack(_unpack(value))
+                if packed != value:
+                    updates.append((packed, rowid))
+            if updates:
+                with conn:
+                    conn.executemany(
+                        f"UPDATE {table} SET {column} = ? WHERE rowid = ?",
+                        updates,
+                    )
+                rewritten += len(updates)
+            if progress:
+                progress(rewritten)
+    if vacuum:
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return {
+        "dict_id": zdict_id,
+        "rewritten": rewritten,
+        "bytes_before": bytes_before,
+        "bytes_after": _db_bytes(path),
+    }
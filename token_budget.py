@@ -0,0 +1,219 @@
+"""
+Размер max_tokens по фактической длине ответов и дневные бюджеты токенов.
+
+CompletionStats хранит скользящее окно длин ответов (completion_tokens)
+по паре (модель, температура). max_tokens запроса — перцентиль окна с
+запасом; пока образцов мало, используется верхний предел. Урезанный
+ответ (finish_reason=length) адаптер дописывает запросом-продолжением,
+а в окно попадает полная длина: следующая оценка станет больше.
+
+TokenBudget — дневные лимиты токенов (prompt + completion): общий и на
+пользователя. Перед запросом резервируется его максимальная стоимость,
+после ответа резерв заменяется фактическим расходом. Расход за сутки
+(UTC) хранится в storage и переживает перезапуск.
+"""
+
+import math
+import time
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import storage
+
+# Сколько суток хранить расход в token_usage
+USAGE_RETENTION_DAYS = 31
+
+
+class CompletionStats:
+    """Длины ответов по (модель, температура) и оценка max_tokens."""
+
+    def __init__(
+        self,
+        percentile: float = 0.98,
+        headroom: float = 1.2,
+        min_tokens: int = 64,
+        max_tokens: int = 1000,
+        min_samples: int = 20,
+        window: int = 500,
+    ):
+        self.percentile = min(1.0, max(0.0, percentile))
+        self.headroom = max(1.0, headroom)
+        self.max_tokens_cap = max(1, max_tokens)
+        self.min_tokens = min(max(1, min_tokens), self.max_tokens_cap)
+        self.min_samples = max(1, min_samples)
+        self.window = max(self.min_samples, window)
+        self._samples: Dict[Tuple[str, float], Deque[int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model: str, temperature: float) -> Tuple[str, float]:
+        return (model or "", round(float(temperature), 2))
+
+    def observe(self, model: str, temperature: float, tokens: int) -> None:
+        """Учесть полную длину ответа (с продолжениями) в токенах."""
+        if tokens <= 0:
+            return
+        key = self._key(model, temperature)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(int(tokens))
+
+    def max_tokens(self, model: str, temperature: float) -> int:
+        """
+        max_tokens для запроса: перцентиль длин × запас в пределах
+        [min_tokens, max_tokens]; без статистики — верхний предел.
+        """
+        with self._lock:
+            samples = self._samples.get(self._key(model, temperature))
+            if samples is None or len(samples) < self.min_samples:
+                return self.max_tokens_cap
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(self.percentile * len(ordered)))
+        value = math.ceil(ordered[index] * self.headroom)
+        return min(self.max_tokens_cap, max(self.min_tokens, value))
+
+    def stats(self) -> List[Dict]:
+        """Снимок по каждой паре (модель, температура)."""
+        with self._lock:
+            keys = list(self._samples)
+            sizes = {key: len(self._samples[key]) for key in keys}
+        return [
+            {
+                "model": model,
+                "temperature": temperature,
+                "samples": sizes[(model, temperature)],
+                "max_tokens": self.max_tokens(model, temperature),
+            }
+            for model, temperature in keys
+        ]
+
+
+class TokenBudgetExceeded(Exception):
+    """Дневной бюджет токенов (общий или пользователя) исчерпан."""
+
+
+class Reservation:
+    """Резерв токенов под один запрос (см. TokenBudget.reserve)."""
+
+    __slots__ = ("day", "user", "tokens")
+
+    def __init__(self, day: str, user: str, tokens: int):
+        self.day = day
+        self.user = user
+        self.tokens = tokens
+
+
+class TokenBudget:
+    """
+    Дневные бюджеты токенов: daily — на всех, user_daily — на одного
+    пользователя (0 — без ограничения). Потокобезопасен; reserve и
+    save обращаются к БД, вызывать их нужно не из event loop-а.
+    """
+
+    def __init__(self, daily: int = 0, user_daily: int = 0):
+        self.daily = max(0, daily)
+        self.user_daily = max(0, user_daily)
+        self._day: Optional[str] = None
+        self._used: Dict[str, int] = {}
+        self._reserved: Dict[str, int] = {}
+        self._used_total = 0
+        self._reserved_total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.daily > 0 or self.user_daily > 0
+
+    @staticmethod
+    def today() -> str:
+        return time.strftime("%Y-%m-%d", time.gmtime())
+
+    def _roll(self) -> str:
+        """Перейти на текущие сутки: загрузить их расход из БД."""
+        day = self.today()
+        if day != self._day:
+            used = storage.token_usage_get(day)
+            before = time.strftime(
+                "%Y-%m-%d",
+                time.gmtime(time.time() - USAGE_RETENTION_DAYS * 86400),
+            )
+            storage.token_usage_purge(before)
+            self._day = day
+            self._used = used
+            self._used_total = sum(used.values())
+            # Резервы прошлых суток сбрасываются: их расход пишется в
+            # свои сутки (save)
+            self._reserved = {}
+            self._reserved_total = 0
+        return day
+
+    def reserve(self, user: Optional[str], tokens: int) -> Reservation:
+        """
+        Зарезервировать tokens под запрос пользователя user или
+        выбросить TokenBudgetExceeded, если бюджет не позволяет.
+        """
+        user = user or ""
+        tokens = max(0, int(tokens))
+        with self._lock:
+            day = self._roll()
+            if self.daily and (
+                self._used_total + self._reserved_total + tokens > self.daily
+            ):
+                raise TokenBudgetExceeded(
+                    f"Daily token budget exhausted ({self.daily})"
+                )
+            if user and self.user_daily and (
+                self._used.get(user, 0)
+                + self._reserved.get(user, 0)
+                + tokens
+                > self.user_daily
+            ):
+                raise TokenBudgetExceeded(
+                    f"Daily token budget for this user exhausted "
+                    f"({self.user_daily})"
+                )
+            self._reserved[user] = self._reserved.get(user, 0) + tokens
+            self._reserved_total += tokens
+        return Reservation(day, user, tokens)
+
+    def release(self, reservation: Reservation, used: int) -> None:
+        """
+        Снять резерв и учесть фактический расход used в памяти (без
+        обращения к БД — можно вызывать из event loop-а).
+        """
+        used = max(0, int(used))
+        user = reservation.user
+        with self._lock:
+            if reservation.day != self._day:
+                return  # сутки сменились: резерв уже сброшен
+            left = self._reserved.get(user, 0) - reservation.tokens
+            if left > 0:
+                self._reserved[user] = left
+            else:
+                self._reserved.pop(user, None)
+            self._reserved_total -= reservation.tokens
+            self._used[user] = self._used.get(user, 0) + used
+            self._used_total += used
+
+    def save(self, reservation: Reservation, used: int) -> None:
+        """Записать расход used в БД (в сутки резерва)."""
+        if used > 0:
+            storage.token_usage_add(reservation.day, reservation.user, used)
+
+    def usage(self, user: Optional[str] = None) -> Dict:
+        """Расход и остаток за сутки: общий или пользователя user."""
+        with self._lock:
+            day = self._roll()
+            if user is None:
+                used, limit = self._used_total, self.daily
+            else:
+                used, limit = self._used.get(user, 0), self.user_daily
+        return {
+            "day": day,
+            "used": used,
+            "limit": limit,
+            "remaining": max(0, limit - used) if limit else None,
+        }
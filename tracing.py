@@ -0,0 +1,574 @@
+"""
+Трассировка запросов и профилирование по требованию.
+
+Трассировка (TRACE_ENABLED=1): обработчик интерфейса или API открывает
+корневой спан с новым trace id, а вызовы llm_adapter и storage внутри
+него — дочерние спаны. Текущий спан хранится в contextvars; на loop
+адаптера и в фоновые задания он передаётся явно (см. attach). Спаны
+пишутся в TRACE_FILE (JSONL, ротация по TRACE_MAX_BYTES) отдельным
+потоком, горячий путь на записи в файл не ждёт.
+
+Профилирование: arm_profile() (или PROFILE_HANDLERS при запуске)
+включает профилировщик — cProfile или сэмплирующий — для следующих
+вызовов обработчика; результат пишется в PROFILE_DIR.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import fnmatch
+import inspect
+import logging
+import secrets
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional
+
+from settings import PROFILE_MODES, get_settings
+
+# Сколько строк статистики cProfile писать в текстовый отчёт
+PROFILE_REPORT_LINES = 60
+
+
+class Span:
+    """Интервал трассы; атрибуты дополняются через set()."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start", "attrs")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str]):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.attrs: Dict = {}
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+
+class _NoopSpan:
+    """Спан выключенной трассировки: set() ничего не делает."""
+
+    trace_id = span_id = parent_id = None
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+NOOP = _NoopSpan()
+
+_current: contextvars.ContextVar = contextvars.ContextVar(
+    "trace_span", default=None
+)
+
+
+def enabled() -> bool:
+    return get_settings().trace_enabled
+
+
+def current() -> Optional[Span]:
+    """Текущий спан (None — вне трассы)."""
+    return _current.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current.get()
+    return span.trace_id if span is not None else None
+
+
+def attach(span: Optional[Span]):
+    """
+    Сделать span текущим (для передачи трассы в другой поток или loop);
+    возвращает токен для detach.
+    """
+    return _current.set(span)
+
+
+def detach(token) -> None:
+    _current.reset(token)
+
+
+def _start(
+    name: str, parent: Optional[Span], root: bool
+) -> Optional[Span]:
+    if parent is None:
+        parent = _current.get()
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id)
+    if not root or not enabled():
+        return None
+    if random.random() >= get_settings().trace_sample_rate:
+        return None
+    return Span(name, secrets.token_hex(16), None)
+
+
+def _finish(span: Span, error: Optional[BaseException] = None) -> None:
+    record = {
+        "trace_id": span.trace_id,
+        "span_id": span.span_id,
+        "parent_id": span.parent_id,
+        "name": span.name,
+        "start": round(span.start, 6),
+        "duration_ms": round((time.time() - span.start) * 1000, 3),
+        "thread": threading.current_thread().name,
+    }
+    if span.attrs:
+        record["attrs"] = span.attrs
+    if error is not None:
+        record["error"] = f"{type(error).__name__}: {error}"
+    _write(record)
+
+
+@contextmanager
+def span(
+    name: str, parent: Optional[Span] = None, root: bool = False, **attrs
+) -> Iterator:
+    """
+    Спан на время блока: дочерний к parent или к текущему. Без
+    родителя спан открывается, только если root=True (новая трасса) и
+    трассировка включена; иначе блок выполняется без записи (NOOP).
+    """
+    s = _start(name, parent, root)
+    if s is None:
+        yield NOOP
+        return
+    s.attrs.update(attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        _finish(s, e)
+        raise
+    else:
+        _finish(s)
+    finally:
+        _current.reset(token)
+
+
+def record(
+    name: str, started: float, duration: float, **attrs
+) -> None:
+    """
+    Записать уже измеренный интервал (started — time.time() начала)
+    дочерним спаном текущего.
+    """
+    parent = _current.get()
+    if parent is None:
+        return
+    s = Span(name, parent.trace_id, parent.span_id)
+    s.start = started
+    if attrs:
+        s.attrs.update(attrs)
+    out = {
+        "trace_id": s.trace_id,
+        "span_id": s.span_id,
+        "parent_id": s.parent_id,
+        "name": name,
+        "start": round(started, 6),
+        "duration_ms": round(duration * 1000, 3),
+        "thread": threading.current_thread().name,
+    }
+    if s.attrs:
+        out["attrs"] = s.attrs
+    _write(out)
+
+
+def http_trace() -> Optional[Callable]:
+    """
+    Колбэк для request.extensions["trace"] (httpcore): фазы соединения
+    и запроса (TCP+DNS, TLS, отправка, ожидание заголовков) — дочерними
+    спанами текущего. None вне трассы.
+    """
+    parent = _current.get()
+    if parent is None:
+        return None
+    started: Dict[str, float] = {}
+
+    async def trace(event: str, info: Dict) -> None:
+        name, _, stage = event.rpartition(".")
+        if stage == "started":
+            started[name] = time.time()
+            return
+        t0 = started.pop(name, None)
+        if t0 is None:
+            return
+        s = Span("http." + name, parent.trace_id, parent.span_id)
+        s.start = t0
+        error = info.get("exception") if stage == "failed" else None
+        # Чтение тела, прерванное потребителем (закрыл поток), — не сбой
+        if error is not None and type(error).__name__ not in (
+            "GeneratorExit",
+            "CancelledError",
+        ):
+            s.attrs["error"] = f"{type(error).__name__}: {error}"
+        _finish(s)
+
+    return trace
+
+
+# --- Обёртки функций ---
+
+
+def traced(name: Optional[str] = None, root: bool = False):
+    """
+    Декоратор: вызов функции — спан name (по умолчанию module.qualname).
+    Работает для обычных и async функций и генераторов; для генераторов
+    спан охватывает всю итерацию. root=True — точка входа (обработчик):
+    без текущего спана начинается новая трасса, и вызов можно
+    профилировать через arm_profile().
+    """
+
+    def decorator(fn):
+        span_name = name or f"{fn.__module__}.{fn.__qualname__}"
+
+        if inspect.isasyncgenfunction(fn):
+
+            @wraps(fn)
+            async def agen_wrapper(*args, **kwargs):
+                with _profiled(span_name, root) as profile:
+                    s = _start(span_name, None, root)
+                    agen = fn(*args, **kwargs)
+                    error = None
+                    try:
+                        while True:
+                            token = _current.set(s) if s else None
+                            profile.resume()
+                            try:
+                                item = await agen.__anext__()
+                            except StopAsyncIteration:
+                                break
+                            finally:
+                                profile.pause()
+                                if token is not None:
+                                    _current.reset(token)
+                            yield item
+                    except GeneratorExit:
+                        raise  # потребитель прервал итерацию — не ошибка
+                    except BaseException as e:
+                        error = e
+                        raise
+                    finally:
+                        await agen.aclose()
+                        if s is not None:
+                            _finish(s, error)
+
+            return agen_wrapper
+
+        if inspect.isgeneratorfunction(fn):
+
+            @wraps(fn)
+            def gen_wrapper(*args, **kwargs):
+                with _profiled(span_name, root) as profile:
+                    s = _start(span_name, None, root)
+                    gen = fn(*args, **kwargs)
+                    error = None
+                    try:
+                        while True:
+                            # Каждый шаг может выполняться в другом потоке
+                            # (и контексте) — спан ставится на шаг
+                            token = _current.set(s) if s else None
+                            profile.resume()
+                            try:
+                                item = next(gen)
+                            except StopIteration:
+                                break
+                            finally:
+                                profile.pause()
+                                if token is not None:
+                                    _current.reset(token)
+                            yield item
+                    except GeneratorExit:
+                        raise  # потребитель прервал итерацию — не ошибка
+                    except BaseException as e:
+                        error = e
+                        raise
+                    finally:
+                        gen.close()
+                        if s is not None:
+                            _finish(s, error)
+
+            return gen_wrapper
+
+        if inspect.iscoroutinefunction(fn):
+
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with _profiled(span_name, root) as profile:
+                    with span(span_name, root=root):
+                        profile.resume()
+                        try:
+                            return await fn(*args, **kwargs)
+                        finally:
+                            profile.pause()
+
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not root and _current.get() is None:
+                return fn(*args, **kwargs)
+            with _profiled(span_name, root) as profile:
+                with span(span_name, root=root):
+                    profile.resume()
+                    try:
+                        return fn(*args, **kwargs)
+                    finally:
+                        profile.pause()
+
+        return wrapper
+
+    return decorator
+
+
+# --- Запись спанов ---
+
+_logger: Optional[logging.Logger] = None
+_listener = None
+_logger_lock = threading.Lock()
+
+
+def _get_logger() -> logging.Logger:
+    """
+    Логгер трасс: QueueHandler (без ожидания диска на горячем пути) ->
+    поток QueueListener -> RotatingFileHandler(TRACE_FILE).
+    """
+    global _logger, _listener
+    if _logger is not None:
+        return _logger
+    with _logger_lock:
+        if _logger is None:
+            import atexit
+            from logging.handlers import (
+                QueueHandler,
+                QueueListener,
+                RotatingFileHandler,
+            )
+
+            s = get_settings()
+            directory = os.path.dirname(s.trace_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(
+                s.trace_file,
+                maxBytes=s.trace_max_bytes,
+                backupCount=s.trace_backups,
+                encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            records: queue.Queue = queue.Queue(-1)
+            _listener = QueueListener(records, handler)
+            _listener.start()
+            atexit.register(_listener.stop)
+            logger = logging.getLogger("flux_prompt_lab.trace")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(QueueHandler(records))
+            _logger = logger
+    return _logger
+
+
+def _write(record: Dict) -> None:
+    try:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        _get_logger().info(line)
+    except Exception as e:
+        print(f"Warning: trace write failed: {e}")
+
+
+# --- Профилирование по требованию ---
+
+# None — ещё не прочитан PROFILE_HANDLERS (включение из окружения)
+_armed: Optional[List[Dict]] = None
+_armed_lock = threading.Lock()
+
+
+def _armed_list() -> List[Dict]:
+    global _armed
+    if _armed is None:
+        with _armed_lock:
+            if _armed is None:
+                s = get_settings()
+                _armed = []
+                if s.profile_handlers:
+                    _armed.append(
+                        {
+                            "pattern": s.profile_handlers,
+                            "count": max(1, s.profile_count),
+                            "mode": s.profile_mode,
+                        }
+                    )
+    return _armed
+
+
+def arm_profile(
+    pattern: str = "*", count: int = 1, mode: str = "cprofile"
+) -> Dict:
+    """
+    Профилировать следующие count вызовов обработчиков, имя спана
+    которых подходит под pattern (fnmatch, например "ui.generate*").
+    mode: cprofile — детерминированный (pstats + текстовый отчёт),
+    sample — сэмплирующий (свёрнутые стеки всех потоков для
+    flamegraph). Возвращает описание включённого профилирования.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode: {mode!r}")
+    request = {"pattern": pattern, "count": max(1, count), "mode": mode}
+    armed = _armed_list()
+    with _armed_lock:
+        armed.append(request)
+    return dict(request)
+
+
+def armed_profiles() -> List[Dict]:
+    armed = _armed_list()
+    with _armed_lock:
+        return [dict(r) for r in armed]
+
+
+def _take_armed(name: str) -> Optional[str]:
+    armed = _armed_list()
+    if not armed:
+        return None
+    with _armed_lock:
+        for request in armed:
+            if fnmatch.fnmatchcase(name, request["pattern"]):
+                request["count"] -= 1
+                if request["count"] <= 0:
+                    armed.remove(request)
+                return request["mode"]
+    return None
+
+
+class _NoProfile:
+    def resume(self) -> None:
+        pass
+
+    def pause(self) -> None:
+        pass
+
+
+_NO_PROFILE = _NoProfile()
+
+
+class _CProfile:
+    """
+    cProfile, включаемый на каждый шаг вызова: шаги генератора могут
+    выполняться в разных потоках, а cProfile видит только свой поток.
+    """
+
+    def __init__(self):
+        import cProfile
+
+        self.profile = cProfile.Profile()
+
+    def resume(self) -> None:
+        try:
+            self.profile.enable()
+        except ValueError:
+            pass  # в потоке уже работает другой профилировщик
+
+    def pause(self) -> None:
+        self.profile.disable()
+
+    def dump(self, path: str) -> List[str]:
+        import pstats
+
+        self.profile.dump_stats(path + ".prof")
+        with open(path + ".txt", "w", encoding="utf-8") as f:
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats("cumulative").print_stats(PROFILE_REPORT_LINES)
+        return [path + ".prof", path + ".txt"]
+
+
+class _Sampler:
+    """
+    Сэмплирующий профилировщик: фоновый поток раз в PROFILE_INTERVAL
+    сек. снимает стеки всех потоков (sys._current_frames) на время
+    вызова. Результат — свёрнутые стеки «поток;f1;f2 N».
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="profile-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} "
+                        f"({os.path.basename(code.co_filename)}"
+                        f":{frame.f_lineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def resume(self) -> None:
+        pass
+
+    def pause(self) -> None:
+        pass
+
+    def dump(self, path: str) -> List[str]:
+        self._stop.set()
+        self._thread.join()
+        with open(path + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return [path + ".collapsed"]
+
+
+def profiled(name: str):
+    """
+    Профилировщик для вызова name, если он включён arm_profile()
+    (иначе заглушка). Профиль собирается между resume() и pause() и
+    пишется при выходе из блока.
+    """
+    return _profiled(name, True)
+
+
+@contextmanager
+def _profiled(name: str, root: bool) -> Iterator:
+    mode = _take_armed(name) if root else None
+    if mode is None:
+        yield _NO_PROFILE
+        return
+    s = get_settings()
+    if mode == "cprofile":
+        profile = _CProfile()
+    else:
+        profile = _Sampler(s.profile_interval)
+    started = time.time()
+    try:
+        yield profile
+    finally:
+        profile.pause()
+        os.makedirs(s.profile_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+        base = os.path.join(
+            s.profile_dir, f"{name}-{stamp}-{secrets.token_hex(3)}"
+        )
+        try:
+            files = profile.dump(base)
+            print(f"Profile of {name} written to {', '.join(files)}")
+        except Exception as e:
+            print(f"Warning: profile dump failed: {e}")
@@ -6,6 +6,7 @@ TEXTS = {
         "slider_label": "Креативность (0 = строго по идее, 10 = креативно)",
         "generate": "Сгенерировать",
         "creative": "Случайный пейзаж",
+        "cancel": "Отменить",
         "save_name": "Имя для сохранения",
         "save_btn": "Сохранить промпт",
         "extended_prompt": "Расширенный промпт",
@@ -14,6 +15,15 @@ TEXTS = {
         "load_btn": "Загрузить",
         "refresh_btn": "Обновить список",
         "delete_btn": "Удалить",
+        "more_btn": "Ещё",
+        "similar_btn": "Похожие",
+        "search_label": "Поиск по сохранённым",
+        "search_placeholder": "Слова из имени, промпта, идеи или тегов",
+        "search_btn": "Найти",
+        "save_tags": "Теги",
+        "save_tags_hint": "Через запятую: горы, закат",
+        "tag_filter_label": "Фильтр по тегам",
+        "tag_match_all": "Все теги сразу",
         "prompt_editor": "Промпт (редактируемый)",
         "status": "Статус",
         "copy_button_html": (
@@ -45,6 +55,7 @@ TEXTS = {
         "slider_label": "Creativity (0 = literal, 10 = creative)",
         "generate": "Generate",
         "creative": "Random landscape",
+        "cancel": "Cancel",
         "save_name": "Save name",
         "save_btn": "Save prompt",
         "extended_prompt": "Extended prompt",
@@ -53,6 +64,15 @@ TEXTS = {
         "load_btn": "Load",
         "refresh_btn": "Refresh list",
         "delete_btn": "Delete",
+        "more_btn": "Load more",
+        "similar_btn": "Similar",
+        "search_label": "Search saved prompts",
+        "search_placeholder": "Words from name, prompt, idea or tags",
+        "search_btn": "Search",
+        "save_tags": "Tags",
+        "save_tags_hint": "Comma-separated: mountains, sunset",
+        "tag_filter_label": "Filter by tags",
+        "tag_match_all": "Match all tags",
         "prompt_editor": "Prompt (editable)",
         "status": "Status",
         "copy_button_html": (
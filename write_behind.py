@@ -0,0 +1,144 @@
+"""
+Отложенная запись с групповым коммитом: записи ставятся в очередь, а
+один поток-писатель сохраняет их пачками — одна транзакция (и один
+fsync) на max_batch записей или на max_delay секунд ожидания.
+"""
+
+import time
+import atexit
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import metrics
+
+WRITE_BATCH_SIZE = metrics.REGISTRY.histogram(
+    "write_behind_batch_size",
+    "Records committed per write-behind transaction",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+WRITE_FAILURES = metrics.REGISTRY.counter(
+    "write_behind_failures", "Records the write-behind writer failed to save"
+)
+
+
+class WriteBehindQueue:
+    """
+    Очередь записи с одним потоком-писателем. flush(items) вызывается в
+    потоке-писателе и возвращает результаты в порядке items (например,
+    id записей). submit() отдаёт Future, который завершается после
+    фиксации транзакции с этой записью. Если пачка не записалась,
+    записи повторяются по одной, чтобы одна плохая запись не роняла
+    остальные. Очередь ограничена max_pending: при переполнении submit
+    ждёт писателя.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List], Sequence],
+        max_batch: int = 100,
+        max_delay: float = 0.05,
+        max_pending: int = 10000,
+        name: str = "write-behind",
+    ):
+        self._flush = flush
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.max_pending = max(self.max_batch, max_pending)
+        self._cond = threading.Condition()
+        self._pending: List[Tuple[object, Future]] = []
+        # Счётчики поставленных и обработанных записей — для flush()
+        self._submitted = 0
+        self._done = 0
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=True
+        )
+        self._thread.start()
+        # Незаписанное — дописать при завершении процесса
+        atexit.register(self.close)
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, item) -> Future:
+        """Поставить запись в очередь; Future — результат flush для неё."""
+        future: Future = Future()
+        with self._cond:
+            while len(self._pending) >= self.max_pending and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            self._pending.append((item, future))
+            self._submitted += 1
+            if len(self._pending) in (1, self.max_batch):
+                self._cond.notify_all()
+        return future
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Дождаться записи всего, что поставлено до вызова. False — не
+        успели за timeout.
+        """
+        with self._cond:
+            target = self._submitted
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: self._done >= target, timeout=timeout
+            )
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Дописать очередь и остановить писателя; новые записи — ошибка."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread.is_alive() and (
+            threading.current_thread() is not self._thread
+        ):
+            self._thread.join(timeout)
+
+    def _next_batch(self) -> Optional[List[Tuple[object, Future]]]:
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            # Добираем пачку не дольше max_delay (при закрытии — сразу)
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_batch and not self._closed:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            batch = self._pending[: self.max_batch]
+            del self._pending[: self.max_batch]
+            # Место в очереди освободилось
+            self._cond.notify_all()
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._write(batch)
+            with self._cond:
+                self._done += len(batch)
+                self._cond.notify_all()
+
+    def _write(self, batch: List[Tuple[object, Future]]) -> None:
+        try:
+            results = self._flush([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                WRITE_FAILURES.inc()
+                batch[0][1].set_exception(e)
+                return
+            for entry in batch:
+                self._write([entry])
+            return
+        WRITE_BATCH_SIZE.observe(len(batch))
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)